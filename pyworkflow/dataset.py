@@ -25,7 +25,9 @@
 # **************************************************************************
 
 import os
+import struct
 from pyworkflow.em.convert import ImageHandler
+from pyworkflow.em.constants import NO_INDEX
 from pyworkflow.mapper.sqlite import SqliteDb, SqliteFlatDb
 from pyworkflow.mapper.sqlite_db import SqliteDb
 
@@ -158,10 +160,17 @@ class Table(object):
         self._rowDict[rowId] = row
     
     def getDataToRenderAndExtra(self):
-        return zip(self.getIdColumn(),
-                   self.getColumnValues("enabled"),
-                   self.getDataToRender(),
-                   self.getTransformationMatrix())
+        """ Return (id, enabled, value to render, transformation matrix)
+        for each row, reading the rows only once. 
+        """
+        label = self._labelToRender
+        colNames = ['id', 'enabled', label, label + '_transformationMatrix']
+        names = self._columns.keys()
+        positions = [names.index(c) if c in self._columns else None 
+                     for c in colNames]
+        
+        return [tuple(None if p is None else row[p] for p in positions) 
+                for row in self.iterRows()]
     
     def getDataToRender(self):
         return self.getColumnValues(self._labelToRender)
@@ -208,6 +217,14 @@ class Table(object):
         """ Iterate over the rows. """
         return self._rowDict.itervalues()
     
+    def setOrderBy(self, columnName, direction='ASC'):
+        """ Sort the rows by the values of a column. """
+        self.getColumn(columnName) # Check that the column exists
+        rows = sorted(self._rowDict.iteritems(), 
+                      key=lambda item: getattr(item[1], columnName),
+                      reverse=direction.upper() == 'DESC')
+        self._rowDict = OrderedDict(rows)
+    
     def getValueFromIndex(self, index, label):
         """ Return the value of the property 'label'
         in the element that has this 'index'.
@@ -271,6 +288,139 @@ class Column(object):
         self._renderType = renderType
     
 
+class SqliteTable(Table):
+    """ Table that reads its rows from the PREFIX_Objects table of
+    a sqlite file when needed, instead of holding all of them. 
+    The sorting is done in the queries and pages of rows can 
+    be read with getRows(first, count).
+    """
+    def __init__(self, dbName, tablePrefix, columns, imgCols, projectPath):
+        """
+        Params:
+            imgCols: dict with the filename columns of images as keys
+                and the columns with their indexes as values.
+        """
+        Table.__init__(self, *columns)
+        self._dbName = dbName
+        self._objectsTable = tablePrefix + 'Objects'
+        self._imgCols = imgCols
+        self._projectPath = projectPath
+        self._orderBy = 'id'
+        self._direction = 'ASC'
+        self._size = None
+        
+    def _getValueFunc(self, i, col):
+        """ Return a function to get the value of column col
+        from the position i of sqlite rows. 
+        """
+        convert = col.getType()
+        
+        def getValue(row):
+            v = row[i]
+            if v is None:
+                v = ''
+            elif isinstance(v, buffer):
+                # Binary matrices (see em.data.Matrix) are 
+                # shown as text, in the same way as json ones
+                values = struct.unpack('16d', v)
+                v = str([list(values[j:j+4]) for j in range(0, 16, 4)])
+            return convert(v)
+        
+        return getValue
+    
+    def _getImageFunc(self, i, indexPos, col):
+        """ Same as _getValueFunc but for images columns, the value
+        will be index@filename if the image index is set.
+        """
+        getFilename = self._getValueFunc(i, col)
+        projectPath = self._projectPath
+        convert = col.getType()
+        
+        def getImage(row):
+            index = row[indexPos]
+            if index:
+                return convert('%06d@%s' % (index, os.path.join(projectPath, row[i] or '')))
+            return getFilename(row)
+        
+        return getImage
+        
+    def _getRowFunc(self, description):
+        """ Return a function to create a Row from the sqlite rows
+        of a query, given its cursor description. The position of
+        each column and how to convert it is only computed once.
+        """
+        positions = dict((d[0], i) for i, d in enumerate(description))
+        funcs = []
+        
+        for col in self.iterColumns():
+            i = positions[col.getName()]
+            if col.getName() in self._imgCols:
+                indexPos = positions[self._imgCols[col.getName()]]
+                funcs.append(self._getImageFunc(i, indexPos, col))
+            else:
+                funcs.append(self._getValueFunc(i, col))
+        
+        makeRow = self.Row._make
+        
+        return lambda row: makeRow([f(row) for f in funcs])
+        
+    def _iterSelect(self, where='', params=(), first=0, count=None):
+        """ Iterate over the rows returned by a query with the
+        current order, the rows are not read all at once. 
+        """
+        query = "SELECT * FROM %s %s ORDER BY %s %s, id" % (self._objectsTable, where,
+                                                            self._orderBy, self._direction)
+        if count is not None or first:
+            query += " LIMIT %d OFFSET %d" % (-1 if count is None else count, first)
+        db = SqliteDb()
+        db._createConnection(self._dbName, 1000)
+        try:
+            db.executeCommand(query, params)
+            rowFunc = self._getRowFunc(db.cursor.description)
+            for row in db.cursor:
+                yield rowFunc(row)
+        finally:
+            db.close()
+            
+    def setOrderBy(self, columnName, direction='ASC'):
+        """ Set the column to sort the rows by in the queries. """
+        self.getColumn(columnName) # Check that the column exists
+        direction = direction.upper()
+        if direction not in ['ASC', 'DESC']:
+            raise Exception('SqliteTable: invalid sort direction "%s"' % direction)
+        self._orderBy = columnName
+        self._direction = direction
+        
+    def getSize(self):
+        """ Return the number of rows. """
+        if self._size is None:
+            db = SqliteDb()
+            db._createConnection(self._dbName, 1000)
+            db.executeCommand("SELECT COUNT(*) FROM %s" % self._objectsTable)
+            self._size = db.cursor.fetchone()[0]
+            db.close()
+        return self._size
+    
+    def getRows(self, first=0, count=None):
+        """ Return the rows, or only count rows starting at first. """
+        return list(self._iterSelect(first=first, count=count))
+    
+    def getRow(self, rowId):
+        rows = list(self._iterSelect('WHERE id=?', (rowId,)))
+        if not rows:
+            raise KeyError(rowId)
+        return rows[0]
+    
+    def _setRow(self, rowId, row):
+        raise Exception('SqliteTable: rows can not be modified')
+    
+    def iterRows(self):
+        return self._iterSelect()
+    
+    def getValueFromIndex(self, index, label):
+        return getattr(self.getRows(index, 1)[0], label)
+    
+
 class SqliteDataSet(DataSet):
     """ Provide a DataSet implementation based on sqlite file.
     The tables of the dataset will be the object tables in database.
@@ -298,6 +448,7 @@ class SqliteDataSet(DataSet):
                 self.tablePrefixes[tableName] = prefix
                 #tablePrefixes.append(prefix)
         DataSet.__init__(self, self.tablePrefixes.keys())
+        self._columnsDict = {} # Columns of each table, read when needed
         db.close()
         
     def _getPlural(self, className):
@@ -307,8 +458,21 @@ class SqliteDataSet(DataSet):
         return className + 's'
         
     def _loadTable(self, tableName):
-        """ Load information from tables PREFIX_Classes, PREFIX_Objects. """
+        """ Create a SqliteTable for tables PREFIX_Classes, PREFIX_Objects.
+        The columns are read only the first time.
+        """
+        if tableName not in self._columnsDict:
+            self._columnsDict[tableName] = self._loadColumns(tableName)
+        columns, imgCols = self._columnsDict[tableName]
+        
+        return SqliteTable(self._dbName, self.tablePrefixes[tableName], 
+                           columns, imgCols, self.projectPath)
         
+    def _loadColumns(self, tableName):
+        """ Load the columns from PREFIX_Classes table, and check in the 
+        first row if the image columns are volumes. Return the columns
+        and a dict with the image columns and its index columns.
+        """
         tableName = self.tablePrefixes[tableName]
         
         BASIC_COLUMNS = [Column('id', int, renderType=COL_RENDER_ID), 
@@ -356,37 +520,28 @@ class SqliteDataSet(DataSet):
                 if row['class_name'] == 'Boolean':
                     renderType = COL_RENDER_CHECKBOX   
                 columns.append(Column(colName, str, label=colLabel, renderType=renderType))
-        table = Table(*columns)
+        # Only keep the filename columns (the prefixes were also added)
+        imgCols = dict((str(k), str(v)) for k, v in imgCols.iteritems() 
+                       if any(col.getName() == k for col in columns))
         
-        checkedImgCols = {} # Check if the image columns are volumes
+        # Check if the image columns are volumes with the first row
         ih = ImageHandler() 
+        db.executeCommand("SELECT * FROM %sObjects LIMIT 1;" % tableName)
+        row = db.cursor.fetchone()
+        if row is not None:
+            for k, colName in imgCols.iteritems():
+                if row[k] is None:
+                    continue
+                filename = os.path.join(self.projectPath, row[k])
+                if os.path.exists(filename.replace(":mrc", "")):
+                    x, y, z, n = ih.getDimensions((row[colName] or NO_INDEX, filename))
+                    if z > 1:
+                        for col in columns:
+                            if col.getName() == k:
+                                col.setRenderType(COL_RENDER_VOLUME)
+        db.close()
         
-        # Populate the table in the DataSet
-        db.executeCommand("SELECT * FROM %sObjects;" % tableName)
-        for row in db._iterResults():
-            rowDict = dict(row)
-            for k, v in rowDict.iteritems():
-                if v is None:
-                    rowDict[k] = ''
-                # Set the index@filename for images columns values
-                if k in imgCols:
-                    colName = imgCols[k]
-                    index = rowDict[colName]
-                    
-                    filename = os.path.join(self.projectPath, rowDict[k])
-                    filepath = filename.replace(":mrc", "")
-                    if not checkedImgCols.get(colName, False):
-                        if os.path.exists(filepath):
-                            #print "Fn to get dims: %s@%s" % (index,filename)
-                            x, y, z, n = ih.getDimensions((index, filename))
-                            if z > 1:
-                                table.getColumn(k).setRenderType(COL_RENDER_VOLUME)
-                        checkedImgCols[colName] = True
-                    if index:
-                        rowDict[k] = '%06d@%s' % (index, filename)
-            table.addRow(row['id'], **rowDict)
-            
-        return table
+        return columns, imgCols
         
         
 class SingleFileDataSet(DataSet):
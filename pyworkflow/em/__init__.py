@@ -38,11 +38,13 @@ from convert import *
 from pyworkflow.viewer import Viewer
 from pyworkflow.wizard import Wizard
 from viewer import *
+from registry import PackagesRegistry, LazyClassesDict
 from pprint import pprint
 import transformations
 #from packages import *
 
 PACKAGES_PATH = os.path.join(pw.HOME, 'em', 'packages')
+REGISTRY_FILE = os.path.join(pw.SCIPION_USER_DATA, 'tmp', 'packages_registry.json')
 
 _emPackagesDict = None
 
@@ -52,6 +54,21 @@ def getPackages():
         _emPackagesDict = getModules(PACKAGES_PATH)
     return _emPackagesDict
 
+_emRegistry = None
+
+def getRegistry():
+    """ Return the registry of the classes in the em-packages,
+    used to import only the packages of the classes that are needed.
+    """
+    global _emRegistry
+    if _emRegistry is None:
+        _emRegistry = PackagesRegistry(PACKAGES_PATH, REGISTRY_FILE,
+                                       {'protocols': Protocol,
+                                        'objects': EMObject,
+                                        'viewers': Viewer,
+                                        'wizards': Wizard})
+    return _emRegistry
+
 # Load all Protocol subclasses found in EM-packages
 _emProtocolsDict = None
 
@@ -92,15 +109,37 @@ def getWizards():
     return _emWizardsDict
         
         
+def getClassesDict(*args, **kwargs):
+    """ Return a dict with the Protocol and EMObject classes
+    defined in pyworkflow.em (updated with args and kwargs), that
+    will import the em-packages classes only when they are requested.
+    """
+    classesDict = LazyClassesDict(getRegistry(), ['protocols', 'objects'])
+    classesDict.update(*args, **kwargs)
+    classesDict.update(getSubclasses(Protocol, globals()))
+    classesDict.update(getSubclasses(EMObject, globals()))
+    return classesDict
+
+
+_emClassesDict = None
+
+def getClass(className):
+    """ Return the Protocol or EMObject class with this name or
+    None if not found. Only the package of the class is imported.
+    """
+    global _emClassesDict
+    if _emClassesDict is None:
+        _emClassesDict = getClassesDict()
+    return _emClassesDict.get(className)
+
+
 def findClass(className):
+    cls = getClass(className)
     
-    if className in getProtocols():
-        return getProtocols()[className]
-    
-    if className in getObjects():
-        return getObjects()[className]
+    if cls is None:
+        raise Exception("findClass: class '%s' not found." % className)
     
-    raise Exception("findClass: class '%s' not found." % className)
+    return cls
 
 
 def findSubClasses(classDict, className):
@@ -119,7 +158,8 @@ def findViewers(className, environment):
     viewers = []
     cls = findClass(className)
     baseClasses = cls.mro()
-    for viewer in getViewers().values():
+    baseNames = [c.__name__ for c in baseClasses]
+    for viewer in getRegistry().findClasses('viewers', environment, baseNames):
         if environment in viewer._environments:
             for t in viewer._targets:
                 if t in baseClasses:
@@ -147,7 +187,10 @@ def findWizards(protocol, environment):
     """ Find availables wizards for this class. 
     Returns:
         a dict with the paramName and wizards for this class."""
-    return findWizardsFromDict(protocol, environment, getWizards())
+    baseNames = [cls.__name__ for cls in protocol.getClass().mro()]
+    wizDict = dict((wiz.__name__, wiz) for wiz in 
+                   getRegistry().findClasses('wizards', environment, baseNames))
+    return findWizardsFromDict(protocol, environment, wizDict)
 
 # Update global dictionary with variables found
 #globals().update(emProtocolsDict)
@@ -158,6 +201,6 @@ def loadSetFromDb(dbName, dbPrefix=''):
     from pyworkflow.mapper.sqlite import SqliteFlatDb
     db = SqliteFlatDb(dbName=dbName, tablePrefix=dbPrefix)
     setClassName = db.getProperty('self') # get the set class name
-    setObj = getObjects()[setClassName](filename=dbName, prefix=dbPrefix)
+    setObj = findClass(setClassName)(filename=dbName, prefix=dbPrefix)
     return setObj
     
\ No newline at end of file
@@ -0,0 +1,174 @@
+# **************************************************************************
+# *
+# * Authors:     Josue Gomez Blanco (jgomez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jgomez@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+This module contains functions to compute angular distributions by
+binning the projection directions in a regular grid over the sphere.
+"""
+
+import os
+import numpy as np
+
+import metadata as md
+
+
+# Width (in degrees) of the tilt bands of the sphere grid
+ANGULAR_BIN_STEP = 2.0
+BINS_SUFFIX = '_bins.npz'
+
+
+def getSphereGrid(step=ANGULAR_BIN_STEP):
+    """ Return the grid used to bin the directions: the sphere is
+    divided in tilt bands of step degrees, and each band in a number
+    of rot bins proportional to its perimeter, so all bins have
+    approximately the same area.
+    Returns (nRot, offsets), with the number of rot bins of each band
+    and the index of the first bin of each band.
+    """
+    nBands = int(np.ceil(180. / step))
+    tiltCenters = (np.arange(nBands) + 0.5) * 180. / nBands
+    perimeter = 360. * np.sin(np.radians(tiltCenters))
+    nRot = np.maximum(1, np.round(perimeter / step)).astype(int)
+    offsets = np.concatenate(([0], np.cumsum(nRot)[:-1]))
+
+    return nRot, offsets
+
+
+def binDirections(rot, tilt, weight=None, step=ANGULAR_BIN_STEP):
+    """ Histogram the projection directions (rot and tilt in degrees)
+    in the sphere grid. Directions with tilt over 180 or below 0 are
+    mapped to the equivalent ones in [0, 180].
+    Returns (rot, tilt, weight) arrays with the center of the non-empty
+    bins and the sum of the weights (or the counts) of each one.
+    """
+    rot = np.asarray(rot, dtype=float)
+    tilt = np.asarray(tilt, dtype=float)
+    weight = (np.ones(rot.shape) if weight is None
+              else np.asarray(weight, dtype=float))
+
+    # Same direction for tilt in (180, 360) or negative tilt
+    tilt = np.mod(tilt, 360.)
+    flip = tilt > 180.
+    tilt = np.where(flip, 360. - tilt, tilt)
+    rot = np.mod(np.where(flip, rot + 180., rot), 360.)
+
+    nRot, offsets = getSphereGrid(step)
+    nBands = len(nRot)
+    band = np.minimum((tilt * nBands / 180.).astype(int), nBands - 1)
+    bandRot = nRot[band]
+    rotBin = np.minimum((rot * bandRot / 360.).astype(int), bandRot - 1)
+    binIds = offsets[band] + rotBin
+
+    nBins = offsets[-1] + nRot[-1]
+    binWeight = np.bincount(binIds, weights=weight, minlength=nBins)
+    binCount = np.bincount(binIds, minlength=nBins)
+    used = np.nonzero(binCount)[0]
+
+    # Centers of the used bins
+    usedBand = np.searchsorted(offsets, used, side='right') - 1
+    binTilt = (usedBand + 0.5) * 180. / nBands
+    binRot = (used - offsets[usedBand] + 0.5) * 360. / nRot[usedBand]
+
+    return binRot, binTilt, binWeight[used]
+
+
+def eulerDirections(rot, tilt):
+    """ Return a (n, 3) array with the projection directions of
+    the angles (in degrees), as xmipp.Euler_direction does.
+    """
+    rot = np.radians(rot)
+    tilt = np.radians(tilt)
+    sinTilt = np.sin(tilt)
+
+    return np.column_stack((np.cos(rot) * sinTilt, np.sin(rot) * sinTilt,
+                            np.cos(tilt)))
+
+
+def readAngles(mdFile):
+    """ Read the rot, tilt and weight columns of a metadata as arrays.
+    Xmipp labels are used, or Relion ones if the Xmipp are not present.
+    The weight is 1 if the metadata has no weights.
+    """
+    angMd = md.MetaData(mdFile)
+    rotLabel, tiltLabel = md.MDL_ANGLE_ROT, md.MDL_ANGLE_TILT
+
+    if (not angMd.containsLabel(md.MDL_ANGLE_TILT) and
+        angMd.containsLabel(md.RLN_ORIENT_TILT)):
+        rotLabel, tiltLabel = md.RLN_ORIENT_ROT, md.RLN_ORIENT_TILT
+
+    rot = np.array(angMd.getColumnValues(rotLabel), dtype=float)
+    tilt = np.array(angMd.getColumnValues(tiltLabel), dtype=float)
+
+    if angMd.containsLabel(md.MDL_WEIGHT):
+        weight = np.array(angMd.getColumnValues(md.MDL_WEIGHT), dtype=float)
+    else:
+        weight = np.ones(rot.shape)
+
+    return rot, tilt, weight
+
+
+def getBinsFile(mdFile):
+    """ Return the file where the bins of mdFile are cached,
+    next to the metadata file.
+    """
+    if '@' in mdFile:
+        block, fileName = mdFile.split('@', 1)
+        return '%s_%s%s' % (os.path.splitext(fileName)[0], block, BINS_SUFFIX)
+
+    return os.path.splitext(mdFile)[0] + BINS_SUFFIX
+
+
+def loadAngularBins(mdFile, step=ANGULAR_BIN_STEP):
+    """ Return the binned (rot, tilt, weight) of the angles in mdFile.
+    The bins are cached in a file next to the metadata and computed
+    again when the metadata is newer or other step is used.
+    """
+    fileName = mdFile.split('@')[-1]
+    binsFn = getBinsFile(mdFile)
+
+    if (os.path.exists(binsFn) and
+        os.path.getmtime(binsFn) >= os.path.getmtime(fileName)):
+        bins = np.load(binsFn)
+        if bins['step'] == step:
+            return bins['rot'], bins['tilt'], bins['weight']
+
+    rot, tilt, weight = binDirections(*readAngles(mdFile), step=step)
+
+    try:
+        np.savez(binsFn, rot=rot, tilt=tilt, weight=weight, step=step)
+    except IOError: # not writable, just compute them next time
+        pass
+
+    return rot, tilt, weight
+
+
+def writeBild(bildFn, centers, radius, color='red'):
+    """ Write a Chimera BILD file with a sphere for each center
+    (a (n, 3) array) and radius.
+    """
+    with open(bildFn, 'w') as f:
+        f.write('.color %s\n' % color)
+        for (x, y, z), r in zip(centers, radius):
+            f.write('.sphere %f %f %f %f\n' % (x, y, z, r))
@@ -28,7 +28,9 @@ This module contains several conversion utilities
 """
 
 import os
+import struct
 import PIL
+import numpy
 
 from constants import NO_INDEX
 import xmipp
@@ -38,6 +40,182 @@ from pyworkflow.utils import runJob, getExt
 # TODO: remove dependency from Xmipp
 DT_FLOAT = xmipp.DT_FLOAT
 
+# Formats that can be read and written with numpy.memmap
+MRC_EXTENSIONS = ['.mrc', '.mrcs', '.st']
+SPIDER_EXTENSIONS = ['.spi', '.stk', '.xmp', '.vol']
+MRC_HEADER_SIZE = 1024
+MRC_DTYPES = {0: 'i1', 1: 'i2', 2: 'f4', 6: 'u2'}
+SPIDER_HEADER_WORDS = 27 # words needed to read the image dimensions
+SPIDER_IFORMS = [1, 3, -11, -12, -21, -22]
+
+
+def _readMrcHeader(fn):
+    """ Return the data type, number of images, image shape, data offset
+    and bytes between images (always 0) of an MRC file. The sections 
+    of the file are taken as the images of the stack.
+    """
+    f = open(fn, 'rb')
+    header = f.read(MRC_HEADER_SIZE)
+    f.close()
+    # Machine stamp is 0x44 0x41 for little endian and 0x11 0x11 for big
+    endian = '>' if struct.unpack('B', header[212:213])[0] == 0x11 else '<'
+    nx, ny, nz, mode = struct.unpack(endian + '4i', header[:16])
+    if mode not in MRC_DTYPES:
+        raise Exception("MRC mode %d of '%s' is not supported" % (mode, fn))
+    nsymbt = struct.unpack(endian + 'i', header[92:96])[0]
+    
+    return (numpy.dtype(endian + MRC_DTYPES[mode]), nz, (ny, nx),
+            MRC_HEADER_SIZE + nsymbt, 0)
+    
+    
+def _unpackSpiderHeader(data, endian):
+    """ Return the words of a SPIDER header unpacked with the given byte
+    order, with SPIDER indexes (starting at 1), or None if they are not
+    a valid SPIDER header.
+    """
+    hdr = (None,) + struct.unpack(endian + '%df' % SPIDER_HEADER_WORDS, data)
+    # Header values 1, 2, 5, 12, 13, 22 and 23 should be integers
+    for i in [1, 2, 5, 12, 13, 22, 23]:
+        try:
+            if hdr[i] != int(hdr[i]):
+                return None
+        except (ValueError, OverflowError): # nan or inf
+            return None
+    labrec, labbyt, lenbyt = int(hdr[13]), int(hdr[22]), int(hdr[23])
+    if int(hdr[5]) not in SPIDER_IFORMS or labbyt != labrec * lenbyt:
+        return None
+    
+    return hdr
+    
+    
+def _readSpiderHeader(fn):
+    """ Same as _readMrcHeader but for SPIDER files. In stacks each
+    image has its own header, which is skipped using the bytes between 
+    images. Images with more than one slice are volumes.
+    """
+    f = open(fn, 'rb')
+    data = f.read(SPIDER_HEADER_WORDS * 4)
+    f.close()
+    hdr = None
+    if len(data) == SPIDER_HEADER_WORDS * 4:
+        for endian in '><': # try big endian first, as SPIDER does
+            hdr = _unpackSpiderHeader(data, endian)
+            if hdr is not None:
+                break
+    if hdr is None:
+        raise Exception("'%s' is not a valid SPIDER file" % fn)
+    dtype = numpy.dtype(endian + 'f4')
+    nslice, nrow, nsam = int(hdr[1]), int(hdr[2]), int(hdr[12])
+    labbyt = int(hdr[22])
+    shape = (nrow, nsam) if nslice == 1 else (nslice, nrow, nsam)
+    
+    if hdr[24] > 0: # istack, the overall header of a stack
+        return dtype, int(hdr[26]), shape, labbyt, labbyt
+    
+    return dtype, 1, shape, labbyt, 0
+
+
+def _readStackHeader(fn):
+    """ Read the header of a MRC or SPIDER file. """
+    ext = os.path.splitext(fn)[1].lower()
+    
+    if ext in MRC_EXTENSIONS:
+        return _readMrcHeader(fn)
+    elif ext in SPIDER_EXTENSIONS:
+        return _readSpiderHeader(fn)
+    
+    raise Exception("Format of '%s' can not be read as a stack" % fn)
+    
+
+def _mapStack(fn, mode='r'):
+    """ Return the images in the file as a numpy.memmap
+    of shape (n, y, x) for images or (n, z, y, x) for volumes.
+    """
+    dtype, n, shape, offset, gap = _readStackHeader(fn)
+    size = numpy.prod(shape)
+    gap /= dtype.itemsize
+    data = numpy.memmap(fn, dtype=dtype, mode=mode, offset=offset,
+                        shape=(n, gap + size))
+    
+    return data[:, gap:].reshape((n,) + shape)
+    
+
+def _writeMrcHeader(f, shape, stats):
+    """ Write the header of an MRC file with float data.
+    shape is (nz, ny, nx) and stats (min, max, mean, rms).
+    """
+    nz, ny, nx = shape
+    header = bytearray(MRC_HEADER_SIZE)
+    struct.pack_into('<10i', header, 0, nx, ny, nz, 2, 0, 0, 0, nx, ny, nz)
+    struct.pack_into('<6f', header, 40, nx, ny, nz, 90, 90, 90)
+    struct.pack_into('<3i3f', header, 64, 1, 2, 3, *stats[:3])
+    struct.pack_into('<4s4Bf', header, 208, 'MAP ', 0x44, 0x41, 0, 0, stats[3])
+    f.write(header)
+    
+
+def _spiderHeader(shape, n, istack, imgnum):
+    """ Return the words of a SPIDER header for images of the given
+    shape, as a float32 array. Index 0 corresponds to SPIDER index 1.
+    """
+    nslice, nrow, nsam = (1,) + shape if len(shape) == 2 else shape
+    lenbyt = nsam * 4
+    labrec = 1024 / lenbyt + (1 if 1024 % lenbyt else 0)
+    hdr = numpy.zeros(labrec * lenbyt / 4, dtype='<f4')
+    values = {1: nslice, 2: nrow, 3: nrow * nslice + labrec, 
+              5: 1 if nslice == 1 else 3, 12: nsam, 13: labrec, 
+              22: labrec * lenbyt, 23: lenbyt, 24: istack, 26: n, 27: imgnum}
+    for i, v in values.iteritems():
+        hdr[i-1] = v
+        
+    return hdr
+
+
+def _createStack(fn, n, shape):
+    """ Write the headers of a new MRC or SPIDER stack file with n 
+    float images of the given shape and return the stack memmap
+    to fill the images data.
+    """
+    ext = os.path.splitext(fn)[1].lower()
+    f = open(fn, 'wb')
+    
+    if ext in MRC_EXTENSIONS:
+        if len(shape) != 2:
+            raise Exception("MRC stacks of volumes are not supported")
+        _writeMrcHeader(f, (n,) + shape, (0, -1, -2, -1)) # stats not set
+        f.truncate(MRC_HEADER_SIZE + n * numpy.prod(shape) * 4)
+        
+    elif ext in SPIDER_EXTENSIONS:
+        if ext == '.stk' or n > 1:
+            _spiderHeader(shape, n, 2, 0).tofile(f)
+            for i in range(1, n+1):
+                _spiderHeader(shape, 0, 0, i).tofile(f)
+                f.seek(numpy.prod(shape) * 4, 1)
+            f.truncate()
+        else:
+            _spiderHeader(shape, 0, 0, 0).tofile(f)
+            f.truncate(f.tell() + numpy.prod(shape) * 4)
+    else:
+        f.close()
+        raise Exception("Format of '%s' can not be written as a stack" % fn)
+    
+    f.close()
+    
+    return _mapStack(fn, mode='r+')
+
+
+def _closeStack(fn, stack):
+    """ Flush the data of a stack created with _createStack 
+    and update the statistics in the header of MRC files.
+    """
+    stack.flush()
+    
+    if os.path.splitext(fn)[1].lower() in MRC_EXTENSIONS:
+        f = open(fn, 'r+b')
+        _writeMrcHeader(f, stack.shape, (stack.min(), stack.max(), 
+                                         stack.mean(), stack.std()))
+        f.close()
+    
+
 
 class ImageHandler(object):
     """ Class to provide several Image manipulation utilities. """
@@ -108,6 +286,9 @@ class ImageHandler(object):
         specified by outFormat/inFormat. If outFormat/inFomat=None then
         there will be inferred from extension
         """
+        if self.isStackFormat(inputFn) and self.isStackFormat(outputFn):
+            self.writeStack(self.readStack(inputFn), outputFn)
+            return
         #get input dim
         (x,y,z,n) = xmipp.getImageSize(inputFn)
         #Create empty output stack for efficiency
@@ -116,6 +297,70 @@ class ImageHandler(object):
         for i in range(1, n+1):
             self.convert((i, inputFn), (i, outputFn))
         
+    def isStackFormat(self, fn):
+        """ Return True if the file is MRC or SPIDER, that can
+        be read and written with readStack and writeStack.
+        """
+        return getExt(fn).lower() in MRC_EXTENSIONS + SPIDER_EXTENSIONS
+    
+    def readStack(self, fn, indices=None):
+        """ Return the images of a MRC or SPIDER stack as a read-only
+        numpy array of shape (n, y, x) mapped to the file. 
+        indices is a list of images indexes (starting at 1) to read,
+        if they are consecutive the array is a view of the file, 
+        otherwise the images are copied to a new array.
+        """
+        stack = _mapStack(fn)
+        
+        if indices is None:
+            return stack
+        
+        first = indices[0]
+        if list(indices) == range(first, first + len(indices)):
+            return stack[first-1:first-1+len(indices)]
+        
+        return stack[[i-1 for i in indices]]
+    
+    def createStack(self, fn, n, shape):
+        """ Create a new MRC or SPIDER stack for n float images of
+        shape (y, x) and return it as a writable numpy array mapped 
+        to the file, so it can be filled without holding it in memory.
+        """
+        return _createStack(fn, n, shape)
+    
+    def writeStack(self, array, fn):
+        """ Write a numpy array of shape (n, y, x) in a MRC or 
+        SPIDER stack file, in a single pass.
+        """
+        stack = _createStack(fn, array.shape[0], array.shape[1:])
+        stack[:] = array
+        _closeStack(fn, stack)
+        
+    def writeImages(self, images, fn):
+        """ Write the images (or locations, see _convertToLocation)
+        in a new stack. If all are MRC or SPIDER files, each input file
+        is mapped only once and the images are copied with numpy,
+        otherwise they are converted one by one.
+        """
+        locations = [self._convertToLocation(img) for img in images]
+        
+        if (self.isStackFormat(fn) and 
+            all(self.isStackFormat(loc[1]) for loc in locations)):
+            stacks = {}
+            output = None
+            for i, (index, inputFn) in enumerate(locations):
+                if inputFn not in stacks:
+                    stacks[inputFn] = _mapStack(inputFn)
+                img = stacks[inputFn][max(index, 1) - 1]
+                if output is None:
+                    output = _createStack(fn, len(locations), img.shape)
+                output[i] = img
+            if output is not None:
+                _closeStack(fn, output)
+        else:
+            for i, loc in enumerate(locations):
+                self.convert(loc, (i+1, fn))
+        
     def getDimensions(self, locationObj):
         """ It will return a tuple with the images dimensions.
         The tuple will contains:
@@ -639,19 +639,20 @@ class EMSet(Set, EMObject):
         This is useful to set new attributes or update values
         for each item.
         """
-        for item in otherSet:
-            # copy items if enabled or copyDisabled=True
-            if copyDisabled or item.isEnabled():
-                newItem = item.clone()
-                if updateItemCallback:
-                    row = None if itemDataIterator is None else next(itemDataIterator)
-                    updateItemCallback(newItem, row)
-                # If updateCallBack function returns attribute _appendItem to False do not append the item
-                if getattr(newItem, "_appendItem", True):
-                    self.append(newItem)
-            else:
-                if itemDataIterator is not None:
-                    next(itemDataIterator) # just skip disabled data row
+        with self.bulkAppend():
+            for item in otherSet:
+                # copy items if enabled or copyDisabled=True
+                if copyDisabled or item.isEnabled():
+                    newItem = item.clone()
+                    if updateItemCallback:
+                        row = None if itemDataIterator is None else next(itemDataIterator)
+                        updateItemCallback(newItem, row)
+                    # If updateCallBack function returns attribute _appendItem to False do not append the item
+                    if getattr(newItem, "_appendItem", True):
+                        self.append(newItem)
+                else:
+                    if itemDataIterator is not None:
+                        next(itemDataIterator) # just skip disabled data row
   
   
 class SetOfImages(EMSet):
@@ -771,11 +772,8 @@ class SetOfImages(EMSet):
         return self._samplingRate.get()
     
     def writeStack(self, fnStack, orderBy='id', direction='ASC'):
-        # TODO create empty file to improve efficiency
-        ih = ImageHandler()
-        for i, img in enumerate(self.iterItems(orderBy=orderBy,
-                                               direction=direction)):
-            ih.convert(img, (i+1, fnStack))
+        ImageHandler().writeImages(self.iterItems(orderBy=orderBy,
+                                                  direction=direction), fnStack)
     
     # TODO: Check whether this function can be used.
     # for example: protocol_apply_mask
@@ -824,9 +822,10 @@ class SetOfImages(EMSet):
         s = "%s (%d items, %s, %0.2f A/px)" % (self.getClassName(), self.getSize(), dimStr, sampling)
         return s
 
-    def iterItems(self, orderBy='id', direction='ASC'):
+    def iterItems(self, orderBy='id', direction='ASC', where='1', reuse=True):
         """ Redefine iteration to set the acquisition to images. """
-        for img in Set.iterItems(self, orderBy=orderBy, direction=direction):
+        for img in Set.iterItems(self, orderBy=orderBy, direction=direction,
+                                 where=where, reuse=reuse):
             # Sometimes the images items in the set could
             # have the acquisition info per data row and we
             # don't want to override with the set acquisition for this case
@@ -834,6 +833,25 @@ class SetOfImages(EMSet):
                 img.setAcquisition(self.getAcquisition())
             yield img
 
+    def getTransformMatrices(self, orderBy='id', direction='ASC', where='1'):
+        """ Read the transformation matrices of all images (or those
+        matching the where condition) directly from the database, 
+        without creating the images and their Transform objects.
+        Returns:
+            (ids, matrices) arrays, matrices with shape (n, 4, 4).
+            The matrices of the images without transform are nan.
+        """
+        try:
+            ids, values = self.getColumnArrays(['id', '_transform._matrix'],
+                                               orderBy=orderBy, 
+                                               direction=direction, where=where)
+        except KeyError: # no image has transform
+            ids = self.getColumnArrays(['id'], orderBy=orderBy,
+                                       direction=direction, where=where)[0]
+            values = [None] * len(ids)
+
+        return ids, Matrix.valuesToArray(values)
+
     def appendFromImages(self, imagesSet):
         """ Iterate over the images and append 
         every image that is enabled. 
@@ -1114,6 +1132,20 @@ class SetOfCoordinates(EMSet):
         for coord in self.iterItems(where=coordWhere):
             yield coord
 
+    def buildSpatialIndex(self, micId, cellSize=None):
+        """ Return a SpatialIndex (see pyworkflow.em.spatial) with the
+        positions of the coordinates of the micrograph micId, and the
+        coordinates ids as ids. The coordinates are read directly from
+        the database, without creating the Coordinate objects.
+        By default the size of the index cells is the box size.
+        """
+        from spatial import SpatialIndex
+        x, y, ids = self.getColumnArrays(['_x', '_y', 'id'], 
+                                         where='_micId=%d' % micId)
+        cellSize = cellSize or self.getBoxSize() or 100
+        
+        return SpatialIndex(np.column_stack((x, y)), cellSize, ids)
+        
     def getMicrographs(self):
         """ Returns the SetOfMicrographs associated with 
         this SetOfCoordinates"""
@@ -1125,6 +1157,12 @@ class SetOfCoordinates(EMSet):
          """
         self._micrographsPointer.set(micrographs)
         
+    def write(self, properties=True):
+        # Coordinates are usually iterated by micrograph
+        # (see iterCoordinates), so index the _micId column
+        self.createIndex('_micId')
+        EMSet.write(self, properties)
+        
     def getFiles(self):
         filePaths = set()
         filePaths.add(self.getFileName())
@@ -1143,25 +1181,79 @@ class SetOfCoordinates(EMSet):
     
 
 class Matrix(Scalar):
+    # If True, the matrix will be stored as a binary blob 
+    # of 16 float64 values instead of json text
+    BINARY_STORAGE = False
+    
+    @classmethod
+    def setBinaryStorage(cls, value):
+        """ Set whether matrices are stored as binary blobs.
+        Both binary and json values are always read, the default
+        json text is kept for compatibility with viewers reading
+        the sqlite files directly.
+        """
+        cls.BINARY_STORAGE = value
+        
+    @classmethod
+    def valuesToArray(cls, values):
+        """ Convert many stored values (json text or binary blobs, 
+        as read from the database) into a single (n, 4, 4) array.
+        None values (items without matrix) give nan matrices.
+        """
+        matrices = np.empty((len(values), 4, 4))
+        matrices.fill(np.nan)
+        binary, text = [], []
+        
+        for i, value in enumerate(values):
+            if isinstance(value, buffer) or isinstance(value, bytearray):
+                binary.append(i)
+            elif value is not None:
+                text.append(i)
+                
+        if binary:
+            data = ''.join(str(values[i]) for i in binary)
+            matrices[binary] = np.frombuffer(data, dtype=np.float64).reshape(-1, 4, 4)
+            
+        if text:
+            # Parse all json matrices at once as a flat list of numbers
+            data = ','.join(values[i] for i in text)
+            data = np.fromstring(data.replace('[', '').replace(']', ''), sep=',')
+            if data.size != 16 * len(text):
+                data = np.array([json.loads(values[i]) for i in text], dtype=float)
+            matrices[text] = data.reshape(-1, 4, 4)
+            
+        return matrices
+        
     def __init__(self, **args):
         Scalar.__init__(self, **args)
         self._matrix = np.eye(4)
         
     def _convertValue(self, value):
         """Value should be a str with comman separated values
-        or a list.
+        or a list. Binary values (buffer) should contain
+        the 16 float64 values of the matrix.
         """
-        self._matrix = np.array(json.loads(value))
+        if isinstance(value, buffer) or isinstance(value, bytearray):
+            # This will not copy the data, the array will be
+            # read-only until modified through getMatrix
+            self._matrix = np.frombuffer(value, dtype=np.float64).reshape(4, 4)
+        else:
+            self._matrix = np.array(json.loads(value))
             
     def getObjValue(self):
-        self._objValue = json.dumps(self._matrix.tolist())
+        if self.BINARY_STORAGE:
+            self._objValue = buffer(np.asarray(self._matrix, dtype=np.float64).tostring())
+        else:
+            self._objValue = json.dumps(self._matrix.tolist())
         return self._objValue
     
     def setValue(self, i, j, value):
-        self._matrix[i, j] = value
+        self.getMatrix()[i, j] = value
         
     def getMatrix(self):
         """ Return internal numpy matrix. """
+        if not self._matrix.flags.writeable:
+            self._matrix = self._matrix.copy()
         return self._matrix
     
     def setMatrix(self, matrix):
@@ -1265,14 +1357,156 @@ class ClassVol(SetOfVolumes):
 
 
 class SetOfClasses(EMSet):
-    """ Store results from a classification. """
+    """ Store results from a classification. 
+    The items of each class are stored in the same sqlite file, in a table
+    per class (prefix Class001, Class002...) or, in the single table layout
+    (see setSingleTable), all in the same table with an index over _classId.
+    In the single table layout, the classes are views over the rows of 
+    the table with their id.
+    """
     ITEM_TYPE = None # type of classes stored in the set
     REP_TYPE = None # type of the representatives of each class
+    ITEMS_PREFIX = 'ClassItems' # prefix of the items table in the single table layout
+    LAYOUT_PROPERTY = 'classesLayout'
+    # If True, the items of new sets are stored in a single table
+    SINGLE_TABLE = False
+    
+    @classmethod
+    def setSingleTable(cls, value):
+        """ Set whether the items of all classes of new sets are stored 
+        in a single table instead of one table per class. Existing sets 
+        are always read with the layout they were written with.
+        The per class tables are kept as default because other programs
+        (e.g the Java viewers) read them directly from the sqlite file.
+        """
+        cls.SINGLE_TABLE = value
     
     def __init__(self, **kwargs):
         EMSet.__init__(self, **kwargs)
         self._representatives = Boolean(False) # Store the average images of each class(SetOfParticles)
         self._imagesPointer = Pointer()
+        self._itemsMapper = None
+        self._singleTable = None
+        
+    def load(self):
+        EMSet.load(self)
+        self._itemsMapper = None
+        self._singleTable = None
+        
+    def write(self, properties=True):
+        EMSet.write(self, properties)
+        if self.isSingleTable():
+            # Build the index over _classId if not done yet
+            self._getItemsMapper().commit()
+        
+    def close(self):
+        EMSet.close(self)
+        if self._itemsMapper is not None:
+            self._itemsMapper.close()
+            self._itemsMapper = None
+            
+    def clear(self):
+        if self.isSingleTable():
+            self._getItemsMapper().deleteAll()
+        EMSet.clear(self)
+        self._singleTable = None
+        
+    def isSingleTable(self):
+        """ Return True if the items of the classes are stored in a 
+        single table, the layout is stored as a property in the file.
+        """
+        if self._singleTable is None:
+            mapper = self._getMapper()
+            if self.getFileName() == ':memory:':
+                # Each connection to memory is a different db,
+                # so the classes views could not share the table
+                self._singleTable = False
+            elif mapper.count():
+                layout = mapper.getProperty(self.LAYOUT_PROPERTY)
+                self._singleTable = layout == 'singleTable'
+            else:
+                self._singleTable = self.SINGLE_TABLE
+        return self._singleTable
+        
+    def _getItemsMapper(self):
+        """ Return the mapper of the table with the items of 
+        all classes, used in the single table layout.
+        """
+        if self._itemsMapper is None:
+            self._itemsMapper = self._MapperClass(self.getFileName(), 
+                                                  self._loadClassesDict(),
+                                                  self.ITEMS_PREFIX)
+            self._itemsMapper.createIndex('_classId')
+        return self._itemsMapper
+    
+    def getClassSizes(self):
+        """ Return a dict with the number of items of each class id.
+        In the single table layout it is done with a single query, 
+        without loading the classes.
+        """
+        if not self.isSingleTable():
+            return dict((cls.getObjId(), cls.getSize()) for cls in self)
+        
+        mapper = self._getItemsMapper()
+        if not mapper.count():
+            return {}
+        rows = mapper.aggregate(['COUNT'], '_classId', ['_classId'])
+        return dict((row['_classId'], row['COUNT']) for row in rows)
+    
+    def migrateToSingleTable(self, dropLegacy=True):
+        """ Move the items of the classes stored in the legacy layout
+        (a table per class) to the single table layout. Nothing is done
+        if the set is already in the single table layout.
+        The items of all classes and the layout are committed at once, 
+        and only then the legacy tables are dropped. So, if the migration
+        fails, the set is still in the legacy layout and it can be 
+        migrated again.
+        Params:
+            dropLegacy: if True, the tables of each class are dropped.
+        """
+        if self.isSingleTable():
+            return
+        
+        fn = self.getFileName()
+        if fn == ':memory:':
+            raise Exception("SetOfClasses.migrateToSingleTable: the set "
+                            "should be stored in a file, not in memory.")
+            
+        classesDict = self._loadClassesDict()
+        classIds = [classItem.getObjId() for classItem in EMSet.iterItems(self)]
+        itemsMapper = self._getItemsMapper()
+        legacyMappers = []
+        
+        try:
+            for classId in classIds:
+                legacy = self._MapperClass(fn, classesDict, 'Class%03d' % classId)
+                legacyMappers.append(legacy)
+                if legacy.db.missingTables():
+                    continue
+                view = itemsMapper.getView('_classId', classId)
+                # Remove the items of a previous failed migration
+                view.deleteAll()
+                view.beginBulk()
+                try:
+                    for item in legacy.selectAll():
+                        view.insert(item)
+                finally:
+                    # All mappers of the file share the connection, 
+                    # the items are committed below with the layout
+                    view.endBulk(commit=False)
+                
+            self._getMapper().setProperty(self.LAYOUT_PROPERTY, 'singleTable')
+            itemsMapper.commit()
+            self._getMapper().commit()
+            self._singleTable = True
+            
+            if dropLegacy:
+                for legacy in legacyMappers:
+                    legacy.db.dropTables()
+                self._getMapper().commit()
+        finally:
+            for legacy in legacyMappers:
+                legacy.close()
 
     def iterClassImages(self):
         """ Iterate over the images of a class. """
@@ -1294,14 +1528,24 @@ class SetOfClasses(EMSet):
             return self.getFirstItem().getRepresentative().getDim()
         return None
     
-    def _setItemMapperPath(self, classItem):
+    def _setItemMapperPath(self, classItem, size=None):
         """ Set the mapper path of this class according to the mapper
-        path of the SetOfClasses and also the prefix acording to class id
+        path of the SetOfClasses and also the prefix acording to class id.
+        In the single table layout, the mapper of the class is a view
+        of the items table and the size of the class could be passed
+        to avoid counting its items.
         """
-        classPrefix = 'Class%03d' % classItem.getObjId()
-        classItem._mapperPath.set('%s,%s' % (self.getFileName(), classPrefix))
-        classItem._mapperPath.setStore(False)
-        classItem.load()
+        if self.isSingleTable():
+            classItem._mapperPath.set('%s,%s' % (self.getFileName(), self.ITEMS_PREFIX))
+            classItem._mapperPath.setStore(False)
+            classItem._mapper = self._getItemsMapper().getView('_classId', 
+                                                               classItem.getObjId())
+            classItem._size.set(classItem._mapper.count() if size is None else size)
+        else:
+            classPrefix = 'Class%03d' % classItem.getObjId()
+            classItem._mapperPath.set('%s,%s' % (self.getFileName(), classPrefix))
+            classItem._mapperPath.setStore(False)
+            classItem.load()
         
     def _insertItem(self, classItem):
         """ Create the SetOfImages assigned to a class.
@@ -1314,6 +1558,9 @@ class SetOfClasses(EMSet):
         EMSet._insertItem(self, classItem)
         classItem.write(properties=False)#Set.write(self)
         
+        if self.isSingleTable() and self.getSize() == 0:
+            self._getMapper().setProperty(self.LAYOUT_PROPERTY, 'singleTable')
+        
     def __getitem__(self, itemId):
         """ Setup the mapper classes before returning the item. """
         classItem = EMSet.__getitem__(self, itemId)
@@ -1325,9 +1572,14 @@ class SetOfClasses(EMSet):
         self._setItemMapperPath(classItem)
         return classItem
 
-    def iterItems(self, orderBy='id', direction='ASC'):
-        for classItem in EMSet.iterItems(self, orderBy=orderBy, direction=direction):
-            self._setItemMapperPath(classItem)
+    def iterItems(self, orderBy='id', direction='ASC', where='1', reuse=True):
+        # Count the items of all classes at once
+        sizes = self.getClassSizes() if self.isSingleTable() else {}
+        
+        for classItem in EMSet.iterItems(self, orderBy=orderBy, direction=direction,
+                                         where=where, reuse=reuse):
+            self._setItemMapperPath(classItem, sizes.get(classItem.getObjId(), 
+                                                         None if not sizes else 0))
             yield classItem
             
     def getSamplingRate(self):
@@ -1343,9 +1595,10 @@ class SetOfClasses(EMSet):
                 newCls.copyInfo(cls)
                 newCls.setObjId(cls.getObjId())
                 self.append(newCls)
-                for img in cls:
-                    if img.isEnabled():                
-                        newCls.append(img)
+                with newCls.bulkAppend():
+                    for img in cls:
+                        if img.isEnabled():                
+                            newCls.append(img)
                 self.update(newCls)
                 
     def copyItems(self, otherSet, 
@@ -1388,36 +1641,57 @@ class SetOfClasses(EMSet):
         """
         clsDict = {} # Dictionary to store the (classId, classSet) pairs
         inputSet = self.getImages()
-        
-        for item in inputSet:
-            # copy items if enabled or copyDisabled=True
-            if classifyDisabled or item.isEnabled():
-                newItem = item.clone()
-                if updateItemCallback:
-                    row = None if itemDataIterator is None else next(itemDataIterator)
-                    updateItemCallback(newItem, row)
-                ref = newItem.getClassId()
-                if ref is None:
-                    raise Exception('Particle classId is None!!!')                    
+        singleTable = self.isSingleTable()
+        if singleTable:
+            # The items of all classes are inserted in batches 
+            # in the same table, they already have the class id
+            itemsMapper = self._getItemsMapper()
+            itemsMapper.beginBulk()
+        
+        try:
+            for item in inputSet:
+                # copy items if enabled or copyDisabled=True
+                if classifyDisabled or item.isEnabled():
+                    newItem = item.clone()
+                    if updateItemCallback:
+                        row = None if itemDataIterator is None else next(itemDataIterator)
+                        updateItemCallback(newItem, row)
+                    ref = newItem.getClassId()
+                    if ref is None:
+                        raise Exception('Particle classId is None!!!')                    
                 
-                if not ref in clsDict: # Register a new class set if the ref was not found.
-                    classItem = self.ITEM_TYPE(objId=ref)
-                    rep = self.REP_TYPE()
-                    classItem.setRepresentative(rep)            
-                    clsDict[ref] = classItem
-                    classItem.copyInfo(inputSet)
-                    classItem.setAcquisition(inputSet.getAcquisition())
-                    if updateClassCallback is not None:
-                        updateClassCallback(classItem)
-                    self.append(classItem)
+                    if not ref in clsDict: # Register a new class set if the ref was not found.
+                        classItem = self.ITEM_TYPE(objId=ref)
+                        rep = self.REP_TYPE()
+                        classItem.setRepresentative(rep)            
+                        clsDict[ref] = classItem
+                        classItem.copyInfo(inputSet)
+                        classItem.setAcquisition(inputSet.getAcquisition())
+                        if updateClassCallback is not None:
+                            updateClassCallback(classItem)
+                        self.append(classItem)
+                        if singleTable:
+                            classItem._mapper = itemsMapper
+                        else:
+                            # Items are inserted in batches in each class table
+                            classItem._getMapper().beginBulk()
+                    else:
+                        classItem = clsDict[ref]
+                    classItem.append(newItem)
                 else:
-                    classItem = clsDict[ref]
-                classItem.append(newItem)
+                    if itemDataIterator is not None:
+                        next(itemDataIterator) # just skip disabled data row
+        finally:
+            # Write the buffered items even if a callback fails
+            if singleTable:
+                itemsMapper.endBulk()
             else:
-                if itemDataIterator is not None:
-                    next(itemDataIterator) # just skip disabled data row                    
-                    
+                for classItem in clsDict.values():
+                    classItem._getMapper().endBulk()
+            
         for classItem in clsDict.values():
+            if singleTable:
+                self._setItemMapperPath(classItem, classItem.getSize())
             self.update(classItem)                    
                 
 
@@ -1430,10 +1704,8 @@ class SetOfClasses2D(SetOfClasses):
         """ Write an stack with the classes averages. """
         if not self.hasRepresentatives():
             raise Exception('Could not write Averages stack if not hasRepresentatives!!!')
-        ih = ImageHandler()
-        for i, class2D in enumerate(self):
-            img = class2D.getRepresentative()
-            ih.convert(img, (i+1, fnStack))
+        ImageHandler().writeImages((class2D.getRepresentative()
+                                    for class2D in self), fnStack)
 
 
 class SetOfClasses3D(SetOfClasses):
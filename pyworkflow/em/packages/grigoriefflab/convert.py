@@ -32,6 +32,7 @@ This module contains converter functions that will serve to:
 """
 
 import os
+import json
 
 from itertools import izip
 import numpy
@@ -47,6 +48,8 @@ HEADER_COLUMNS = ['INDEX', 'PSI', 'THETA', 'PHI', 'SHX', 'SHY', 'MAG',
                   'FILM', 'DF1', 'DF2', 'ANGAST', 'OCC',
                   '-LogP', 'SIGMA', 'SCORE', 'CHANGE']
 
+HEADER_LINE = ("C           PSI   THETA     PHI       SHX       SHY     MAG  FILM      DF1"
+               "      DF2  ANGAST     OCC     -LogP      SIGMA   SCORE  CHANGE\n")
 
 class FrealignParFile(object):
     """ Handler class to read/write frealign metadata."""
@@ -63,10 +66,129 @@ class FrealignParFile(object):
                 row = OrderedDict(zip(HEADER_COLUMNS, line.split()))
                 yield row
 
+    def iterLines(self):
+        """ Iterate over the lines of the file without parsing them.
+        Yield (particleNumber, line) tuples, the particleNumber is
+        None for the comment lines.
+        """
+        for line in self._file:
+            if line.startswith('C'):
+                yield None, line
+            else:
+                yield int(line.split(None, 1)[0]), line
+
+    def writeHeader(self):
+        self._file.write(HEADER_LINE)
+
+    def writeLines(self, lines):
+        """ Write the lines as they are (they should end with newline). """
+        self._file.writelines(lines)
+
     def close(self):
         self._file.close()
 
 
+def splitParFile(parFn, blockFiles, lastParticles):
+    """ Split a par file in the files of the blocks in a single pass.
+    As the par files written for the first iteration, the file of each
+    block contains the particles from the first one to the last 
+    particle of the block, so the lines are copied to all blocks
+    that are not completed yet.
+    Params:
+        parFn: the par file with the particles sorted by number.
+        blockFiles: the par files to write for each block.
+        lastParticles: the last particle number of each block.
+    """
+    outputs = [FrealignParFile(fn, 'w') for fn in blockFiles]
+    for output in outputs:
+        output.writeHeader()
+
+    parFile = FrealignParFile(parFn)
+    block = 0
+    nBlocks = len(outputs)
+    segment = []
+
+    for partNumber, line in parFile.iterLines():
+        while (partNumber is not None and block < nBlocks and 
+               partNumber > lastParticles[block]):
+            # The current block is completed, write the pending 
+            # lines to it and to the following blocks
+            segment = [''.join(segment)]
+            for output in outputs[block:]:
+                output.writeLines(segment)
+            outputs[block].close()
+            segment = []
+            block += 1
+        if block == nBlocks:
+            break
+        segment.append(line)
+
+    segment = [''.join(segment)]
+    for output in outputs[block:]:
+        output.writeLines(segment)
+        output.close()
+    parFile.close()
+
+
+def mergeParFiles(blockFiles, parFn, writeHeader=True):
+    """ Write the particles lines (not the comments) of the blocks files
+    into a single par file.
+    """
+    parFile = FrealignParFile(parFn, 'w')
+    if writeHeader:
+        parFile.writeHeader()
+
+    for fn in blockFiles:
+        if not os.path.exists(fn):
+            raise Exception("Error: file %s does not exists" % fn)
+        with open(fn) as f:
+            parFile.writeLines(line for line in f if not line.startswith('C'))
+    parFile.close()
+
+
+def createBlockPlan(micIdList, numberOfBlocks):
+    """ Distribute the particles in blocks, with all the particles of a
+    micrograph in the same block and the micrographs equally distributed.
+    Params:
+        micIdList: list of dicts with the '_micId' and the 'count' of
+            particles of each micrograph, as returned by aggregate.
+        numberOfBlocks: the number of blocks.
+    Returns:
+        a dict with the 'micIds' and 'counts' (in the order of micIdList,
+        that is used for the Frealign film numbers) and the 'firstParticles'
+        and 'lastParticles' (starting at 1) of each block.
+    """
+    micIds = [mic['_micId'] for mic in micIdList]
+    counts = [mic['count'] for mic in micIdList]
+    # The particles are written sorted by micrograph
+    sortedCounts = numpy.array([c for _, c in sorted(zip(micIds, counts))], dtype=int)
+
+    nMics = len(micIds)
+    micsPerBlock = numpy.empty(numberOfBlocks, dtype=int)
+    micsPerBlock.fill(nMics / numberOfBlocks)
+    micsPerBlock[:nMics % numberOfBlocks] += 1
+
+    partsCumsum = numpy.concatenate(([0], numpy.cumsum(sortedCounts)))
+    lastParticles = partsCumsum[numpy.cumsum(micsPerBlock)]
+    firstParticles = numpy.concatenate(([1], lastParticles[:-1] + 1))
+
+    return {'numberOfBlocks': numberOfBlocks,
+            'micIds': micIds,
+            'counts': counts,
+            'firstParticles': firstParticles.tolist(),
+            'lastParticles': lastParticles.tolist()}
+
+
+def writeBlockPlan(plan, filename):
+    with open(filename, 'w') as f:
+        json.dump(plan, f)
+
+
+def readBlockPlan(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
 def readSetOfParticles(inputSet, outputSet, parFileName):
     """
      Iterate through the inputSet and the parFile lines
@@ -240,6 +362,18 @@ def geometryFromMatrix(matrix):
     return shifts, angles
 
 
+def geometryFromMatrices(matrices):
+    """ Same as geometryFromMatrix, but for (n, 4, 4) matrices,
+    returning the (n, 3) shifts and angles arrays.
+    """
+    from pyworkflow.em.transformations import (translations_from_matrices,
+                                               euler_from_matrices)
+    matrices = inv(matrices)
+    shifts = -translations_from_matrices(matrices)
+    angles = -rad2deg(euler_from_matrices(matrices, axes='szyz'))
+    return shifts, angles
+
+
 def geometryFromAligment(alignment):
     shifts, angles = geometryFromMatrix(alignment.getMatrix(),True)#####
 
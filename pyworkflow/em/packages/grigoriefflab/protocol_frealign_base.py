@@ -41,6 +41,8 @@ from constants import (MOD2_SIMPLE_SEARCH_REFINEMENT, MOD_REFINEMENT, EWA_DISABL
                        MOD_SIMPLE_SEARCH_REFINEMENT, EWA_REFERENCE, EWA_SIMPLE_HAND, EWA_SIMPLE,
                        FSC_3DR_ODD, FSC_3DR_EVEN, FSC_3DR_ALL, MEM_1, MEM_2, INTERPOLATION_0, REF_ANGLES, REF_SHIFTS)
 from grigoriefflab import FREALIGN, FREALIGN_PATH, FREALIGNMP_PATH
+from convert import (HEADER_LINE, splitParFile, mergeParFiles, createBlockPlan,
+                     readBlockPlan, writeBlockPlan, geometryFromMatrices)
 
 
 
@@ -580,6 +582,7 @@ class ProtFrealignBase(EMProtocol):
         inputParticles = self.inputParticles.get()
         magnification = inputParticles.getAcquisition().getMagnification()
         params = {}
+        micIdMap = self._getMicCounter()
 
         for block in self._allBlocks():
             more = 1
@@ -593,7 +596,6 @@ class ProtFrealignBase(EMProtocol):
             # ToDo: Implement a better method to get the info particles.
             #  Now, you iterate several times over the SetOfParticles
             # (as many threads as you have)
-            micIdMap = self._getMicCounter()
             for i, img in self.iterParticlesByMic():
                 film = micIdMap[img.getMicId()]
                 ctf = img.getCTF()
@@ -623,36 +625,26 @@ class ProtFrealignBase(EMProtocol):
     def writeInitialAnglesStep(self):
         """This function write a .par file with all necessary information for a refinement"""
 
-        #imgSet = self.inputParticles.get()
-        #frealign need to have a numeric micId not longer than 5 digits
-        micIdList = self.inputParticles.get().aggregate(['count'],'_micId',['_micId'])
-        self.micIdMap={}
-        counter = 0;
-        for mic in micIdList:
-            self.micIdMap[mic['_micId']]=counter
-            counter = counter +1
+        imgSet = self.inputParticles.get()
+        self.micIdMap = self._getMicCounter()
+        
+        # Convert the transforms of all particles at once,
+        # in the same order of iterParticlesByMic
+        _, matrices = imgSet.getTransformMatrices(orderBy=['_micId', 'id'])
+        shifts, angles = geometryFromMatrices(matrices)
+        
+        # The lines are created iterating only once over the particles,
+        # each block file contains the lines until its last particle
+        lines = [self._getAnglesLine(i + 1, img, shifts[i], angles[i])
+                 for i, img in self.iterParticlesByMic()]
 
         for block in self._allBlocks():
-            more = 1
             _, lastPart = self._initFinalBlockParticles(block)
             parFn = self._getFileName('input_par_block', block= block, iter=1, prevIter=0)
             f = open(parFn, 'w')
-            f.write("C           PSI   THETA     PHI       SHX       SHY     MAG  FILM      DF1"
-                    "      DF2  ANGAST     OCC     -LogP      SIGMA   SCORE  CHANGE\n")
-
-            # ToDo: Implement a better method to get the info particles.
-            # Now, you iterate several times over the SetOfParticles (as many threads as you have)
-            for i, img in self.iterParticlesByMic():
-                partCounter = i + 1
-
-                if partCounter == lastPart: # The last particle in the block
-                    more = 0
-
-                self.writeAnglesLines(partCounter, img, f)
-
-                if more == 0: # close the block.
-                    f.close()
-                    break
+            f.write(HEADER_LINE)
+            f.writelines(lines[:lastPart])
+            f.close()
 
     def refineParticlesStep(self, iterN, block, paramsDic):
         """Only refine the parameters of the SetOfParticles
@@ -1056,20 +1048,9 @@ eot
             copyFile(inFile,file2)
         else:
             if numberOfBlocks != 1:
-                f2 = open(file2, 'w+')
-                f2.write("C           PSI   THETA     PHI       SHX       SHY     MAG  FILM      DF1"
-                         "      DF2  ANGAST     OCC     -LogP      SIGMA   SCORE  CHANGE\n")
-                for block in range(1, numberOfBlocks + 1):
-                    file1 = self._getFileName('output_par_block', block=block, iter=iterN)
-                    if not os.path.exists(file1):
-                        raise Exception ("Error: file %s does not exists" % file1)
-                    f1 = open(file1)
-                    
-                    for l in f1:
-                        if not l.startswith('C'):
-                            f2.write(l)
-                    f1.close()
-                f2.close()
+                blockFiles = [self._getFileName('output_par_block', block=block, iter=iterN)
+                              for block in range(1, numberOfBlocks + 1)]
+                mergeParFiles(blockFiles, file2)
             else:
                 file1 = self._getFileName('output_par_block', block=1, iter=iterN)
                 copyFile(file1, file2)
@@ -1080,29 +1061,9 @@ eot
         prevIter = iterN -1
         file1 = self._getFileName('output_par', iter=prevIter)
         if numberOfBlocks != 1:
-            for block in range(1, numberOfBlocks + 1):
-                f1 = open(file1)
-                file2 = self._getFileName('input_par_block', block=block, iter=iterN, prevIter=prevIter)
-                f2 = open(file2, 'w+')
-                f2.write("C           PSI   THETA     PHI       SHX       SHY     MAG  FILM      DF1"
-                         "      DF2  ANGAST     OCC     -LogP      SIGMA   SCORE  CHANGE\n")
-
-                _, finalPart = self._initFinalBlockParticles(block)
-
-                for l in f1:
-
-                    if l.startswith('C'):
-                        f2.write(l)
-                    else:
-                        split = l.split()
-                        numPart = int(''.join(split[:1]))
-                        
-                        if numPart <= finalPart:
-                            f2.write(l)
-                        else:
-                            break
-                f2.close()
-                f1.close()
+            blockFiles = [self._getFileName('input_par_block', block=block, iter=iterN, prevIter=prevIter)
+                          for block in range(1, numberOfBlocks + 1)]
+            splitParFile(file1, blockFiles, self._getBlockPlan()['lastParticles'])
         else:
             file2 = self._getFileName('input_par_block', block=1, iter=iterN, prevIter=prevIter)
             copyFile(file1, file2)
@@ -1127,53 +1088,49 @@ eot
         for i in range(1, self.numberOfBlocks+1):
             yield i
 
-    def _initFinalBlockParticles(self, block):
-        """ return initial and final particle number for a determined block """
-        sortedMicIdList = sorted(self._getMicIdList(), key=lambda k: k['_micId'])
-        finalPart = 0
-        particlesPerBlock = self._particlesPerBlock(self.numberOfBlocks, sortedMicIdList)
-        for i in range(block):
-            initPart = 1 + finalPart
-            finalPart = finalPart + particlesPerBlock[i]
-        return initPart, finalPart
-    
-    def _particlesPerBlock(self, numberOfBlocks, micIdList):
-        """ Return a list with numberOfBlocks values, each value will be
-        the number of particles assigned to each block.
+    def _getBlockPlan(self, numberOfBlocks=None):
+        """ Return the distribution of the particles in blocks (see
+        convert.createBlockPlan). It is computed only once and stored
+        in the extra folder, so the steps of all iterations reuse it.
         """
-        numbOfMIcs = len(micIdList)
-        
-        restBlock = numbOfMIcs % numberOfBlocks
-        colBlock = numbOfMIcs / numberOfBlocks
-        # Create a list with the number of micrographs assigned
-        # to each block, initially equally distributed
-        blockMics = [colBlock] * numberOfBlocks
-        # Now assign the particles in the rest
-        for i, v in enumerate(blockMics):
-            if i < restBlock:
-                blockMics[i] += 1
+        numberOfBlocks = numberOfBlocks or self.numberOfBlocks
+        if not hasattr(self, '_blockPlans'):
+            self._blockPlans = {}
+        plans = self._blockPlans
         
-        blckCounter = 0
-        micCounter = 1
-        numberOfParts = 0
-        particlesPerBlock = []
-        for mic in micIdList:
-            numberOfParts = numberOfParts + mic['count']
-            if micCounter == blockMics[blckCounter]:
-                if blckCounter < len(blockMics)-1:
-                    blckCounter += 1
-                micCounter = 0
-                particlesPerBlock.append(numberOfParts)
-                numberOfParts = 0
-            micCounter += 1
-        return particlesPerBlock
+        if numberOfBlocks not in plans:
+            planFn = self._getExtraPath('block_plan_%03d.json' % numberOfBlocks)
+            if exists(planFn):
+                plan = readBlockPlan(planFn)
+            else:
+                plan = createBlockPlan(self._getMicIdList(), numberOfBlocks)
+                # Write it with other name and rename, since several
+                # steps (in other processes or threads) could be
+                # computing it at the same time
+                tmpFn = planFn + '.%d.%d' % (os.getpid(), id(plan))
+                writeBlockPlan(plan, tmpFn)
+                os.rename(tmpFn, planFn)
+            plans[numberOfBlocks] = plan
+            
+        return plans[numberOfBlocks]
+    
+    def _initFinalBlockParticles(self, block, numberOfBlocks=None):
+        """ return initial and final particle number for a determined block """
+        plan = self._getBlockPlan(numberOfBlocks)
+        return plan['firstParticles'][block-1], plan['lastParticles'][block-1]
     
     def writeAnglesLines(self, counter, img, filePar):
-        objId = self.micIdMap[img.getMicId()]
-
         # get alignment parameters for each particle
         from convert import geometryFromMatrix
         shifts, angles = geometryFromMatrix(img.getTransform().getMatrix())
+        filePar.write(self._getAnglesLine(counter, img, shifts, angles))
+        
+    def _getAnglesLine(self, counter, img, shifts, angles):
+        """ Return the par file line of a particle, with the shifts and
+        angles already computed from its transform (geometryFromMatrix).
+        """
+        objId = self.micIdMap[img.getMicId()]
+
         #TODO: check if can use shiftZ
         shiftXP, shiftYP, _ = shifts * img.getSamplingRate()
         psiP, thetaP, phiP = angles
@@ -1195,8 +1152,8 @@ eot
         acquisition = img.getAcquisition()
         mag = acquisition.getMagnification()
 
-        filePar.write("%(counter)7d %(psi)7.2f %(theta)7.2f %(phi)7.2f %(shiftX)9.2f %(shiftY)9.2f"
-                      " %(mag)7.0f %(objId)5d %(defU)8.1f %(defV)8.1f %(defAngle)7.2f  100.00      0000     0.5000   00.00   00.00\n" % locals())
+        return ("%(counter)7d %(psi)7.2f %(theta)7.2f %(phi)7.2f %(shiftX)9.2f %(shiftY)9.2f"
+                " %(mag)7.0f %(objId)5d %(defU)8.1f %(defV)8.1f %(defAngle)7.2f  100.00      0000     0.5000   00.00   00.00\n" % locals())
     
     def iterParticlesByMic(self):
         """ Iterate the particles ordered by micrograph """
@@ -1219,12 +1176,8 @@ eot
     
     def _getMicCounter(self):
         #frealign need to have a numeric micId not longer than 5 digits
-        micIdMap={}
-        counter = 0
-        for mic in self._getMicIdList():
-            micIdMap[mic['_micId']]=counter
-            counter = counter +1
-        return micIdMap
+        micIds = self._getBlockPlan()['micIds']
+        return dict((micId, counter) for counter, micId in enumerate(micIds))
     
     def _defNumberOfCPUs(self):
         cpus = max(self.numberOfMpi.get() - 1, self.numberOfThreads.get() - 1, 1)
@@ -33,6 +33,7 @@ from data import Volume
 from pyworkflow.em.packages.grigoriefflab.grigoriefflab import FREALIGNMP_PATH, RSAMPLE_PATH, CALC_OCC_PATH
 # from constants import *
 from protocol_frealign_base import ProtFrealignBase
+from convert import splitParFile, mergeParFiles
 
 
 class ProtFrealignClassify(ProtFrealignBase, ProtClassify3D):
@@ -324,17 +325,9 @@ marginal likelihood.
         
         file2 = self._getFileName('output_par_class', iter=iterN, ref=ref)
         if numberOfBlocks != 1:
-            f2 = open(file2, 'w+')
-            
-            for block in range(1, numberOfBlocks + 1):
-                file1 = self._getFileName('output_par_block_class', block=block, iter=iterN, ref=ref)
-                f1 = open(file1)
-                
-                for l in f1:
-                    if not l.startswith('C'):
-                        f2.write(l)
-                f1.close()
-            f2.close()
+            blockFiles = [self._getFileName('output_par_block_class', block=block, iter=iterN, ref=ref)
+                          for block in range(1, numberOfBlocks + 1)]
+            mergeParFiles(blockFiles, file2, writeHeader=False)
         else:
             file1 = self._getFileName('output_par_block_class', block=1, iter=iterN, ref=ref)
             copyFile(file1, file2)
@@ -345,28 +338,11 @@ marginal likelihood.
         prevIter = iterN -1
         file1 = self._getFileName('output_par_class', iter=prevIter, ref=ref)
         if numberOfBlocks != 1:
-            for block in range(1, numberOfBlocks + 1):
-                f1 = open(file1)
-                file2 = self._getFileName('input_par_block_class',prevIter=prevIter, iter=iterN, ref=ref, block=block)
-                f2 = open(file2, 'w+')
-                _, finalPart = self._particlesInBlock(block, numberOfBlocks)
-                
-                for l in f1:
-                    
-                    if l.startswith('C'):
-                        f2.write(l)
-                    else:
-                        split = l.split()
-                        numPart = int(''.join(split[:1]))
-                        
-                        if numPart <= finalPart:
-                            f2.write(l)
-                        else:
-                            break
-                f2.close()
-                f1.close()
+            blockFiles = [self._getFileName('input_par_block_class',prevIter=prevIter, iter=iterN, ref=ref, block=block)
+                          for block in range(1, numberOfBlocks + 1)]
+            splitParFile(file1, blockFiles, self._getBlockPlan(numberOfBlocks)['lastParticles'])
         else:
-            file2 = self._getFileName('input_par_block_class',prevIter=prevIter, iter=iterN, ref=ref, block=block)
+            file2 = self._getFileName('input_par_block_class',prevIter=prevIter, iter=iterN, ref=ref, block=1)
             copyFile(file1, file2)
     
     def _rsampleCommand(self):
@@ -399,15 +375,5 @@ eot
     
     def _particlesInBlock(self, block, numberOfBlocks):
         """calculate the initial and final particles that belongs to this block"""
-        
-        imgSet = self.inputParticles.get()
-        
-        blockParticles = self._particlesPerBlock(numberOfBlocks, imgSet.getSize())
-        initPart = 0
-        lastPart = 0
-        for i in range(block):
-            initPart = lastPart + 1
-            lastPart = lastPart + blockParticles[i]
-        
-        return initPart, lastPart
+        return self._initFinalBlockParticles(block, numberOfBlocks)
 
@@ -45,6 +45,7 @@ import pyworkflow.em as em
 # Since Relion share several conventions with Xmipp, we will reuse 
 # the xmipp3 tools implemented for Scipion here
 import pyworkflow.em.metadata as md
+from pyworkflow.utils.star import writeStar
 
 
 # This dictionary will be used to map
@@ -276,6 +277,42 @@ def matrixFromGeometry(shifts, angles, inverseTransform):
     return M
 
 
+def geometryFromMatrices(matrices, inverseTransform):
+    """ Same as geometryFromMatrix, but for (n, 4, 4) matrices,
+    returning the (n, 3) shifts and angles arrays.
+    """
+    from pyworkflow.em.transformations import (translations_from_matrices,
+                                               euler_from_matrices)
+    if inverseTransform:
+        from numpy.linalg import inv
+        matrices = inv(matrices)
+        shifts = -translations_from_matrices(matrices)
+    else:
+        shifts = translations_from_matrices(matrices)
+    angles = -numpy.rad2deg(euler_from_matrices(matrices, axes='szyz'))
+    return shifts, angles
+
+
+def matricesFromGeometry(shifts, angles, inverseTransform):
+    """ Same as matrixFromGeometry, but for the (n, 3) shifts 
+    and angles arrays, returning (n, 4, 4) matrices.
+    """
+    from pyworkflow.em.transformations import euler_matrices
+    from numpy import deg2rad
+    radAngles = -deg2rad(angles)
+    shifts = numpy.asarray(shifts)
+    
+    M = euler_matrices(radAngles[:, 0], radAngles[:, 1], radAngles[:, 2], 'szyz')
+    if inverseTransform:
+        from numpy.linalg import inv
+        M[:, :3, 3] = -shifts[:, :3]
+        M = inv(M)
+    else:
+        M[:, :3, 3] = shifts[:, :3]
+
+    return M
+
+
 def alignmentToRow(alignment, alignmentRow, alignType):
     """
     is2D == True-> matrix is 2D (2D images alignment)
@@ -508,6 +545,176 @@ def setOfImagesToMd(imgSet, imgMd, imgToFunc, **kwargs):
         imgRow.writeToMd(imgMd, objId)
 
 
+def _getSetColumn(imgSet, label):
+    """ Return the values of an attribute of all items of the set,
+    or None if no item has a value for it. If only some items have
+    a value, it can not be written as a column and ValueError is raised.
+    """
+    try:
+        values = imgSet.getColumnArrays([label])[0]
+    except KeyError: # the items have not this attribute
+        return None
+
+    if values.dtype.kind == 'f':
+        missing = numpy.isnan(values)
+    elif values.dtype == object:
+        missing = numpy.array([v is None for v in values], dtype=bool)
+    else:
+        return values
+
+    if missing.all():
+        return None
+    if missing.any():
+        raise ValueError("Some items have no value for '%s'" % label)
+    return values
+
+
+def _getConstantColumn(value, n):
+    """ Return a column with the same value for the n items, 
+    or None if the value is None. 
+    """
+    if value is None:
+        return None
+    return numpy.repeat(value, n)
+
+
+def _toLabelType(label, values):
+    """ Cast the values to the type of the label, as objectToRow does. """
+    valueType = md.label2Python(label)
+    if valueType is str:
+        return values
+    return values.astype(valueType)
+
+
+def alignmentToColumns(imgSet, alignType):
+    """ Convert the transform of all images of the set at once, 
+    in the same way as alignmentToRow.
+    Returns:
+        an OrderedDict with the alignment labels as keys and the
+        arrays of values, empty if no image has a transform.
+        ValueError is raised if only some images have a transform.
+    """
+    columns = OrderedDict()
+    matrices = imgSet.getTransformMatrices()[1]
+    missing = numpy.isnan(matrices).any(axis=2).any(axis=1)
+    
+    if missing.all():
+        return columns
+    if missing.any():
+        raise ValueError("Some items have no transform")
+    
+    is2D = alignType == em.ALIGN_2D
+    inverseTransform = alignType == em.ALIGN_PROJ
+    shifts, angles = geometryFromMatrices(matrices, inverseTransform)
+    
+    columns[md.RLN_ORIENT_ORIGIN_X] = shifts[:, 0]
+    columns[md.RLN_ORIENT_ORIGIN_Y] = shifts[:, 1]
+    
+    if is2D:
+        columns[md.RLN_ORIENT_PSI] = angles[:, 0] + angles[:, 2]
+    else:
+        columns[md.RLN_ORIENT_ORIGIN_Z] = shifts[:, 2]
+        columns[md.RLN_ORIENT_ROT] = angles[:, 0]
+        columns[md.RLN_ORIENT_TILT] = angles[:, 1]
+        columns[md.RLN_ORIENT_PSI] = angles[:, 2]
+    
+    return columns
+
+
+def particlesToColumns(imgSet, **kwargs):
+    """ Read the values of the Relion labels of all particles of the set
+    as columns, directly from the set database and without creating
+    the particles and rows as particleToRow does.
+    Params:
+        imgSet: the SetOfParticles.
+        kwargs: the same options of particleToRow (filesDict, writeCtf...)
+    Returns:
+        an OrderedDict with the labels names as keys and the arrays of values
+        or None if the row hooks are used or some particles have missing
+        values (or transform), so particleToRow should be used.
+    """
+    alignType = kwargs.get('alignType', imgSet.getAlignment())
+    if kwargs.get('preprocessImageRow') or kwargs.get('postprocessImageRow'):
+        return None
+
+    columns = OrderedDict()
+
+    def addColumn(label, values, castType=True):
+        if values is not None:
+            columns[md.label2Str(label)] = (_toLabelType(label, values) 
+                                            if castType else values)
+
+    try:
+        ids, enabled, filenames, indexes = imgSet.getColumnArrays(['id', 'enabled', 
+                                                                   '_filename', '_index'])
+        addColumn(md.RLN_IMAGE_ENABLED, enabled, castType=False)
+
+        for attr, label in COOR_DICT.iteritems():
+            addColumn(label, _getSetColumn(imgSet, '_coordinate.' + attr))
+        coordMicIds = _getSetColumn(imgSet, '_coordinate._micId')
+        if coordMicIds is not None:
+            addColumn(md.RLN_MICROGRAPH_NAME, 
+                      numpy.array([str(m) for m in coordMicIds], dtype=object))
+
+        # The micId of the particle or from its coordinate
+        micIds = _getSetColumn(imgSet, '_micId')
+        if micIds is None:
+            micIds = coordMicIds
+        if micIds is not None:
+            micIds = micIds.astype(long)
+            addColumn(md.RLN_MICROGRAPH_ID, micIds)
+            if md.label2Str(md.RLN_MICROGRAPH_NAME) not in columns:
+                addColumn(md.RLN_MICROGRAPH_NAME, 
+                          numpy.array(['fake_micrograph_%06d.mrc' % m 
+                                       for m in micIds], dtype=object))
+        addColumn(md.RLN_PARTICLE_ID, _getSetColumn(imgSet, '_rlnParticleId'))
+
+        addColumn(md.RLN_IMAGE_ID, ids)
+        filesDict = kwargs.get('filesDict', {})
+        addColumn(md.RLN_IMAGE_NAME,
+                  numpy.array([locationToRelion(i, filesDict.get(fn, fn))
+                               for i, fn in izip(indexes, filenames)], dtype=object))
+
+        if kwargs.get('writeCtf', True) and imgSet.hasCTF():
+            for attr, label in CTF_DICT.iteritems():
+                addColumn(label, _getSetColumn(imgSet, '_ctfModel.' + attr))
+            for label in CTF_EXTRA_LABELS:
+                addColumn(label, _getSetColumn(imgSet, '_ctfModel._' + md.label2Str(label)),
+                          castType=False)
+
+        if alignType != em.ALIGN_NONE:
+            for label, values in alignmentToColumns(imgSet, alignType).iteritems():
+                addColumn(label, values)
+
+        if kwargs.get('writeAcquisition', True):
+            # As in Image.hasAcquisition, the magnification is needed. The
+            # particles without it take the acquisition of the set when 
+            # iterating (see SetOfImages.iterItems), so it is written 
+            # as constant columns
+            if _getSetColumn(imgSet, '_acquisition._magnification') is not None:
+                acqColumns = [(label, _getSetColumn(imgSet, '_acquisition.' + attr))
+                              for attr, label in ACQUISITION_DICT.iteritems()]
+            elif imgSet.hasAcquisition():
+                acquisition = imgSet.getAcquisition()
+                acqColumns = [(label, _getConstantColumn(getattr(acquisition, attr).get(),
+                                                         len(ids)))
+                              for attr, label in ACQUISITION_DICT.iteritems()]
+            else:
+                acqColumns = []
+            if all(values is not None for label, values in acqColumns):
+                for label, values in acqColumns:
+                    addColumn(label, values)
+
+        for label in IMAGE_EXTRA_LABELS:
+            addColumn(label, _getSetColumn(imgSet, '_' + md.label2Str(label)),
+                      castType=False)
+
+    except ValueError: # some items have missing values
+        return None
+
+    return columns
+
+
 def writeSetOfParticles(imgSet, starFile,
                         outputDir, **kwargs):
     """ This function will write a SetOfImages as Relion meta
@@ -518,10 +725,17 @@ def writeSetOfParticles(imgSet, starFile,
     """
     filesDict = convertBinaryFiles(imgSet, outputDir)
     kwargs['filesDict'] = filesDict
-    partMd = md.MetaData()
-    setOfImagesToMd(imgSet, partMd, particleToRow, **kwargs)
     blockName = kwargs.get('blockName', 'Particles')
-    partMd.write('%s@%s' % (blockName, starFile))
+    # Write all particles at once when it is possible,
+    # without converting each one to a row
+    columns = particlesToColumns(imgSet, **kwargs)
+    
+    if columns is not None:
+        writeStar('%s@%s' % (blockName, starFile), columns, columns.keys())
+    else:
+        partMd = md.MetaData()
+        setOfImagesToMd(imgSet, partMd, particleToRow, **kwargs)
+        partMd.write('%s@%s' % (blockName, starFile))
     
     
 def writeReferences(inputSet, outputRoot):
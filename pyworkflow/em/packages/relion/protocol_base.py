@@ -563,10 +563,8 @@ class ProtRelionBase(EMProtocol):
                 auxMovieParticles = self._createSetOfMovieParticles(suffix='tmp')
                 auxMovieParticles.copyInfo(movieParticleSet)
                 # Discard the movie particles that are not present in the refinement set
-                for movieParticle in movieParticleSet:
-                    particle = imgSet[movieParticle.getParticleId()]
-                    if particle is not None:
-                        auxMovieParticles.append(movieParticle)
+                for movieParticle, _ in movieParticleSet.join(imgSet, on='_particleId'):
+                    auxMovieParticles.append(movieParticle)
                             
                 writeSetOfParticles(auxMovieParticles,
                                     self._getFileName('movie_particles'), None, originalSet=imgSet,
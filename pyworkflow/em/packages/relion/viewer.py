@@ -75,11 +75,11 @@ class RelionPlotter(EmPlotter):
         '''Create an special type of subplot, representing the angular
         distribution of weight projections. A metadata should be provided containing
         labels: RLN_ORIENT_ROT, RLN_ORIENT_TILT, MDL_WEIGHT '''
-        from math import radians
+        from numpy import radians
         
-        rot = [radians(angularMd.getValue(md.RLN_ORIENT_ROT, objId)) for objId in angularMd]
-        tilt = [angularMd.getValue(md.RLN_ORIENT_TILT, objId) for objId in angularMd]
-        weight = [angularMd.getValue(md.MDL_WEIGHT, objId) for objId in angularMd]
+        rot = radians(angularMd.getColumnValues(md.RLN_ORIENT_ROT))
+        tilt = angularMd.getColumnValues(md.RLN_ORIENT_TILT)
+        weight = angularMd.getColumnValues(md.MDL_WEIGHT)
         
         self.plotAngularDistribution(title, rot, tilt, weight)
 
@@ -733,10 +733,11 @@ def readSetOfImages(filename, imgSet, rowToFunc, **kwargs):
         else:
             kwargs['alignType'] = ALIGN_NONE
     
-    for objId in imgMd:
-        imgRow = rowFromMd(imgMd, objId)
-        img = rowToFunc(imgRow, **kwargs)
-        imgSet.append(img)
+    with imgSet.bulkAppend():
+        for objId in imgMd:
+            imgRow = rowFromMd(imgMd, objId)
+            img = rowToFunc(imgRow, **kwargs)
+            imgSet.append(img)
         
     imgSet.setHasCTF(img.hasCTF())
     imgSet.setAlignment(kwargs['alignType'])
@@ -39,12 +39,12 @@ class XmippPlotter(EmPlotter):
         '''Create an special type of subplot, representing the angular
         distribution of weight projections. A metadata should be provided containing
         labels: MDL_ANGLE_ROT, MDL_ANGLE_TILT, MDL_WEIGHT '''
-        from math import radians
+        from numpy import radians
         from xmipp import MDL_ANGLE_ROT, MDL_ANGLE_TILT, MDL_WEIGHT
         
-        rot = [radians(md.getValue(MDL_ANGLE_ROT, objId)) for objId in md]
-        tilt = [md.getValue(MDL_ANGLE_TILT, objId) for objId in md]
-        weight = [md.getValue(MDL_WEIGHT, objId) for objId in md]
+        rot = radians(md.getColumnValues(MDL_ANGLE_ROT))
+        tilt = md.getColumnValues(MDL_ANGLE_TILT)
+        weight = md.getColumnValues(MDL_WEIGHT)
         
         self.plotAngularDistribution(title, rot, tilt, weight)
     
@@ -29,7 +29,6 @@ Consensus picking protocol
 import os
 import collections
 from itertools import izip
-from math import sqrt
 
 from pyworkflow.utils.path import cleanPath, removeBaseExt, copyFile
 from pyworkflow.object import Set, Integer, Float, String, Object
@@ -37,6 +36,7 @@ import pyworkflow.protocol.params as params
 from pyworkflow.em.protocol.protocol_particles import ProtParticlePicking
 from pyworkflow.protocol.constants import *
 from pyworkflow.em.data import SetOfCoordinates, Coordinate
+from pyworkflow.em.spatial import mergeClosePoints
 
 import pyworkflow.em as em
 import convert 
@@ -92,33 +92,14 @@ class XmippProtConsensusPicking(ProtParticlePicking):
         coords = []
         Ncoords = 0
         for coordinates in self.inputCoordinates:
-            coordArray = np.asarray([x.getPosition() 
-                                     for x in coordinates.get().iterCoordinates(micId)])
-            coords.append(coordArray)
-            Ncoords += coordArray.shape[0]
+            x, y = coordinates.get().getColumnArrays(['_x', '_y'], 
+                                                     where='_micId=%d' % micId)
+            coords.append(np.column_stack((x, y)))
+            Ncoords += len(x)
         
-        allCoords = np.zeros([Ncoords,2])
-        votes = np.zeros(Ncoords)
-        
-        # Add all coordinates in the first method
-        N0 = coords[0].shape[0]
-        allCoords[0:N0,:] = coords[0]
-        votes[0:N0] = 1
-        
-        # Add the rest of coordinates
-        Ncurrent = N0
-        for n in range(1, len(self.inputCoordinates)):
-            for coord in coords[n]:
-                dist = np.sum((coord - allCoords[0:Ncurrent])**2, axis=1)
-                imin = np.argmin(dist)
-                if sqrt(dist[imin]) < self.consensusRadius:
-                    newCoord = (votes[imin]*allCoords[imin,]+coord)/(votes[imin]+1)
-                    allCoords[imin,] = newCoord
-                    votes[imin] += 1
-                else:
-                    allCoords[Ncurrent,:] = coord
-                    votes[Ncurrent] = 1
-                    Ncurrent += 1
+        # Merge the coordinates of each method with the close ones
+        # of the previous methods, using a spatial index
+        allCoords, votes = mergeClosePoints(coords, self.consensusRadius.get())
         
         # Select those in the consensus
         if self.consensus <= 0:
@@ -126,7 +107,7 @@ class XmippProtConsensusPicking(ProtParticlePicking):
         else:
             consensus = self.consensus.get()
         consensusCoords = allCoords[votes>=consensus,:]
-        jaccardIdx = float(len(consensusCoords))/(float(len(allCoords))/len(self.inputCoordinates))
+        jaccardIdx = float(len(consensusCoords))/(float(Ncoords)/len(self.inputCoordinates))
         # COSS: Possible problem with concurrent writes
         with open(self._getExtraPath('jaccard.txt'), "a") as fhJaccard:
             fhJaccard.write("%d %f\n"%(micId,jaccardIdx))
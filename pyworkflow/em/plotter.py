@@ -26,10 +26,11 @@
 """
 This module implement the classes to create plots on xmipp.
 """
-from itertools import izip
+import numpy as np
 import matplotlib.pyplot as plt 
 
 import pyworkflow.em.metadata as md
+from pyworkflow.em.angdist import ANGULAR_BIN_STEP, loadAngularBins
 from pyworkflow.gui.plotter import Plotter
 import pyworkflow.em.metadata as md
 
@@ -43,18 +44,20 @@ class EmPlotter(Plotter):
                                 tilt, weight=[], max_p=40, 
                                 min_p=5, max_w=2, min_w=1, color='blue'):
         '''Create an special type of subplot, representing the angular
-        distribution of weight projections. '''
-        if weight:
-            max_w = max(weight)
-            min_w = min(weight)
+        distribution of weight projections. All the points are drawn
+        with a single scatter call. '''
+        if len(weight):
+            weight = np.asarray(weight, dtype=float)
+            max_w = weight.max()
+            min_w = weight.min()
             a = self.createSubPlot(title, 'Min weight=%(min_w).2f, Max weight=%(max_w).2f' % locals(), '', projection='polar')
-            for r, t, w in izip(rot, tilt, weight):
-                pointsize = int((w - min_w)/(max_w - min_w + 0.001) * (max_p - min_p) + min_p)
-                a.plot(r, t, markerfacecolor=color, marker='.', markersize=pointsize)
+            pointsize = ((weight - min_w)/(max_w - min_w + 0.001) * (max_p - min_p) + min_p).astype(int)
         else:
             a = self.createSubPlot(title, 'Empty plot', '', projection='polar')
-            for r, t in izip(rot, tilt):
-                a.plot(r, t, markerfacecolor=color, marker='.', markersize=10)
+            pointsize = 10
+        # scatter sizes are areas, while plot markersize is a diameter
+        a.scatter(rot, tilt, s=np.square(pointsize), c=color, marker='.', 
+                  edgecolors='none')
                 
     def plotAngularDistributionFromMd(self, mdFile, title, **kwargs):
         """ Read the values of rot, tilt and weights from
@@ -63,18 +66,14 @@ class EmPlotter(Plotter):
             rot: MDL_ANGLE_ROT
             tilt: MDL_ANGLE_TILT
             weight: MDL_WEIGHT
+        The directions are binned in a sphere grid (see 
+        pyworkflow.em.angdist) and the bins are cached next to mdFile.
         """
-        angMd = md.MetaData(mdFile)
-        rot = []
-        tilt = []
-        weight = []
-        
-        for row in md.iterRows(angMd):
-            rot.append(row.getValue(md.MDL_ANGLE_ROT))
-            tilt.append(row.getValue(md.MDL_ANGLE_TILT))
-            weight.append(row.getValue(md.MDL_WEIGHT))
+        step = kwargs.pop('step', ANGULAR_BIN_STEP)
+        rot, tilt, weight = loadAngularBins(mdFile, step)
             
-        return self.plotAngularDistribution(title, rot, tilt, weight, **kwargs)
+        return self.plotAngularDistribution(title, np.radians(rot), tilt, 
+                                            weight, **kwargs)
         
     def plotHist(self, yValues, nbins, color='blue', **kwargs):
         """ Create an histogram. """
@@ -166,14 +165,20 @@ class PlotData():
         else:
             setClassName = db.getProperty('self') # get the set class name
 
-        from pyworkflow.em import getObjects
-        setObj = getObjects()[setClassName](filename=dbName, prefix=dbPreffix)
+        from pyworkflow.em import findClass
+        setObj = findClass(setClassName)(filename=dbName, prefix=dbPreffix)
         return setObj
     
     def _getValuesFromSet(self, columnName):
-        return [self._getValue(obj, columnName) 
-                  for obj in self._table.iterItems(orderBy=self._orderColumn, 
-                                                   direction=self._orderDirection)]
+        try:
+            # Read the column values directly from the db into an array
+            return self._table.getColumnArrays([columnName], 
+                                               orderBy=self._orderColumn,
+                                               direction=self._orderDirection)[0]
+        except KeyError: # not a stored attribute, use the items objects
+            return [self._getValue(obj, columnName) 
+                    for obj in self._table.iterItems(orderBy=self._orderColumn, 
+                                                     direction=self._orderDirection)]
         
     def _loadMd(self, fileName, tableName):
         label = md.str2Label(self._orderColumn)
@@ -0,0 +1,229 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+This module contains the registry of the classes defined in the em
+packages, to import a package only when one of its classes is needed.
+"""
+
+import os
+import json
+from inspect import isclass
+
+from pyworkflow.utils.reflection import (getModules, getModulesMtimes,
+                                         importModule, getSubclasses,
+                                         getSubclassesFromModules)
+
+
+REGISTRY_VERSION = 2
+
+
+def _getTargetName(target):
+    """ Targets of viewers are classes and targets of
+    wizards are tuples (class, params).
+    """
+    if isinstance(target, tuple):
+        target = target[0]
+    return getattr(target, '__name__', str(target))
+
+
+class PackagesRegistry():
+    """ Map the name of the classes found in the packages under
+    packagesPath to the package where they are defined, and to the 
+    names of their base classes (to find subclasses). For classes
+    with _targets and _environments (viewers and wizards) they are
+    also stored, so we can find them without importing all packages.
+    The registry is stored in registryFn and built again (importing
+    all packages) when the modification time of any package changes.
+    Params:
+        baseClasses: dict with the kind of classes (e.g 'protocols')
+            as keys and the base class as value.
+    """
+    def __init__(self, packagesPath, registryFn, baseClasses):
+        self.packagesPath = packagesPath
+        self.registryFn = registryFn
+        self.baseClasses = baseClasses
+        self._data = None
+        self._packages = {}
+
+    def __read(self):
+        try:
+            with open(self.registryFn) as f:
+                return json.load(f)
+        except Exception: # not existing or corrupted, build it
+            return None
+
+    def __write(self, data):
+        """ Write to a temporary file and rename it, so other
+        processes never read an incomplete registry.
+        """
+        tmpFn = '%s.tmp%d' % (self.registryFn, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(self.registryFn)):
+                os.makedirs(os.path.dirname(self.registryFn))
+            with open(tmpFn, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmpFn, self.registryFn)
+        except Exception, ex: # we can live without storing it
+            print ">>> Error writing classes registry: ", ex
+
+    def __setPackage(self, name, module):
+        """ Store the imported package and set the _package
+        attribute of its classes.
+        """
+        self._packages[name] = module
+        for BaseClass in self.baseClasses.values():
+            getSubclassesFromModules(BaseClass, {name: module})
+
+    def __build(self, mtimes):
+        """ Import all packages and find their classes. """
+        packages = getModules(self.packagesPath)
+        classes = {}
+
+        for name, module in packages.iteritems():
+            self.__setPackage(name, module)
+
+        for kind, BaseClass in self.baseClasses.iteritems():
+            classes[kind] = kindDict = {}
+            for pkgName, module in packages.iteritems():
+                for clsName, cls in getSubclasses(BaseClass, module.__dict__).iteritems():
+                    modName = cls.__module__.replace('pyworkflow.em.packages.', '')
+                    # Prefer the package where the class is defined
+                    if clsName not in kindDict or modName.split('.')[0] == pkgName:
+                        info = {'package': pkgName,
+                                'bases': [c.__name__ for c in cls.__mro__]}
+                        if hasattr(cls, '_environments'):
+                            info['environments'] = list(cls._environments)
+                            info['targets'] = [_getTargetName(t) for t in cls._targets]
+                        kindDict[clsName] = info
+
+        return {'version': REGISTRY_VERSION,
+                'path': self.packagesPath,
+                'mtimes': mtimes,
+                'classes': classes}
+
+    def getData(self):
+        """ Load the registry, building it if it is not valid. """
+        if self._data is None:
+            mtimes = getModulesMtimes(self.packagesPath)
+            data = self.__read()
+
+            if (data is None or data.get('version') != REGISTRY_VERSION or
+                data.get('path') != self.packagesPath or
+                data.get('mtimes') != mtimes):
+                data = self.__build(mtimes)
+                self.__write(data)
+            self._data = data
+
+        return self._data
+
+    def getPackage(self, name):
+        """ Import (if not done before) and return the package. """
+        if name not in self._packages:
+            module = importModule(self.packagesPath, name)
+            if module is None:
+                return None
+            self.__setPackage(name, module)
+        return self._packages[name]
+
+    def hasClass(self, kind, className):
+        return className in self.getData()['classes'][kind]
+
+    def getClass(self, kind, className):
+        """ Return the class of this kind with className, importing
+        only its package, or None if it is not in any package.
+        """
+        info = self.getData()['classes'][kind].get(className)
+
+        if info is not None:
+            module = self.getPackage(info['package'])
+            if module is not None:
+                return getattr(module, className, None)
+
+        return None
+
+    def getSubclassNames(self, kind, baseName):
+        """ Return the names of the classes of this kind that are
+        subclasses of the class baseName, without importing them.
+        """
+        return [className for className, info 
+                in self.getData()['classes'][kind].iteritems()
+                if baseName in info.get('bases', [])]
+
+    def findClasses(self, kind, environment, targetNames):
+        """ Return the classes of this kind (viewers or wizards) available
+        in the environment and with any of targetNames as target.
+        """
+        classes = []
+        targetNames = set(targetNames)
+
+        for className, info in self.getData()['classes'][kind].iteritems():
+            if (environment in info.get('environments', []) and
+                targetNames.intersection(info.get('targets', []))):
+                cls = self.getClass(kind, className)
+                if cls is not None:
+                    classes.append(cls)
+
+        return classes
+
+
+class LazyClassesDict(dict):
+    """ Dictionary of classes that looks in the registry for the
+    classes that are not in it, so the packages are only imported
+    when their classes are needed (e.g by the mappers).
+    """
+    def __init__(self, registry, kinds, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._registry = registry
+        self._kinds = kinds
+
+    def __missing__(self, className):
+        for kind in self._kinds:
+            cls = self._registry.getClass(kind, className)
+            if cls is not None:
+                self[className] = cls
+                return cls
+        raise KeyError(className)
+
+    def __contains__(self, className):
+        return (dict.__contains__(self, className) or
+                any(self._registry.hasClass(k, className) for k in self._kinds))
+
+    def get(self, className, default=None):
+        try:
+            return self[className]
+        except KeyError:
+            return default
+
+    def getSubclassNames(self, base):
+        """ Return the names of the subclasses of base (including itself)
+        in the dictionary or in the registry. The classes of the 
+        registry are not imported.
+        """
+        names = set(k for k, v in self.iteritems()
+                    if isclass(v) and issubclass(v, base))
+        for kind in self._kinds:
+            names.update(self._registry.getSubclassNames(kind, base.__name__))
+        return list(names)
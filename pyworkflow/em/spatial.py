@@ -0,0 +1,188 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+This module contains a spatial index of 2D points (e.g the coordinates
+of a micrograph) to find the points close to others without comparing
+all against all.
+"""
+
+import numpy as np
+
+
+class SpatialIndex():
+    """ Index the points in a grid of square cells of cellSize, stored
+    as the points indexes sorted by cell. The queries only compare the
+    points in the cells around each query point, and all the query
+    points are processed at once with numpy.
+    Params:
+        points: (n, 2) array with the x, y of the points.
+        cellSize: size of the cells, queries are faster when it is
+            similar to the radius of the queries.
+        ids: the ids of the points (e.g the coordinates ids), if
+            None, the indexes of the points are used.
+    """
+    def __init__(self, points, cellSize, ids=None):
+        if cellSize <= 0:
+            raise Exception("SpatialIndex: cellSize should be positive, "
+                            "received %s" % cellSize)
+
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.cellSize = float(cellSize)
+        self.ids = (np.arange(len(self.points)) if ids is None
+                    else np.asarray(ids))
+
+        cells = self.__getCells(self.points)
+        if len(cells):
+            self._origin = cells.min(axis=0)
+            self._shape = cells.max(axis=0) - self._origin + 1
+        else:
+            self._origin = np.zeros(2, dtype=np.int64)
+            self._shape = np.zeros(2, dtype=np.int64)
+        keys = self.__getKeys(cells)[1]
+        self._order = np.argsort(keys, kind='mergesort')
+        self._sortedKeys = keys[self._order]
+
+    def __getCells(self, points):
+        return np.floor(points / self.cellSize).astype(np.int64)
+
+    def __getKeys(self, cells):
+        """ Return the mask of the cells inside the grid
+        and the keys of these cells.
+        """
+        cells = cells - self._origin
+        valid = np.all((cells >= 0) & (cells < self._shape), axis=1)
+        cells = cells[valid]
+        return valid, cells[:, 0] * self._shape[1] + cells[:, 1]
+
+    def __len__(self):
+        return len(self.points)
+
+    def queryPairs(self, points, radius):
+        """ Find all pairs of query points and index points that are
+        closer than radius.
+        Returns:
+            (queryIdx, pointIdx, dist) arrays, with the index of the
+            query point, the index of the point in this index and
+            the distance between them.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        cells = self.__getCells(points)
+        k = int(np.ceil(radius / self.cellSize))
+        queryIdx, pointIdx = [], []
+
+        for dx in range(-k, k + 1):
+            for dy in range(-k, k + 1):
+                valid, keys = self.__getKeys(cells + [dx, dy])
+                start = np.searchsorted(self._sortedKeys, keys, 'left')
+                counts = np.searchsorted(self._sortedKeys, keys, 'right') - start
+                total = counts.sum()
+                if total:
+                    # Expand the [start, start + count) ranges of each query
+                    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                    queryIdx.append(np.repeat(np.nonzero(valid)[0], counts))
+                    pointIdx.append(self._order[np.repeat(start, counts) + offsets])
+
+        if not queryIdx:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+
+        queryIdx = np.concatenate(queryIdx)
+        pointIdx = np.concatenate(pointIdx)
+        dist = np.sqrt(np.sum((points[queryIdx] - self.points[pointIdx])**2, axis=1))
+        close = dist < radius
+
+        return queryIdx[close], pointIdx[close], dist[close]
+
+    def queryRadius(self, point, radius):
+        """ Return the ids of the points closer than radius
+        to a single point, sorted by distance.
+        """
+        _, pointIdx, dist = self.queryPairs([point], radius)
+        return self.ids[pointIdx[np.lexsort((pointIdx, dist))]]
+
+    def nearestIndexes(self, points, maxDist):
+        """ Return the index of the nearest point (closer than maxDist)
+        to each query point, or -1 if there is none, and the distances.
+        Ties are resolved with the lowest index.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        nearest = np.empty(len(points), dtype=np.int64)
+        nearest.fill(-1)
+        nearestDist = np.empty(len(points))
+        nearestDist.fill(np.inf)
+
+        queryIdx, pointIdx, dist = self.queryPairs(points, maxDist)
+        if len(queryIdx):
+            order = np.lexsort((pointIdx, dist, queryIdx))
+            queryIdx, first = np.unique(queryIdx[order], return_index=True)
+            nearest[queryIdx] = pointIdx[order][first]
+            nearestDist[queryIdx] = dist[order][first]
+
+        return nearest, nearestDist
+
+    def nearest(self, point, maxDist):
+        """ Return the id of the nearest point closer than maxDist
+        to point, or None if there is none.
+        """
+        nearest, _ = self.nearestIndexes([point], maxDist)
+        return None if nearest[0] < 0 else self.ids[nearest[0]]
+
+
+def mergeClosePoints(pointsList, radius):
+    """ Merge the points of several lists (e.g the coordinates picked
+    by different methods in a micrograph). The points of each list are
+    merged with the nearest point, closer than radius, of the previous
+    lists (averaged with it, weighted by its votes), or added as new
+    points if there is none.
+    Returns:
+        (points, votes) arrays, with the merged points and the
+        number of points merged in each one.
+    """
+    points = np.asarray(pointsList[0], dtype=float).reshape(-1, 2)
+    votes = np.ones(len(points))
+
+    for newPoints in pointsList[1:]:
+        newPoints = np.asarray(newPoints, dtype=float).reshape(-1, 2)
+        index = SpatialIndex(points, max(radius, 1))
+        nearest = index.nearestIndexes(newPoints, radius)[0]
+        matched = nearest >= 0
+
+        if matched.any():
+            # Weighted average of the matched points
+            n = len(points)
+            counts = np.bincount(nearest[matched], minlength=n)
+            sums = points * votes[:, None]
+            for i in range(2):
+                sums[:, i] += np.bincount(nearest[matched], 
+                                          weights=newPoints[matched, i], minlength=n)
+            votes = votes + counts
+            points = sums / votes[:, None]
+
+        unmatched = newPoints[~matched]
+        points = np.vstack((points, unmatched))
+        votes = np.concatenate((votes, np.ones(len(unmatched))))
+
+    return points, votes
@@ -237,6 +237,19 @@ def translation_from_matrix(matrix):
     return numpy.array(matrix, copy=False)[:3, 3].copy()
 
 
+def translations_from_matrices(matrices):
+    """Return (N, 3) translation vectors from (N, 4, 4) matrices.
+
+    >>> v0 = numpy.random.random((10, 3)) - 0.5
+    >>> v1 = translations_from_matrices([translation_matrix(v) for v in v0])
+    >>> numpy.allclose(v0, v1)
+    True
+
+    """
+    M = numpy.asarray(matrices)
+    return M.reshape((-1,) + M.shape[-2:])[:, :3, 3].copy()
+
+
 def reflection_matrix(point, normal):
     """Return matrix to mirror at plane defined by point and normal vector.
 
@@ -1160,6 +1173,118 @@ def euler_from_matrix(matrix, axes='sxyz'):
     return ax, ay, az
 
 
+def euler_matrices(ai, aj, ak, axes='sxyz'):
+    """Return (N, 4, 4) rotation matrices from arrays of Euler angles.
+
+    Vectorized version of euler_matrix for N triplets of angles.
+
+    ai, aj, ak : arrays with Euler's roll, pitch and yaw angles
+    axes : One of 24 axis sequences as string or encoded tuple
+
+    >>> angles = (4*math.pi) * (numpy.random.random((10, 3)) - 0.5)
+    >>> for axes in _AXES2TUPLE.keys():
+    ...    R0 = euler_matrices(angles[:, 0], angles[:, 1], angles[:, 2], axes)
+    ...    R1 = [euler_matrix(axes=axes, *a) for a in angles]
+    ...    if not numpy.allclose(R0, R1): print(axes, "failed")
+
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes]
+    except (AttributeError, KeyError):
+        _TUPLE2AXES[axes]  # validation
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis
+    j = _NEXT_AXIS[i+parity]
+    k = _NEXT_AXIS[i-parity+1]
+
+    ai = numpy.array(ai, dtype=numpy.float64, ndmin=1)
+    aj = numpy.array(aj, dtype=numpy.float64, ndmin=1)
+    ak = numpy.array(ak, dtype=numpy.float64, ndmin=1)
+
+    if frame:
+        ai, ak = ak, ai
+    if parity:
+        ai, aj, ak = -ai, -aj, -ak
+
+    si, sj, sk = numpy.sin(ai), numpy.sin(aj), numpy.sin(ak)
+    ci, cj, ck = numpy.cos(ai), numpy.cos(aj), numpy.cos(ak)
+    cc, cs = ci*ck, ci*sk
+    sc, ss = si*ck, si*sk
+
+    M = numpy.zeros((len(ai), 4, 4))
+    M[:, 3, 3] = 1.0
+    if repetition:
+        M[:, i, i] = cj
+        M[:, i, j] = sj*si
+        M[:, i, k] = sj*ci
+        M[:, j, i] = sj*sk
+        M[:, j, j] = -cj*ss+cc
+        M[:, j, k] = -cj*cs-sc
+        M[:, k, i] = -sj*ck
+        M[:, k, j] = cj*sc+cs
+        M[:, k, k] = cj*cc-ss
+    else:
+        M[:, i, i] = cj*ck
+        M[:, i, j] = sj*sc-cs
+        M[:, i, k] = sj*cc+ss
+        M[:, j, i] = cj*sk
+        M[:, j, j] = sj*ss+cc
+        M[:, j, k] = sj*cs-sc
+        M[:, k, i] = -sj
+        M[:, k, j] = cj*si
+        M[:, k, k] = cj*ci
+    return M
+
+
+def euler_from_matrices(matrices, axes='sxyz'):
+    """Return (N, 3) Euler angles from (N, 4, 4) or (N, 3, 3) matrices.
+
+    Vectorized version of euler_from_matrix, the same angles are
+    returned for each matrix.
+
+    >>> angles = (4*math.pi) * (numpy.random.random((10, 3)) - 0.5)
+    >>> for axes in _AXES2TUPLE.keys():
+    ...    R = euler_matrices(angles[:, 0], angles[:, 1], angles[:, 2], axes)
+    ...    A0 = euler_from_matrices(R, axes)
+    ...    A1 = [euler_from_matrix(r, axes) for r in R]
+    ...    if not numpy.allclose(A0, A1): print(axes, "failed")
+
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        _TUPLE2AXES[axes]  # validation
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis
+    j = _NEXT_AXIS[i+parity]
+    k = _NEXT_AXIS[i-parity+1]
+
+    M = numpy.asarray(matrices, dtype=numpy.float64)
+    M = M.reshape((-1,) + M.shape[-2:])[:, :3, :3]
+    if repetition:
+        sy = numpy.sqrt(M[:, i, j]*M[:, i, j] + M[:, i, k]*M[:, i, k])
+        ok = sy > _EPS
+        ax = numpy.where(ok, numpy.arctan2( M[:, i, j],  M[:, i, k]),
+                             numpy.arctan2(-M[:, j, k],  M[:, j, j]))
+        ay = numpy.arctan2( sy,       M[:, i, i])
+        az = numpy.where(ok, numpy.arctan2( M[:, j, i], -M[:, k, i]), 0.0)
+    else:
+        cy = numpy.sqrt(M[:, i, i]*M[:, i, i] + M[:, j, i]*M[:, j, i])
+        ok = cy > _EPS
+        ax = numpy.where(ok, numpy.arctan2( M[:, k, j],  M[:, k, k]),
+                             numpy.arctan2(-M[:, j, k],  M[:, j, j]))
+        ay = numpy.arctan2(-M[:, k, i],  cy)
+        az = numpy.where(ok, numpy.arctan2( M[:, j, i],  M[:, i, i]), 0.0)
+
+    if parity:
+        ax, ay, az = -ax, -ay, -az
+    if frame:
+        ax, az = az, ax
+    return numpy.column_stack((ax, ay, az))
+
+
 def euler_from_quaternion(quaternion, axes='sxyz'):
     """Return Euler angles from quaternion for specified axis sequence.
 
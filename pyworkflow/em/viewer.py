@@ -35,6 +35,7 @@ import shlex
 import ast
 from threading import Thread
 from multiprocessing.connection import Client
+import numpy as np
 from numpy import flipud
 import socket
 
@@ -48,6 +49,7 @@ import showj
 import metadata as md
 import xmipp
 from data import PdbFile
+from angdist import loadAngularBins, eulerDirections, getBinsFile, writeBild
 
 
 #------------------------ Some common Views ------------------
@@ -375,48 +377,26 @@ class ChimeraAngDistClient(ChimeraClient):
             self.client.send('end')
 
     def readAngularDistFile(self):
-        angleRotLabel = md.MDL_ANGLE_ROT
-        angleTiltLabel = md.MDL_ANGLE_TILT
-        anglePsiLabel = md.MDL_ANGLE_PSI
-        mdAngDist = md.MetaData(self.angularDistFile)
-        if not mdAngDist.containsLabel(md.MDL_ANGLE_PSI):
-            anglePsiLabel = None
-            if mdAngDist.containsLabel(md.RLN_ORIENT_PSI):
-                angleRotLabel = md.RLN_ORIENT_ROT
-                angleTiltLabel = md.RLN_ORIENT_TILT
-                anglePsiLabel = md.RLN_ORIENT_PSI
-
-        if not mdAngDist.containsLabel(md.MDL_WEIGHT):
-            mdAngDist.fillConstant(md.MDL_WEIGHT, 1.)
-
-        maxweight = mdAngDist.aggregateSingle(md.AGGR_MAX, md.MDL_WEIGHT)
-        minweight = mdAngDist.aggregateSingle(md.AGGR_MIN, md.MDL_WEIGHT)
+        """ Bin the projection directions in a sphere grid and write
+        a sphere for each bin in a BILD file, next to the angular
+        distribution file, that is opened with a single command.
+        """
+        rot, tilt, weight = loadAngularBins(self.angularDistFile)
+
+        maxweight = weight.max()
+        minweight = weight.min()
         interval = maxweight - minweight
         if interval < 1:
             interval = 1
         minweight = minweight - 1#to avoid 0 on normalized weight
 
-        self.angulardist = []
-        x2=self.xdim/2
-        y2=self.ydim/2
-        z2=self.zdim/2
-        #cofr does not seem to work!
-        #self.angulardist.append('cofr %d,%d,%d'%(x2,y2,z2))
-        for id in mdAngDist:
-            rot = mdAngDist.getValue(angleRotLabel, id)
-            tilt = mdAngDist.getValue(angleTiltLabel, id)
-            psi = mdAngDist.getValue(anglePsiLabel, id) if anglePsiLabel else 0
-            weight = mdAngDist.getValue(md.MDL_WEIGHT, id)
-            weight = (weight - minweight)/interval
-            x, y, z = xmipp.Euler_direction(rot, tilt, psi)
-            radius = weight * self.spheresMaxRadius
-
-            x = x * self.spheresDistance + x2
-            y = y * self.spheresDistance + y2
-            z = z * self.spheresDistance + z2
-            command = 'shape sphere radius %s center %s,%s,%s color %s '%(radius, x, y, z, self.spheresColor)
-            self.angulardist.append(command)
-            #printCmd(command)
+        radius = (weight - minweight) / interval * self.spheresMaxRadius
+        center = np.array([self.xdim/2, self.ydim/2, self.zdim/2])
+        centers = eulerDirections(rot, tilt) * self.spheresDistance + center
+
+        bildFn = os.path.splitext(getBinsFile(self.angularDistFile))[0] + '.bild'
+        writeBild(bildFn, centers, radius, self.spheresColor)
+        self.angulardist = ['open %s' % os.path.abspath(bildFn)]
 
 
 class ChimeraVirusClient(ChimeraClient):
@@ -26,6 +26,7 @@
 
 
 from pyworkflow.utils.path import replaceExt, joinExt
+from pyworkflow.object import Integer, Float
 from mapper import Mapper
 from sqlite_db import SqliteDb
 
@@ -79,6 +80,7 @@ class SqliteMapper(Mapper):
     def insert(self, obj):
         """Insert a new object into the system, the id will be set"""
         self.__insert(obj)
+        self.__touch(obj)
         
     def insertChild(self, obj, key, attr, namePrefix=None):
         if not hasattr(attr, '_objDoStore'):
@@ -114,6 +116,30 @@ class SqliteMapper(Mapper):
         """Delete an object and all its childs"""
         self.deleteChilds(obj)
         self.db.deleteObject(obj.getObjId())
+        self.__touch(obj)
+        
+    def __touch(self, obj):
+        """ Register in the changes journal that the root object
+        (the one without parent) of obj has been modified.
+        Child objects names start with the id of the root object.
+        """
+        rootId = obj._objId
+        if obj._objParentId is not None and '.' in obj._objName:
+            rootId = int(obj._objName.split('.')[0])
+        self.db.touchObject(rootId)
+        
+    def getLastChange(self):
+        """ Return the sequence number of the last change
+        registered in the changes journal. """
+        return self.db.selectLastChange()
+    
+    def getChangesSince(self, lastChange):
+        """ Return a list of (objId, change) tuples with the root 
+        objects that have been inserted, modified or deleted after 
+        lastChange (as returned by getLastChange).
+        """
+        return [(row['object_id'], row['seq']) 
+                for row in self.db.selectChangesSince(lastChange)]
     
     def __getNamePrefix(self, obj):
         if len(obj._objName) > 0 and '.' in obj._objName:
@@ -134,6 +160,7 @@ class SqliteMapper(Mapper):
             self.db.updateObject(ptr._objId, ptr._objName, ptr.getClassName(),
                              self.__getObjectValue(obj), ptr._objParentId, 
                              ptr._objLabel, ptr._objComment)
+        self.__touch(obj)
         
     def __updateTo(self, obj, level):
         self.db.updateObject(obj._objId, obj._objName, obj.getClassName(),
@@ -272,13 +299,18 @@ class SqliteMapper(Mapper):
         
         if includeSubclasses:
             from pyworkflow.utils.reflection import getSubclasses
-            whereStr = "classname='%s'" % className
+            classNames = [className]
             base = self.dictClasses.get(className)
-            subDict = getSubclasses(base, self.dictClasses)
-            for k, v in subDict.iteritems():
-                if issubclass(v, base):
-                    whereStr += " OR classname='%s'" % k
-            objRows = self.db.selectObjectsWhere(whereStr)
+            if hasattr(self.dictClasses, 'getSubclassNames'):
+                # Lazy dict (see em.getClassesDict): the subclasses
+                # could be in packages that are not imported yet
+                classNames = self.dictClasses.getSubclassNames(base)
+            else:
+                subDict = getSubclasses(base, self.dictClasses)
+                for k, v in subDict.iteritems():
+                    if issubclass(v, base):
+                        classNames.append(k)
+            objRows = self.db.selectObjectsByClasses(classNames)
             return self.__objectsFromRows(objRows, iterate, objectFilter)
         else:
             return self.selectBy(iterate=iterate, classname=className)
@@ -288,6 +320,53 @@ class SqliteMapper(Mapper):
         objRows = self.db.selectObjectsByParent(parent_id=None)
         return self.__objectsFromRows(objRows, iterate, objectFilter)    
     
+    def selectClosureIds(self, objIds):
+        """ Return the ids of all objects needed to load the given ones:
+        the objects with its childs, the objects pointed by any pointer
+        among them and the ancestors of all of them (also with childs).
+        """
+        closureIds = set()
+        pendingIds = list(objIds)
+        
+        while pendingIds:
+            objId = pendingIds.pop()
+            if objId in closureIds:
+                continue
+            objRow = self.db.selectObjectById(objId)
+            if objRow is None:
+                continue
+            namePrefix = objRow['name']
+            if namePrefix and '.' in namePrefix:
+                namePrefix = replaceExt(namePrefix, str(objId))
+            else:
+                namePrefix = str(objId)
+            rows = [objRow] + self.db.selectObjectsByAncestor(namePrefix)
+            for row in rows:
+                closureIds.add(row['id'])
+                if row['classname'] == 'Pointer' and row['value']:
+                    try:
+                        pendingIds.append(int(row['value']))
+                    except ValueError:
+                        pass # pointer to an object not stored yet
+            if objRow['parent_id'] is not None:
+                pendingIds.append(objRow['parent_id'])
+                
+        return closureIds
+    
+    def copyClosureTo(self, dbName, objIds):
+        """ Create a new db with only the objects needed to load the
+        given ones (see selectClosureIds) and the relations between them.
+        Object ids are kept, so they can be loaded with the same ids.
+        """
+        self.db.copyObjectsTo(dbName, self.selectClosureIds(objIds))
+        
+    def selectByIds(self, objIds, iterate=False, objectFilter=None):
+        """ Select the objects with the given ids. Objects are always 
+        read from the db, even if they were already loaded before. """
+        self.__initObjDict()
+        objRows = self.db.selectObjectsByIds(objIds)
+        return self.__objectsFromRows(objRows, iterate, objectFilter)
+    
     def insertRelation(self, relName, creatorObj, parentObj, childObj):
         """ This function will add a new relation between two objects.
         Params:
@@ -357,6 +436,14 @@ class SqliteObjectsDb(SqliteDb):
     SELECT_RELATION = "SELECT object_%s_id AS id FROM Relations WHERE name=? AND object_%s_id=?"
     SELECT_RELATIONS = "SELECT * FROM Relations WHERE "
     
+    CREATE_INDEX = "CREATE INDEX IF NOT EXISTS %s_%s_index ON %s(%s)"
+    INDEXES = [('Objects', 'name'), ('Objects', 'parent_id'), 
+               ('Objects', 'classname'), ('Relations', 'parent_id')]
+    # Objects in the hierarchy of 'prefix' have names between 
+    # 'prefix.' and 'prefix/' ('/' is the character after '.')
+    # this range can use the index on name, while LIKE can not.
+    ANCESTOR_WHERE = "name >= ? AND name < ?"
+    
     
     def selectCmd(self, whereStr, orderByStr=' ORDER BY id'):
         return self.SELECT + whereStr + orderByStr
@@ -394,6 +481,16 @@ class SqliteObjectsDb(SqliteDb):
                       object_child_id  INTEGER REFERENCES Objects(id) ON DELETE CASCADE,
                       creation  DATE                 -- creation date and time of the object
                       )""")
+        # Create the Changes table, a journal that stores for each
+        # root object the sequence number of its last modification
+        self.executeCommand("""CREATE TABLE IF NOT EXISTS Changes
+                     (object_id INTEGER PRIMARY KEY, -- id of the root object
+                      seq       INTEGER              -- number of the change
+                      )""")
+        # Create indexes for the most common queries, the one on 'name'
+        # is used by the prefix range queries on the objects hierarchy
+        for table, column in self.INDEXES:
+            self.executeCommand(self.CREATE_INDEX % (table, column, table, column))
         self.commit()
         
     def insertObject(self, name, classname, value, parent_id, label, comment):
@@ -440,9 +537,60 @@ class SqliteObjectsDb(SqliteDb):
     
     def selectObjectsByAncestor(self, ancestor_namePrefix, iterate=False):
         """Select all objects in the hierachy of ancestor_id"""
-        self.executeCommand(self.selectCmd("name LIKE '%s.%%'" % ancestor_namePrefix))
+        self.executeCommand(self.selectCmd(self.ANCESTOR_WHERE), 
+                            self.__ancestorRange(ancestor_namePrefix))
         return self._results(iterate)          
     
+    def __ancestorRange(self, ancestor_namePrefix):
+        """ Return the parameters for the ANCESTOR_WHERE query. """
+        return ('%s.' % ancestor_namePrefix, '%s/' % ancestor_namePrefix)
+    
+    def copyObjectsTo(self, dbName, objIds):
+        """ Copy the objects with given ids, and the relations between
+        them, to a new db (that should not exists). The sequence of ids
+        is also copied, so new objects will get the same ids than here.
+        """
+        SqliteObjectsDb(dbName).close() # Create the tables
+        self.executeCommand("CREATE TEMP TABLE IF NOT EXISTS CopyIds "
+                            "(id INTEGER PRIMARY KEY)")
+        self.executeCommand("DELETE FROM CopyIds")
+        self.cursor.executemany("INSERT INTO CopyIds (id) VALUES (?)", 
+                                ((objId,) for objId in objIds))
+        self.commit()
+        self.executeCommand("ATTACH DATABASE ? AS CopyDb", (dbName,))
+        try:
+            self.executeCommand("INSERT INTO CopyDb.Objects SELECT * FROM Objects "
+                                "WHERE id IN (SELECT id FROM CopyIds)")
+            self.executeCommand("INSERT INTO CopyDb.Relations SELECT * FROM Relations "
+                                "WHERE object_parent_id IN (SELECT id FROM CopyIds) "
+                                "AND object_child_id IN (SELECT id FROM CopyIds) "
+                                "AND (parent_id IS NULL OR parent_id IN (SELECT id FROM CopyIds))")
+            self.executeCommand("DELETE FROM CopyDb.sqlite_sequence")
+            self.executeCommand("INSERT INTO CopyDb.sqlite_sequence "
+                                "SELECT * FROM sqlite_sequence")
+            self.executeCommand("DELETE FROM CopyIds")
+            self.commit()
+        except Exception:
+            # The connection could be shared with other dbs of the same
+            # file, their pending changes were committed with the ids above
+            self.connection.rollback()
+            raise
+        finally:
+            self.executeCommand("DETACH DATABASE CopyDb")
+    
+    def selectObjectsByIds(self, objIds, iterate=False):
+        """ Select all objects whose id is in the given list. """
+        objIds = list(objIds)
+        whereStr = "id IN (%s)" % ','.join('?' * len(objIds))
+        self.executeCommand(self.selectCmd(whereStr), tuple(objIds))
+        return self._results(iterate)
+    
+    def selectObjectsByClasses(self, classNames, iterate=False):
+        """ Select all objects whose classname is in the given list. """
+        whereStr = "classname IN (%s)" % ','.join('?' * len(classNames))
+        self.executeCommand(self.selectCmd(whereStr), tuple(classNames))
+        return self._results(iterate)
+    
     def selectObjectsBy(self, iterate=False, **args):     
         """More flexible select where the constrains can be passed
         as a dictionary, the concatenation is done by an AND"""
@@ -463,13 +611,31 @@ class SqliteObjectsDb(SqliteDb):
     def deleteChildObjects(self, ancestor_namePrefix):
         """ Delete from db all objects that are childs 
         of an ancestor, now them will have the same starting prefix"""
-        self.executeCommand(self.DELETE + "name LIKE '%s.%%'" % ancestor_namePrefix)
+        self.executeCommand(self.DELETE + self.ANCESTOR_WHERE, 
+                            self.__ancestorRange(ancestor_namePrefix))
         
     def deleteAll(self):
         """ Delete all objects from the db. """
         self.executeCommand(self.DELETE + "1")
         self.executeCommand(self.DELETE_SEQUENCE) # restart the count of ids
         
+    def touchObject(self, objId):
+        """ Register a new change of the object in the Changes table. """
+        self.executeCommand("INSERT OR REPLACE INTO Changes (object_id, seq) "
+                            "SELECT ?, IFNULL(MAX(seq), 0) + 1 FROM Changes", 
+                            (objId,))
+        
+    def selectLastChange(self):
+        """ Return the number of the last change or 0 if no changes. """
+        self.executeCommand("SELECT IFNULL(MAX(seq), 0) FROM Changes")
+        return self.cursor.fetchone()[0]
+    
+    def selectChangesSince(self, seq):
+        """ Select the changes with a number greater than seq. """
+        self.executeCommand("SELECT object_id, seq FROM Changes WHERE seq>? "
+                            "ORDER BY seq", (seq,))
+        return self._results()
+        
     def selectRelationChilds(self, relName, object_parent_id):
         self.executeCommand(self.SELECT_RELATION % ('child', 'parent'), 
                             (relName, object_parent_id))
@@ -493,12 +659,26 @@ class SqliteObjectsDb(SqliteDb):
 
 
 class SqliteFlatMapper(Mapper):
-    """Specific Flat Mapper implementation using Sqlite database"""
-    def __init__(self, dbName, dictClasses=None, tablePrefix=''):
+    """Specific Flat Mapper implementation using Sqlite database.
+    If viewFilter is passed as a (label, value) pair, the mapper will 
+    only see the rows of the table where the integer attribute label 
+    has this value and it will set it in the inserted objects 
+    (see getView).
+    """
+    def __init__(self, dbName, dictClasses=None, tablePrefix='', viewFilter=None):
         Mapper.__init__(self, dictClasses)
         self._objTemplate = None
+        self._viewFilter = viewFilter
+        # Secondary indexes declared with createIndex, the
+        # pending ones will be built lazily on commit or select
+        self._indexes = set()
+        self._pendingIndexes = set()
+        # Rows buffered while in bulk mode (see beginBulk)
+        self._bulkRows = None
         try:
             self.db = SqliteFlatDb(dbName, tablePrefix)
+            if viewFilter is not None:
+                self.db.setView(*viewFilter)
             self.doCreateTables = self.db.missingTables()
             
             if not self.doCreateTables:
@@ -507,43 +687,176 @@ class SqliteFlatMapper(Mapper):
             raise Exception('Error creating SqliteFlatMapper, dbName: %s, tablePrefix: %s\n error: %s' % (dbName, tablePrefix, ex))
     
     def commit(self):
+        self.flushBulk()
+        self.__buildPendingIndexes()
         self.db.commit()
         
     def close(self):
+        self.flushBulk()
         self.db.close()
         
-    def insert(self, obj):
+    def beginBulk(self, batchSize=10000, fast=False):
+        """ Start the bulk insert mode. In this mode, inserted objects
+        are converted to rows and buffered, and every batchSize rows
+        they are written with a single executemany call. 
+        Params:
+            batchSize: number of rows to buffer before writing them.
+            fast: if True, the sqlite synchronous mode is set to OFF
+                until endBulk is called. This is faster but the db could
+                be corrupted if the machine crash while writing.
+        """
+        self._bulkRows = []
+        self._bulkSize = batchSize
+        self._bulkSync = None
+        if fast:
+            self._bulkSync = self.db.getPragma('synchronous')
+            self.db.setPragma('synchronous', 'OFF')
+            
+    def inBulk(self):
+        """ Return True if the bulk insert mode is active. """
+        return self._bulkRows is not None
+        
+    def flushBulk(self):
+        """ Write the buffered rows (if any) to the database. """
+        if self._bulkRows:
+            self.db.insertObjects(self._bulkRows)
+            self._bulkRows = []
+        
+    def endBulk(self, commit=True):
+        """ Write the remaining rows, commit and leave the bulk mode.
+        Params:
+            commit: if False, the rows are written but not committed, 
+                they will be committed with the next commit.
+        """
+        if self.inBulk():
+            self.flushBulk()
+            self._bulkRows = None
+            if commit:
+                self.db.commit()
+            if self._bulkSync is not None:
+                self.db.setPragma('synchronous', self._bulkSync)
+        
+    def createIndex(self, label):
+        """ Declare a secondary index over the column of a given
+        attribute (e.g. '_micId'). The index is not built right away,
+        but when the changes are committed or before the next select.
+        This avoids updating the index on every insert while the set
+        is being populated.
+        """
+        self._indexes.add(label)
+        self._pendingIndexes.add(label)
+        
+    def __buildPendingIndexes(self):
+        """ Build the indexes declared with createIndex that 
+        have not been created yet. Nothing is done if the tables 
+        are not created, the indexes will be kept as pending.
+        """
+        self.__checkTables()
+        if self._pendingIndexes and not self.doCreateTables:
+            for label in self._pendingIndexes:
+                self.db.createIndex(label)
+            self._pendingIndexes.clear()
+            
+    def getIndexes(self):
+        """ Return the list of attributes labels that 
+        have an index built in the database. 
+        """
         if self.doCreateTables:
-            self.db.createTables(obj.getObjDict(includeClass=True))
+            return []
+        return self.db.getIndexes()
+    
+    def getView(self, label, value):
+        """ Return a new mapper over the same table that only sees the
+        rows where the attribute label is equal to value, for example
+        the items of one class: mapper.getView('_classId', 3).
+        The table could be shared by many views, so an index over
+        the label column should be created.
+        """
+        return SqliteFlatMapper(self.db.getDbName(), self.dictClasses,
+                                self.db.tablePrefix, viewFilter=(label, value))
+    
+    def __checkTables(self):
+        """ The tables could be created by other mapper (e.g. a view
+        of the same table) after this mapper was created.
+        """
+        if self.doCreateTables and not self.db.missingTables():
             self.doCreateTables = False
+            self.__loadObjDict()
+            
+    def __setViewValue(self, obj):
+        """ Set the value of the view attribute in the object, 
+        adding the attribute if the object has not it.
+        """
+        label, value = self._viewFilter
+        attr = getattr(obj, label, None)
+        if attr is None:
+            setattr(obj, label, Integer(value))
+        else:
+            attr.set(value)
+        
+    def insert(self, obj):
         """Insert a new object into the system, the id will be set"""
-        self.db.insertObject(obj.getObjId(), obj.isEnabled(), obj.getObjLabel(), obj.getObjComment(), 
-                             *obj.getObjDict().values())
+        if self._viewFilter is not None:
+            self.__setViewValue(obj)
+        if self.doCreateTables:
+            objDict = obj.getObjDict(includeClass=True)
+            # The tables could be created by other mapper (e.g. other view)
+            if self.db.missingTables():
+                self.db.createTables(objDict)
+            else:
+                self.db.setupCommands(objDict)
+            self.doCreateTables = False
+            values = [v[1] for k, v in objDict.iteritems() if k != SELF]
+        else:
+            if self._viewFilter is not None and self.db.INSERT_OBJECT is None:
+                # Views can append items to an existing table
+                self.db.setupCommands(obj.getObjDict(includeClass=True))
+            values = obj.getObjDict().values()
+        row = [obj.getObjId(), obj.isEnabled(), obj.getObjLabel(), obj.getObjComment()]
+        row.extend(values)
+        
+        if self._bulkRows is None:
+            self.db.insertObject(*row)
+        else:
+            self._bulkRows.append(row)
+            if len(self._bulkRows) >= self._bulkSize:
+                self.flushBulk()
         
     def enableAppend(self):
         """ This will allow to append items to existing db. 
         This is by default not allow, since most sets are not 
         modified after creation.
         """
+        self.flushBulk()
         if not self.doCreateTables:
             obj = self.selectFirst()
             if obj is not None:
                 self.db.setupCommands(obj.getObjDict(includeClass=True))
         
     def clear(self):
+        if self._viewFilter is not None:
+            # Only delete the rows of the view, the table is shared
+            self.deleteAll()
+            return
         self.db.clear()
         self.doCreateTables = True
+        # Indexes are dropped with the tables, so 
+        # they should be built again after new inserts
+        self._pendingIndexes = set(self._indexes)
     
     def deleteAll(self):
         """ Delete all objects stored """
+        self.flushBulk()
         self.db.deleteAll()
                 
     def delete(self, obj):
         """Delete an object and all its childs"""
+        self.flushBulk()
         self.db.deleteObject(obj.getObjId())
     
     def updateTo(self, obj, level=1):
         """ Update database entry with new object values. """ 
+        self.flushBulk()
         if self.db.INSERT_OBJECT is None:
             self.db.setupCommands(obj.getObjDict(includeClass=True))
         args = list(obj.getObjDict().values())
@@ -552,6 +865,8 @@ class SqliteFlatMapper(Mapper):
             
     def selectById(self, objId):
         """Build the object which id is objId"""
+        self.__checkTables()
+        self.flushBulk()
         objRow = self.db.selectObjectById(objId)
         if objRow is None:
             obj = None
@@ -576,6 +891,7 @@ class SqliteFlatMapper(Mapper):
             else:
                 # Lets update the database column mapping
                 self.db._columnsMapping[label] = r['column_name']
+                self.db._columnsClasses[label] = r['class_name']
                 columnList.append(label)
                 attrClasses[label] = r['class_name']
                 attrParts = label.split('.')
@@ -594,6 +910,33 @@ class SqliteFlatMapper(Mapper):
         basicRows = 5
         n = len(rows) + basicRows - 1
         self._objColumns = zip(range(basicRows, n), columnList)
+        self.__compileObjColumns()
+        
+    def __compileObjColumns(self):
+        """ Resolve once the attribute of the template object 
+        where the value of each column should be set. 
+        For Integer and Float attributes, the value coming from 
+        the db has already the proper type (INTEGER and REAL columns),
+        so the internal value can be directly assigned.
+        """
+        obj = self._objTemplate
+        self._objDirectColumns = []
+        self._objSetColumns = []
+        rootsDict = {}
+        
+        for c, attrName in self._objColumns:
+            attrParts = attrName.split('.')
+            attr = obj
+            for a in attrParts:
+                attr = getattr(attr, a)
+            rootsDict[attrParts[0]] = getattr(obj, attrParts[0])
+            if type(attr) is Integer or type(attr) is Float:
+                self._objDirectColumns.append((c, attr))
+            else:
+                self._objSetColumns.append((c, attr))
+        # Keep first level attributes to detect if they are replaced
+        # in the template (e.g. img.setCTF(ctf)) while iterating
+        self._objRoots = rootsDict.items()
          
     def __buildAndFillObj(self):
         obj = self._buildObject(self._objClassName)
@@ -612,45 +955,60 @@ class SqliteFlatMapper(Mapper):
         if self._objTemplate is None:
             self.__loadObjDict()
             
+        # Basic columns are accessed by position (id, enabled, label, 
+        # comment, creation), so rows can also be plain tuples
         obj = self._objTemplate #self.__buildAndFillObj()
-        obj.setObjId(objRow['id'])
-        obj.setObjLabel(self._getStrValue(objRow['label']))
-        obj.setObjComment(self._getStrValue(objRow['comment']))
+        obj.setObjId(objRow[0])
+        obj.setObjLabel(self._getStrValue(objRow[2]))
+        obj.setObjComment(self._getStrValue(objRow[3]))
         
         try:
-            obj.setEnabled(objRow['enabled'])
-            obj.setObjCreation(self._getStrValue(objRow['creation']))
+            obj.setEnabled(objRow[1])
+            obj.setObjCreation(self._getStrValue(objRow[4]))
         except Exception:
             # THIS SHOULD NOT HAPPENS
             print "WARNING: 'creation' column not found in object: %s" % obj.getObjId()
             print "         db: %s" % self.db.getDbName()
             print "         objRow: ", dict(objRow)
         
-        for c, attrName in self._objColumns:
-            obj.setAttributeValue(attrName, objRow[c])
+        for attrName, attr in self._objRoots:
+            if getattr(obj, attrName) is not attr:
+                self.__compileObjColumns()
+                break
+            
+        for c, attr in self._objDirectColumns:
+            attr._objValue = objRow[c]
+            
+        for c, attr in self._objSetColumns:
+            attr.set(objRow[c])
 
         return obj
         
-    def __iterObjectsFromRows(self, objRows, objectFilter=None):
+    def __iterObjectsFromRows(self, objRows, objectFilter=None, reuse=True):
         for objRow in objRows:
             obj = self.__objFromRow(objRow)
             if objectFilter is None or objectFilter(obj): 
-                yield obj
+                yield obj if reuse else obj.clone()
         
-    def __objectsFromRows(self, objRows, iterate=False, objectFilter=None):
+    def __objectsFromRows(self, objRows, iterate=False, objectFilter=None, reuse=True):
         """Create a set of object from a set of rows
         Params:
             objRows: rows result from a db select.
             iterate: if True, iterates over all elements, if False the whole list is returned
             objectFilter: function to filter some of the objects of the results. 
+            reuse: if True (and iterate=True), the same object instance will
+                be filled and yielded for every row, so callers should clone
+                it if they want to keep it. If False, a new object is 
+                yielded for each row.
         """
         if not iterate:
             return [obj.clone() for obj in self.__iterObjectsFromRows(objRows, objectFilter)]
         else:
-            return self.__iterObjectsFromRows(objRows, objectFilter)
+            return self.__iterObjectsFromRows(objRows, objectFilter, reuse)
          
     def selectBy(self, iterate=False, objectFilter=None, **args):
         """Select object meetings some criterias"""
+        self.flushBulk()
         objRows = self.db.selectObjectsBy(**args)
         return self.__objectsFromRows(objRows, iterate, objectFilter)
     
@@ -658,16 +1016,136 @@ class SqliteFlatMapper(Mapper):
                       , objectFilter=None
                       , orderBy='id'
                       , direction='ASC'
-                      , where='1'):
+                      , where='1'
+                      , reuse=True):
+        self.__checkTables()
         if self._objTemplate is None:
             self.__loadObjDict()
+        self.flushBulk()
+        self.__buildPendingIndexes()
         objRows = self.db.selectAll(orderBy=orderBy,
                                     direction=direction,
                                     where=where)
         
-        return self.__objectsFromRows(objRows, iterate, objectFilter) 
+        return self.__objectsFromRows(objRows, iterate, objectFilter, reuse) 
 
+    def selectByIds(self, ids, orderBy='id', direction='ASC', reuse=True):
+        """ Iterate over the objects with the given ids, with a 
+        single query instead of one selectById per id.
+        The ids not present in the table are ignored.
+        """
+        self.__checkTables()
+        if self.doCreateTables:
+            return iter([])
+        if self._objTemplate is None:
+            self.__loadObjDict()
+        self.flushBulk()
+        objRows = self.db.selectByIds(ids, orderBy=orderBy, direction=direction)
+        
+        return self.__objectsFromRows(objRows, True, reuse=reuse)
+    
+    def selectExistingIds(self, ids):
+        """ Return a python set with the ids that are present in the table. """
+        self.__checkTables()
+        if self.doCreateTables:
+            return set()
+        self.flushBulk()
+        return self.db.selectExistingIds(ids)
+    
+    def selectJoin(self, otherMapper, on, otherOn='id', reuse=True):
+        """ Iterate over the pairs (obj, otherObj) of objects of this mapper 
+        and otherMapper where the attribute 'on' of obj is equal to the
+        attribute 'otherOn' of otherObj. The other database is attached
+        to this one, so the pairs are found with a single query.
+        """
+        self.__checkTables()
+        otherMapper.__checkTables()
+        if self.doCreateTables or otherMapper.doCreateTables:
+            return
+        
+        for mapper in [self, otherMapper]:
+            if mapper._objTemplate is None:
+                mapper.__loadObjDict()
+            # The other connection should commit to be visible in this one
+            mapper.commit()
+        # Number of columns of the rows of this table
+        n = len(self._objColumns) + 5
+        
+        for row in self.db.selectJoin(otherMapper.db, on, otherOn):
+            obj = self.__objFromRow(row[:n])
+            otherObj = otherMapper.__objFromRow(row[n:])
+            if reuse:
+                yield obj, otherObj
+            else:
+                yield obj.clone(), otherObj.clone()
+
+    def selectColumns(self, labels, orderBy='id', direction='ASC', where='1'):
+        """ Return a list of tuples with the values of the given 
+        attributes labels, without building any object. 
+        """
+        self.__checkTables()
+        if self.doCreateTables:
+            return []
+        self.flushBulk()
+        self.__buildPendingIndexes()
+        return self.db.selectColumns(labels, orderBy=orderBy, 
+                                     direction=direction, where=where)
+        
+    def getColumnClass(self, label):
+        """ Return the class name of the attribute with this label. """
+        return self.db.getColumnClass(label)
+    
+    def insertColumns(self, obj, ids, columns):
+        """ Insert len(ids) rows taking the values from columns.
+        Params:
+            obj: object used as template, the values of the attributes
+                not present in columns will be taken from it.
+            ids: the ids of the new rows.
+            columns: dict with the attributes labels as keys and the 
+                sequence of values of each attribute. 'enabled' is also
+                accepted as key.
+        """
+        self.flushBulk()
+        if self._viewFilter is not None:
+            self.__setViewValue(obj)
+        objDict = obj.getObjDict(includeClass=True)
+        if self.doCreateTables:
+            if self.db.missingTables():
+                self.db.createTables(objDict)
+            else:
+                self.db.setupCommands(objDict)
+            self.doCreateTables = False
+        elif self._viewFilter is not None and self.db.INSERT_OBJECT is None:
+            self.db.setupCommands(objDict)
+        del objDict[SELF]
+        labels = objDict.keys()
+        basicRow = [None, obj.isEnabled(), obj.getObjLabel(), obj.getObjComment()]
+        basicRow.extend([v[1] for v in objDict.values()])
+        basicRows = 4
+        
+        colList = []
+        for label, values in columns.iteritems():
+            if label == 'enabled':
+                pos = 1
+            elif label in objDict:
+                pos = labels.index(label) + basicRows
+            else:
+                raise Exception("Invalid column label '%s', valid ones are: %s"
+                                % (label, ', '.join(labels)))
+            colList.append((pos, values))
+        
+        def _iterRows():
+            for i, objId in enumerate(ids):
+                row = list(basicRow)
+                row[0] = objId
+                for pos, values in colList:
+                    row[pos] = values[i]
+                yield row
+                
+        self.db.insertObjects(_iterRows())
+        
     def aggregate(self, operations, operationLabel, groupByLabels=None):
+        self.flushBulk()
         rows = self.db.aggregate(operations, operationLabel, groupByLabels)
         results = []
         for row in rows:
@@ -683,8 +1161,10 @@ class SqliteFlatMapper(Mapper):
         #convert row to dictionary
 
     def count(self):
+        self.__checkTables()
         if self.doCreateTables:
             return 0
+        self.flushBulk()
         return self.db.count()   
     
     def __objectsFromIds(self, objIds):
@@ -722,29 +1202,21 @@ class SqliteFlatDb(SqliteDb):
         tablePrefix = tablePrefix.strip()
         if tablePrefix and not tablePrefix.endswith('_'): # Avoid having _ for empty prefix
             tablePrefix += '_'
-        #NOTE (Jose Miguel, 2014/01/02
-        # Reusing connections is a bit dangerous, since it have lead to
-        # unexpected and hard to trace errors due to using an out-of-date
-        # reused connection. That's why we are changing now the default to False
-        # and only setting to True when the tablePrefix is non-empty, which is the
-        # case for classes that are different tables in the same db and it logical
-        # to reuse the connection.
-        if tablePrefix:
-            self._reuseConnections = True
-        else:
-            self._reuseConnections = False#True
-        
         self.CHECK_TABLES = "SELECT name FROM sqlite_master WHERE type='table' AND name='%sObjects';" % tablePrefix
         self.SELECT = "SELECT * FROM %sObjects WHERE " % tablePrefix
         self.FROM   = "FROM %sObjects" % tablePrefix
         self.DELETE = "DELETE FROM %sObjects WHERE " % tablePrefix
         self.INSERT_CLASS = "INSERT INTO %sClasses (label_property, column_name, class_name) VALUES (?, ?, ?)" % tablePrefix
         self.SELECT_CLASS = "SELECT * FROM %sClasses;" % tablePrefix
+        self.CREATE_INDEX = "CREATE INDEX IF NOT EXISTS %sObjects_%%s_index ON %sObjects(%%s);" % (tablePrefix, tablePrefix)
+        self.SELECT_INDEXES = "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='%sObjects';" % tablePrefix
         self.tablePrefix = tablePrefix
         self._createConnection(dbName, timeout)
         self.INSERT_OBJECT = None
         self.UPDATE_OBJECT = None
         self._columnsMapping = {}
+        self._columnsClasses = {}
+        self._view = None
 
         self.INSERT_PROPERTY = "INSERT INTO Properties (key, value) VALUES (?, ?)"
         self.DELETE_PROPERTY = "DELETE FROM Properties WHERE key=?"
@@ -780,8 +1252,31 @@ class SqliteFlatDb(SqliteDb):
     def deleteProperty(self, key):
         self.executeCommand(self.DELETE_PROPERTY, (key,))
 
+    def setView(self, label, value):
+        """ Restrict the rows of the table to those where the integer 
+        attribute label is equal to value (e.g. the items of one class 
+        with '_classId'), all selects, counts and deletes will only 
+        see these rows.
+        """
+        self._view = (label, value)
+        
+    def _getViewCondition(self, alias=''):
+        """ Return the condition of the rows of the view, the 
+        columns could be prefixed by the table alias (e.g 'a.').
+        """
+        if self._view is None:
+            return '1'
+        label, value = self._view
+        return '%s%s=%d' % (alias, self._getRealCol(label), value)
+    
+    def _viewWhere(self, whereStr):
+        """ Add the condition of the view (if any) to whereStr. """
+        if self._view is None:
+            return whereStr
+        return '%s AND (%s)' % (self._getViewCondition(), whereStr)
+
     def selectCmd(self, whereStr, orderByStr=' ORDER BY id'):
-        return self.SELECT + whereStr + orderByStr
+        return self.SELECT + self._viewWhere(whereStr) + orderByStr
 
     def missingTables(self):
         """ Return True is the needed Objects and Classes table are not created yet. """
@@ -792,6 +1287,12 @@ class SqliteFlatDb(SqliteDb):
 
     def clear(self):
         self.executeCommand("DROP TABLE IF EXISTS Properties;")
+        self.dropTables()
+        
+    def dropTables(self):
+        """ Drop the Classes and Objects tables of this prefix,
+        but not the Properties table shared by all prefixes.
+        """
         self.executeCommand("DROP TABLE IF EXISTS %sClasses;" % self.tablePrefix)
         self.executeCommand("DROP TABLE IF EXISTS %sObjects;" % self.tablePrefix)
 
@@ -841,9 +1342,10 @@ class SqliteFlatDb(SqliteDb):
         self.INSERT_OBJECT = "INSERT INTO %sObjects (id, enabled, label, comment, creation" % self.tablePrefix
         self.UPDATE_OBJECT = "UPDATE %sObjects SET enabled=?, label=?, comment=?" % self.tablePrefix
         c = 0
-        for k in objDict:
+        for k, v in objDict.iteritems():
             colName = 'c%02d' % c
             self._columnsMapping[k] = colName
+            self._columnsClasses[k] = v[0]
             c += 1
             if k != SELF:
                 self.INSERT_OBJECT += ',%s' % colName
@@ -852,6 +1354,30 @@ class SqliteFlatDb(SqliteDb):
         self.INSERT_OBJECT += ") VALUES (?,?,?,?, datetime('now')" + ',?' * (c-1) + ')'
         self.UPDATE_OBJECT += ' WHERE id=?'
 
+    def createIndex(self, label):
+        """ Create an index (if not exists) on the column where
+        the attribute with this label is stored. The index will 
+        be registered in the database sqlite_master table and 
+        will be used by sqlite for queries filtering by that column.
+        """
+        if label not in self._columnsMapping:
+            raise Exception("Can not create index, label '%s' not found in "
+                            "table %sObjects" % (label, self.tablePrefix))
+        colName = self._columnsMapping[label]
+        self.executeCommand(self.CREATE_INDEX % (colName, colName))
+        
+    def getIndexes(self):
+        """ Return the attributes labels of the indexed columns. """
+        self.executeCommand(self.SELECT_INDEXES)
+        labelsMapping = dict((v, k) for k, v in self._columnsMapping.iteritems())
+        labels = []
+        for row in self._results(iterate=False):
+            # Index names are in the form: <prefix>Objects_<column>_index
+            colName = str(row['name']).split('_')[-2]
+            if colName in labelsMapping:
+                labels.append(str(labelsMapping[colName]))
+        return labels
+
     def getClassRows(self):
         """ Create a dictionary with names of the attributes
         of the colums. """
@@ -877,6 +1403,12 @@ class SqliteFlatDb(SqliteDb):
         """
         self.executeCommand(self.INSERT_OBJECT, args)
 
+    def insertObjects(self, rows):
+        """ Insert many rows at once with a single executemany call.
+        Each row should contains the same values as in insertObject.
+        """
+        self.cursor.executemany(self.INSERT_OBJECT, rows)
+
     def updateObject(self, *args):
         """Update object data """
         self.executeCommand(self.UPDATE_OBJECT, args)
@@ -886,25 +1418,27 @@ class SqliteFlatDb(SqliteDb):
         self.executeCommand(self.selectCmd("id=?"), (objId,))
         return self.cursor.fetchone()
 
-    def selectAll(self, iterate=True, orderBy='id', direction='ASC', where='1'):
+    def _getRealCol(self, colName):
+        """ Transform the column name taking into account
+         special columns such as: id or RANDOM(), and
+         getting the mapping translation otherwise.
+        """
+        if colName in ['id', 'enabled', 'RANDOM()']:
+            return colName
+        else:
+            return self._columnsMapping[colName]
+        
+    def _whereOrderByStr(self, where, orderBy, direction):
+        """ Return the where and ORDER BY strings of a select
+        with the attribute labels translated to table columns.
+        """
         # Handle the specials orderBy values of 'id' and 'RANDOM()'
         # other columns names should be mapped to table column
         # such as: _micId -> c04
-
-        def _getRealCol(colName):
-            """ Transform the column name taking into account
-             special columns such as: id or RANDOM(), and
-             getting the mapping translation otherwise.
-            """
-            if colName in ['id', 'RANDOM()']:
-                return colName
-            else:
-                return self._columnsMapping[colName]
-
         if isinstance(orderBy, basestring):
-            orderByCol = _getRealCol(orderBy)
+            orderByCol = self._getRealCol(orderBy)
         elif isinstance(orderBy, list):
-            orderByCol = ','.join([_getRealCol(c) for c in orderBy])
+            orderByCol = ','.join([self._getRealCol(c) for c in orderBy])
         else:
             raise Exception('Invalid type for orderBy: %s' % type(orderBy))
 
@@ -912,19 +1446,97 @@ class SqliteFlatDb(SqliteDb):
         # the real table column name ( for example: _micId -> c01 )
         # Right now we are asuming a simple where string in the form
         # colName=VALUE
+        # If the column has been indexed (see createIndex)
+        # sqlite will use the index for the filtering
         if '=' in where:
-            whereCol = where.split('=')[0]
-            whereRealCol = _getRealCol(whereCol)
+            whereCol = where.split('=')[0].strip()
+            whereRealCol = self._getRealCol(whereCol)
             whereStr = where.replace(whereCol, whereRealCol)
         else:
             whereStr = where
+            
+        return whereStr, ' ORDER BY %s %s' % (orderByCol, direction)
 
-        cmd = self.selectCmd(whereStr,
-                             orderByStr=' ORDER BY %s %s' % (orderByCol, direction))
+    def selectAll(self, iterate=True, orderBy='id', direction='ASC', where='1'):
+        whereStr, orderByStr = self._whereOrderByStr(where, orderBy, direction)
+        cmd = self.selectCmd(whereStr, orderByStr=orderByStr)
         #import sys
         #print >> sys.stderr, "command", cmd
         self.executeCommand(cmd)
         return self._results(iterate)
+    
+    def selectColumns(self, labels, orderBy='id', direction='ASC', where='1'):
+        """ Select only the columns of the given attributes labels.
+        The result is a list of tuples with the values, which is
+        much lighter than the sqlite Row objects returned by selectAll.
+        """
+        whereStr, orderByStr = self._whereOrderByStr(where, orderBy, direction)
+        cols = ','.join([self._getRealCol(label) for label in labels])
+        cmd = "SELECT %s %s WHERE %s%s" % (cols, self.FROM, self._viewWhere(whereStr), 
+                                           orderByStr)
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(cmd)
+        return cursor.fetchall()
+    
+    def _createTempIds(self, ids):
+        """ Fill a temporary table with the ids, to be used
+        in queries instead of doing one query per id.
+        """
+        self.executeCommand("CREATE TEMP TABLE IF NOT EXISTS TempIds "
+                            "(id INTEGER PRIMARY KEY)")
+        self.executeCommand("DELETE FROM TempIds")
+        self.cursor.executemany("INSERT OR IGNORE INTO TempIds (id) VALUES (?)",
+                                ((long(objId),) for objId in ids))
+        
+    def selectByIds(self, ids, orderBy='id', direction='ASC'):
+        """ Select the rows with the given ids. """
+        self._createTempIds(ids)
+        _, orderByStr = self._whereOrderByStr('1', orderBy, direction)
+        cmd = self.selectCmd("id IN (SELECT id FROM TempIds)", orderByStr)
+        self.executeCommand(cmd)
+        return self._iterResults()
+    
+    def selectExistingIds(self, ids):
+        """ Return a python set with the ids present in the table. """
+        self._createTempIds(ids)
+        self.executeCommand("SELECT t.id FROM TempIds t JOIN %sObjects o "
+                            "ON t.id = o.id WHERE %s" 
+                            % (self.tablePrefix, self._getViewCondition('o.')))
+        return set(row[0] for row in self.cursor.fetchall())
+    
+    def selectJoin(self, otherDb, on, otherOn='id'):
+        """ Iterate over the rows of this table joined with the rows 
+        of the table of otherDb where the column of attribute 'on' is 
+        equal to the column of attribute 'otherOn' of the other table. 
+        Each result is a tuple with the values of both rows.
+        """
+        joinCmd = ("SELECT a.*, b.* FROM %sObjects a JOIN JoinDb.%sObjects b "
+                   "ON a.%s = b.%s WHERE %s AND %s ORDER BY a.id, b.id" 
+                   % (self.tablePrefix, otherDb.tablePrefix, 
+                      self._getRealCol(on), otherDb._getRealCol(otherOn),
+                      self._getViewCondition('a.'), otherDb._getViewCondition('b.')))
+        # Attach is not allowed inside a transaction
+        self.commit()
+        self.executeCommand("ATTACH DATABASE ? AS JoinDb", (otherDb.getDbName(),))
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        
+        try:
+            cursor.execute(joinCmd)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+            self.executeCommand("DETACH DATABASE JoinDb")
+
+    def getColumnClass(self, label):
+        """ Return the class name of the attribute stored in a column. """
+        if label == 'id':
+            return 'Integer'
+        if label == 'enabled':
+            return 'Boolean'
+        return self._columnsClasses[label]
 
     def aggregate(self, operations, operationLabel, groupByLabels=None):
         #let us count for testing
@@ -948,7 +1560,8 @@ class SqliteFlatDb(SqliteDb):
                 separator = ', '
         else:
             groupByStr = ' '
-        sqlCommand = selectStr +"\n" + self.FROM + "\n" + groupByStr
+        sqlCommand = (selectStr + "\n" + self.FROM + "\n" + 
+                      "WHERE %s\n" % self._getViewCondition() + groupByStr)
         self.executeCommand(sqlCommand)
         return self._results(iterate=False)
 
@@ -978,5 +1591,5 @@ class SqliteFlatDb(SqliteDb):
     def deleteAll(self):
         """ Delete all objects from the db. """
         if not self.missingTables():
-            self.executeCommand(self.DELETE + "1")
+            self.executeCommand(self.DELETE + self._viewWhere("1"))
         
@@ -27,30 +27,223 @@
 This module contains some sqlite basic tools to handle Databases.
 """
 
+import os
+import thread
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
 from sqlite3 import dbapi2 as sqlite
 
 from pyworkflow.utils import envVarOn
 
 
+def getDbSignature(dbName):
+    """ Return a tuple that changes every time a transaction is
+    committed in the db file, or None if the file could not be read.
+    The size of the file usually does not change when rows are updated
+    and the mtime resolution could be one second, so the sqlite file
+    change counter (bytes 24-27 of the header) is also included.
+    In WAL mode, commits are written to the -wal file and the db file
+    only changes on checkpoints, so the size of the -wal file and the
+    salts of its header (bytes 16-23, changed when it is restarted)
+    are also included.
+    """
+    try:
+        st = os.stat(dbName)
+        with open(dbName, 'rb') as f:
+            f.seek(24)
+            changeCounter = f.read(4)
+    except (OSError, IOError):
+        return None
+    
+    try:
+        walName = dbName + '-wal'
+        walSize = os.path.getsize(walName)
+        with open(walName, 'rb') as f:
+            f.seek(16)
+            walSalts = f.read(8)
+    except (OSError, IOError):
+        walSize, walSalts = None, None
+        
+    return (st.st_mtime, st.st_size, changeCounter, walSize, walSalts)
+
+
+class SqliteConnectionPool():
+    """ Keep open sqlite connections to be reused, instead of opening
+    and closing them each time a db is used. Connections are kept
+    per database path, process and thread, so a connection is never
+    shared between threads. The pool has a maximum size; when it is
+    reached, the least recently used connections that are not in use
+    are closed. If the db file has been deleted or replaced, its
+    connection is closed and a new one is opened.
+    
+    NOTE: the SqliteDb objects opened over the same file in the same
+    thread share the connection, and so its transaction. A commit or
+    rollback from any of them also commits or discards the pending
+    changes of the others, and the changes of a closed db are not
+    discarded while the connection is used by others. Callers that
+    write through several mappers of the same file (e.g. the classes
+    and the items of a SetOfClasses) should commit once all of them
+    are done.
+    """
+    def __init__(self, maxSize=32, walMode=False):
+        self._maxSize = maxSize
+        self._walMode = walMode
+        # The lock is reentrant because a SqliteDb could be garbage 
+        # collected (and released) while its thread is changing the pool,
+        # those releases are deferred until the change is done
+        self._lock = threading.RLock()
+        self._busy = False
+        self._deferred = []
+        # Each entry is [connection, fileId, users], where users is a
+        # weak set with the SqliteDb objects using the connection.
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def setMaxSize(self, maxSize):
+        self._maxSize = maxSize
+        
+    def setWalMode(self, value):
+        """ Use WAL journal mode in new connections, then readers
+        will not block writers (the mode is stored in the db file).
+        """
+        self._walMode = value
+        
+    def _getKey(self, dbName):
+        return (os.path.abspath(dbName), os.getpid(), thread.get_ident())
+    
+    def _getFileId(self, dbName):
+        """ Return the device and inode of the file, or None if
+        the file does not exists. """
+        try:
+            st = os.stat(dbName)
+            return (st.st_dev, st.st_ino)
+        except OSError:
+            return None
+        
+    @contextmanager
+    def _locked(self):
+        """ Hold the lock while changing the pool, and then 
+        do the releases deferred in the meantime. """
+        with self._lock:
+            self._busy = True
+            try:
+                yield
+                while self._deferred:
+                    self._release(*self._deferred.pop())
+            finally:
+                self._busy = False
+        
+    def _closeEntry(self, key):
+        """ Close and remove an entry, the lock should be held. """
+        connection = self._entries.pop(key)[0]
+        connection.close()
+        
+    def getConnection(self, dbName, timeout, user):
+        """ Return a connection to dbName for the current thread,
+        reusing an open one if possible. The user object will
+        be registered until releaseConnection is called.
+        """
+        if dbName == ':memory:': # Memory dbs can not be shared
+            return self._newConnection(dbName, timeout)
+        
+        key = self._getKey(dbName)
+        with self._locked():
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[1] != self._getFileId(dbName):
+                self._closeEntry(key) # The file has been removed or replaced
+                entry = None
+            if entry is None:
+                self.misses += 1
+                connection = self._newConnection(dbName, timeout)
+                entry = [connection, self._getFileId(dbName), weakref.WeakSet()]
+                self._entries[key] = entry
+                self._evict()
+            else:
+                self.hits += 1
+                del self._entries[key] # move to the end (most recently used)
+                self._entries[key] = entry
+            entry[2].add(user)
+            
+        return entry[0]
+    
+    def _newConnection(self, dbName, timeout):
+        connection = sqlite.Connection(dbName, timeout, check_same_thread=False)
+        connection.row_factory = sqlite.Row
+        if self._walMode:
+            connection.execute("PRAGMA journal_mode=WAL;")
+        return connection
+    
+    def _evict(self):
+        """ Close least recently used connections that are not in use
+        until the pool size is not greater than the maximum. """
+        for key in self._entries.keys():
+            if len(self._entries) <= self._maxSize:
+                break
+            if not self._entries[key][2]:
+                self._closeEntry(key)
+                self.evictions += 1
+                
+    def releaseConnection(self, connection, user):
+        """ The user object will not use the connection any more,
+        pending changes are discarded but the connection is 
+        kept open to be reused, unless the file was deleted. 
+        """
+        with self._lock:
+            if self._busy: # released from a __del__ while changing the pool
+                self._deferred.append((connection, user))
+                return
+            with self._locked():
+                self._release(connection, user)
+        
+    def _release(self, connection, user):
+        """ Do the release of a connection, the pool should be locked. """
+        for key, entry in self._entries.items():
+            if entry[0] is connection:
+                entry[2].discard(user)
+                if not entry[2]:
+                    connection.rollback()
+                    if self._getFileId(key[0]) != entry[1]:
+                        self._closeEntry(key)
+                    else:
+                        self._evict()
+                return
+        connection.close() # not pooled connection
+        
+    def closeConnections(self, dbName):
+        """ Close all connections to a given db (from any thread). """
+        dbPath = os.path.abspath(dbName)
+        with self._locked():
+            for key in self._entries.keys():
+                if key[0] == dbPath:
+                    self._closeEntry(key)
+                    
+    def getStats(self):
+        """ Return a dictionary with the usage counters of the pool. """
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 
+                    'misses': self.misses, 'evictions': self.evictions}
+        
+
 class SqliteDb():
     """Class to handle a Sqlite database.
     It will create connection, execute queries and commands.
+    The connection is taken from a pool and it is shared with other 
+    SqliteDb objects of the same file in the same thread, so they
+    also share the current transaction (see SqliteConnectionPool).
     """
-    OPEN_CONNECTIONS = {} # Store all conections made
+    POOL = SqliteConnectionPool(walMode=envVarOn('SCIPION_SQLITE_WAL'))
     
     def __init__(self):
-        self._reuseConnections = False
+        pass
         
     def _createConnection(self, dbName, timeout):
         """Establish db connection"""
         self._dbName = dbName
-        if self._reuseConnections and dbName in self.OPEN_CONNECTIONS:
-            self.connection = self.OPEN_CONNECTIONS[dbName]
-        else:
-            self.connection = sqlite.Connection(dbName, timeout, check_same_thread=False)
-            self.connection.row_factory = sqlite.Row
-            self.OPEN_CONNECTIONS[dbName] = self.connection
-            
+        self.connection = self.POOL.getConnection(dbName, timeout, self)
         self.cursor = self.connection.cursor()
         # Define some shortcuts functions
         if envVarOn('SCIPION_DEBUG_SQLITE'):
@@ -61,18 +254,20 @@ class SqliteDb():
         
     @classmethod
     def closeConnection(cls, dbName):
-        if dbName in cls.OPEN_CONNECTIONS:
-            connection = cls.OPEN_CONNECTIONS[dbName]
-            del cls.OPEN_CONNECTIONS[dbName]
-            connection.close()
+        cls.POOL.closeConnections(dbName)
         
     def getDbName(self):
         return self._dbName
     
     def close(self):
-        self.connection.close()
-        if self._dbName in self.OPEN_CONNECTIONS:
-            del self.OPEN_CONNECTIONS[self._dbName]
+        """ Release the connection, it will be kept in the
+        pool to be reused later. """
+        self.POOL.releaseConnection(self.connection, self)
+        
+    def checkpoint(self):
+        """ Write the WAL content (if any) into the db file, it should
+        be done before copying the db file. """
+        self.executeCommand("PRAGMA wal_checkpoint(FULL);")
         
     def _debugExecute(self, *args):
         try:
@@ -100,6 +295,15 @@ class SqliteDb():
         else:
             return self._iterResults()
         
+    def getPragma(self, name):
+        """ Return the current value of a sqlite PRAGMA. """
+        self.executeCommand("PRAGMA %s;" % name)
+        return self.cursor.fetchone()[0]
+    
+    def setPragma(self, name, value):
+        """ Set the value of a sqlite PRAGMA. """
+        self.executeCommand("PRAGMA %s=%s;" % (name, value))
+        
     def getTables(self, tablePattern=None):
         """ Return the table names existing in the Database.
         If  tablePattern is not None, only tables matching 
@@ -30,6 +30,13 @@ basic classes.
 """
 
 from itertools import izip
+from contextlib import contextmanager
+
+# Types of the numpy arrays used for Set.getColumnArrays
+NUMPY_TYPES = {'Integer': 'int64',
+               'Float': 'float64',
+               'Boolean': 'bool'
+               }
 
 # Binary relations always involve two objects, we 
 # call them parent-child objects, the following
@@ -935,6 +942,16 @@ class Set(OrderedObject):
             
     def aggregate(self, operations, operationLabel, groupByLabels=None):
         return self._getMapper().aggregate(operations, operationLabel, groupByLabels)
+    
+    def createIndex(self, *labels):
+        """ Declare secondary indexes over some attributes of the items.
+        The indexes will be built when the set is written and will 
+        speed up the iteration using a where condition on those attributes.
+        Example:
+            coordSet.createIndex('_micId')
+        """
+        for label in labels:
+            self._getMapper().createIndex(label)
 
     def setMapperClass(self, MapperClass):
         """ Set the mapper to be used for storage. """
@@ -951,10 +968,60 @@ class Set(OrderedObject):
         """ element in Set """
         return self._getMapper().selectById(itemId) != None
 
-    def iterItems(self, orderBy='id', direction='ASC', where='1'):
+    def iterItems(self, orderBy='id', direction='ASC', where='1', reuse=True):
+        """ Iterate over the items of the set.
+        Params:
+            orderBy, direction: sorting of the items.
+            where: condition to filter the items, e.g: '_micId=3'
+            reuse: by default (reuse=True) the same item object is 
+                filled and returned in each iteration, to avoid 
+                allocating a new object per row. The item should be 
+                cloned if it needs to be kept after the next iteration.
+                Use reuse=False to get a new object for each item.
+        """
         return self._getMapper().selectAll(orderBy=orderBy,
                                            direction=direction,
-                                           where=where)#has flat mapper, iterate is true
+                                           where=where,
+                                           reuse=reuse)#has flat mapper, iterate is true
+
+    def getItemsByIds(self, ids, orderBy='id', direction='ASC', reuse=True):
+        """ Iterate over the items with the given ids, with a single
+        query instead of one query per id as done by set[itemId].
+        The ids that are not in the set are ignored.
+        Params:
+            ids: any iterable of ids (e.g a list or a numpy array).
+            orderBy, direction, reuse: as in iterItems.
+        """
+        return self._getMapper().selectByIds(ids, orderBy=orderBy, 
+                                             direction=direction,
+                                             reuse=reuse)
+        
+    def hasIds(self, ids):
+        """ Return a list of booleans telling if each one of the
+        ids (a list or a numpy array) is in the set, with a single query.
+        """
+        existingIds = self._getMapper().selectExistingIds(ids)
+        return [objId in existingIds for objId in ids]
+    
+    def join(self, otherSet, on, otherOn='id', reuse=True):
+        """ Iterate over the pairs (item, otherItem) of items of this set
+        and otherSet where the attribute 'on' of item is equal to the 
+        attribute 'otherOn' of otherItem. The pairs are sorted by the 
+        item id and found with a single query, so both sets should be
+        stored in files (not in memory). For example:
+            for movieParticle, particle in movieParticles.join(particles, 
+                                                               on='_particleId'):
+                ...
+        Params:
+            reuse: as in iterItems, the same pair of objects is filled 
+                in each iteration, unless reuse=False.
+        """
+        if otherSet.getFileName() == ':memory:':
+            raise Exception("Set.join: the other set should be stored in "
+                            "a file, not in memory.")
+            
+        return self._getMapper().selectJoin(otherSet._getMapper(), on, 
+                                            otherOn=otherOn, reuse=reuse)
 
     def getFirstItem(self):
         """ Return the first item in the Set. """
@@ -1051,6 +1118,30 @@ class Set(OrderedObject):
     def _insertItem(self, item):
         self._getMapper().insert(item)
         
+    @contextmanager
+    def bulkAppend(self, batchSize=10000, fast=False):
+        """ Context manager to append many items efficiently.
+        Inside the 'with' block, appended items are buffered and 
+        written in batches of batchSize rows. All pending rows are 
+        written and committed when leaving the block.
+        If fast=True, sqlite synchronous writes will be disabled
+        while in the block.
+        Example:
+            with imgSet.bulkAppend():
+                for img in images:
+                    imgSet.append(img)
+        """
+        mapper = self._getMapper()
+        # Allow nesting, only the outer block will flush and commit
+        if mapper.inBulk():
+            yield self
+        else:
+            mapper.beginBulk(batchSize, fast)
+            try:
+                yield self
+            finally:
+                mapper.endBulk()
+        
     def update(self, item):
         """ Update an existing item. """
         self._getMapper().update(item)
@@ -1097,6 +1188,61 @@ class Set(OrderedObject):
         """
         self.setAttributeValue(propertyName, self.getProperty(propertyName, defaultValue))
         
+    def getColumnArrays(self, labels, orderBy='id', direction='ASC', where='1'):
+        """ Read the values of some attributes of all items 
+        (or those matching the where condition) directly from the
+        database into numpy arrays, without building any item object.
+        Params:
+            labels: list of attributes labels, e.g: ['_x', '_y', '_micId']
+                'id' and 'enabled' can also be used.
+        Returns:
+            a list with one array per label. Integer, Float and Boolean
+            attributes give int64, float64 and bool arrays (Integer 
+            columns with null values are returned as float64 with nan),
+            other attributes are returned as arrays of objects.
+        """
+        import numpy as np
+        mapper = self._getMapper()
+        rows = mapper.selectColumns(labels, orderBy=orderBy, 
+                                    direction=direction, where=where)
+        columns = zip(*rows) if rows else [()] * len(labels)
+        arrays = []
+        
+        for label, values in izip(labels, columns):
+            dtype = NUMPY_TYPES.get(mapper.getColumnClass(label), object)
+            if dtype == 'int64' and None in values:
+                dtype = 'float64'
+            arrays.append(np.array(values, dtype=dtype))
+        
+        return arrays
+    
+    def appendFromArrays(self, arrays, item=None):
+        """ Append new items to the set from columns of values.
+        This is the inverse of getColumnArrays and allows to write 
+        many items without creating an object for each one.
+        Params:
+            arrays: dict with attributes labels as keys and arrays 
+                (or lists) of values, all with the same length.
+                If 'id' is not present, ids will be assigned as in append.
+            item: object used as template for the attributes not present
+                in arrays. If None, an ITEM_TYPE() instance is used.
+        """
+        if item is None:
+            item = self.ITEM_TYPE()
+        columns = {}
+        for label, values in arrays.iteritems():
+            # Convert to python types that can be stored by sqlite
+            columns[label] = values.tolist() if hasattr(values, 'tolist') else list(values)
+        ids = columns.pop('id', None)
+        n = len(columns.values()[0]) if columns else len(ids)
+        if ids is None:
+            ids = range(self._idCount + 1, self._idCount + n + 1)
+        
+        if n:
+            self._getMapper().insertColumns(item, ids, columns)
+            self._idCount = max(self._idCount, max(ids))
+            self._size.set(self._size.get() + n)
+        
     def getIdSet(self):
         """ Return a Python set object containing all ids. """
         s = set()
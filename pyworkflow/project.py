@@ -41,6 +41,7 @@ import pyworkflow.protocol as pwprot
 import pyworkflow.object as pwobj
 import pyworkflow.utils as pwutils
 from pyworkflow.mapper import SqliteMapper
+from pyworkflow.mapper.sqlite_db import getDbSignature
 from pyworkflow.utils.graph import Graph
 from pyworkflow.utils import getFreePort
 
@@ -79,6 +80,8 @@ class Project(object):
         self.settingsPath = self.__addPath(PROJECT_SETTINGS)
         self.configPath = self.__addPath(PROJECT_CONFIG)
         self.runs = None
+        self._runsLastChange = 0 # last change in db when runs were loaded
+        self._runsDbStats = {} # signature of runs db when they were last updated
         self._runsGraph = None
         self._transformGraph = None
         self._sourceGraph = None
@@ -160,11 +163,10 @@ class Project(object):
     def createMapper(self, sqliteFn):
         """ Create a new SqliteMapper object and pass as classes dict
         all globas and update with data and protocols from em.
+        The em-packages are only imported when their classes are used.
         """
         #TODO: REMOVE THE USE OF globals() here
-        classesDict = dict(pwobj.__dict__)
-        classesDict.update(em.getProtocols())
-        classesDict.update(em.getObjects())
+        classesDict = em.getClassesDict(pwobj.__dict__)
         return SqliteMapper(sqliteFn, classesDict)
     
     def load(self, dbPath=None, hostsConf=None, protocolsConf=None, chdir=True):
@@ -333,10 +335,10 @@ class Project(object):
         protocol.makePathsAndClean() # Create working dir if necessary
         self.mapper.commit()
         
-        # Prepare a separate db for this run
-        # NOTE: now we are simply copying the entire project db, this can be changed later
-        # to only create a subset of the db need for the run
-        pwutils.path.copyFile(self.dbPath, protocol.getDbPath())
+        # Prepare a separate db for this run, only with the objects
+        # needed by the protocol instead of the entire project db
+        pwutils.path.cleanPath(protocol.getDbPath())
+        self.mapper.copyClosureTo(protocol.getDbPath(), [protocol.getObjId()])
         
         # Launch the protocol, the jobId should be set after this call
         pwprot.launch(protocol, wait)
@@ -349,6 +351,9 @@ class Project(object):
         self.mapper.commit()
         
     def _updateProtocol(self, protocol, tries=0):
+        """ Copy the protocol values from its run db.
+        Return True if the protocol was updated.
+        """
         if not self.isReadOnly():
             try:
                 # Backup the values of 'jobId', 'label' and 'comment'
@@ -373,6 +378,7 @@ class Project(object):
                 protocol.setObjComment(comment)
                 
                 self.mapper.store(protocol)
+                return True
             
             except Exception, ex:
                 print "Error trying to update protocol: %s(jobId=%s)\n ERROR: %s, tries=%d" % (protocol.getObjName(), jobId, ex, tries)
@@ -383,7 +389,8 @@ class Project(object):
                     self.mapper.store(protocol)
                 else:
                     time.sleep(0.5)
-                    self._updateProtocol(protocol, tries+1)
+                    return self._updateProtocol(protocol, tries+1)
+        return False
         
     def stopProtocol(self, protocol):
         """ Stop a running protocol """
@@ -617,14 +624,13 @@ class Project(object):
         f = open(filename)
         protocolsList = json.load(f)
         
-        emProtocols = em.getProtocols()
         newDict = {}
         
         # First iteration: create all protocols and setup parameters
         for protDict in protocolsList:
             protClassName = protDict['object.className']
             protId = protDict['object.id']
-            protClass = emProtocols.get(protClassName, None)
+            protClass = em.getClass(protClassName)
             
             if protClass is None:
                 print "ERROR: protocol class name '%s' not found" % protClassName
@@ -727,20 +733,68 @@ class Project(object):
             
     def getRuns(self, iterate=False, refresh=True):
         """ Return the existing protocol runs in the project. 
+        All runs are loaded the first time, after that, a refresh
+        only reloads the runs that have changed in the project db
+        since the previous one (using the mapper changes journal).
+        Active runs are only updated if their run db has changed.
         """
         if self.runs is None or refresh:
-            # Close db open connections to db files
-            self.runs = self.mapper.selectByClass("Protocol", iterate=False)
-            for r in self.runs:
+            lastChange = self.mapper.getLastChange()
+            if self.runs is None:
+                self.runs = self.mapper.selectByClass("Protocol", iterate=False)
+                changedRuns = self.runs
+            else:
+                changedRuns = self.__reloadChangedRuns()
+            for r in changedRuns:
                 self._setProtocolMapper(r)
+            updatedIds = set()
+            for r in self.runs:
                 # Update nodes that are running and are not invoked by other protocols
                 if r.isActive():
                     if not r.isChild():
-                        self._updateProtocol(r)
+                        dbSignature = self.__getRunDbSignature(r)
+                        if (dbSignature is None or 
+                            self._runsDbStats.get(r.getObjId()) != dbSignature):
+                            if self._updateProtocol(r) and dbSignature is not None:
+                                # Only skip the next update if this one succeeded
+                                self._runsDbStats[r.getObjId()] = dbSignature
+                            updatedIds.add(r.getObjId())
             self.mapper.commit()
+            # Do not reload in the next refresh the runs updated here,
+            # unless something else has been changed in the meantime
+            changes = self.mapper.getChangesSince(lastChange)
+            if all(objId in updatedIds for objId, _ in changes):
+                lastChange = max([lastChange] + [seq for _, seq in changes])
+            self._runsLastChange = lastChange
         
         return self.runs
     
+    def __reloadChangedRuns(self):
+        """ Reload from the db the runs that have been changed
+        since the last load, new runs are added and deleted ones removed.
+        Return the list of reloaded runs.
+        """
+        changedIds = set(objId for objId, _ in 
+                         self.mapper.getChangesSince(self._runsLastChange))
+        if not changedIds:
+            return []
+        runsDict = dict((r.getObjId(), r) for r in self.runs
+                        if r.getObjId() not in changedIds)
+        changedRuns = [r for r in self.mapper.selectByIds(changedIds)
+                       if isinstance(r, pwprot.Protocol)]
+        for r in changedRuns:
+            runsDict[r.getObjId()] = r
+        self.runs = [runsDict[k] for k in sorted(runsDict)]
+        
+        return changedRuns
+    
+    def __getRunDbSignature(self, protocol):
+        """ Return the signature of the run db of the protocol (see
+        getDbSignature), it is compared with the one of the last 
+        update to detect if the run has been modified.
+        """
+        return getDbSignature(os.path.join(self.path, protocol.getDbPath()))
+    
     def iterSubclasses(self, classesName, objectFilter=None):
         """ Retrieve all objects from the project that are instances
             of any of the classes in classesName list.
@@ -0,0 +1,288 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+This module contains the cache of the result files produced by steps.
+When the same step (same protocol class, parameters, function and 
+arguments, same input files and same prerequisites steps) is run again,
+for example in a copy of the protocol or when restarting it, the result
+files are copied from the cache instead of running the step again.
+"""
+
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import threading
+
+from pyworkflow.utils import envVarOn
+from pyworkflow.utils.path import cleanPath, makeFilePath
+
+
+WORKING_DIR_TAG = '%(WORKINGDIR)s'
+RESULTS_FILE = 'results.json'
+
+
+def iterArgsFiles(value):
+    """ Iterate over the existing files named in the arguments of a step
+    function: strings that are a file path or the words of strings (as 
+    in the command line of runJob), inside lists, tuples and dicts.
+    """
+    if isinstance(value, basestring):
+        if os.path.isfile(value):
+            yield value
+        else:
+            for word in value.split():
+                if os.path.isfile(word):
+                    yield word
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            for fn in iterArgsFiles(v):
+                yield fn
+    elif isinstance(value, dict):
+        for fn in iterArgsFiles(value.values()):
+            yield fn
+
+
+class ResultsCache():
+    """ Cache the result files of steps in a folder, with one entry
+    (a folder named with the step key) for each step. The files are
+    hard linked (or copied if it is not possible) into the entries,
+    and copied back when restored, so the files of a run are never
+    shared with other runs. The least recently used entries are removed
+    when the size of the cache is bigger than maxSize (in bytes).
+    """
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    def __normalize(self, value, workingDirs):
+        """ Replace the working dir in the arguments, so the same
+        step in other protocol will have the same key.
+        """
+        if isinstance(value, basestring):
+            for wd in workingDirs:
+                value = value.replace(wd, WORKING_DIR_TAG)
+            return value
+        elif isinstance(value, (list, tuple)):
+            return [self.__normalize(v, workingDirs) for v in value]
+        elif isinstance(value, dict):
+            return sorted((k, self.__normalize(v, workingDirs))
+                          for k, v in value.iteritems())
+        return value
+
+    def __updateFileHash(self, h, fn):
+        """ Update the hash with the content of a file. """
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), ''):
+                h.update(block)
+
+    def getKey(self, scope, funcName, args, workingDir, params=None,
+               prerequisitesKeys=None):
+        """ Compute the key of a step from the scope (e.g the protocol
+        class name), the function name, the normalized arguments and
+        the input files. The files outside the workingDir are identified 
+        by their path, modification time and size. The files inside it
+        (generated by previous steps) by their content, since they could 
+        be regenerated from a different input with the same name.
+        Params:
+            params: values of the protocol parameters, since the step
+                function could read them from the protocol instead 
+                of receiving them as arguments.
+            prerequisitesKeys: keys of the steps that should be done
+                before, so the key changes if any of them changes.
+        """
+        absWorkingDir = os.path.abspath(workingDir)
+        workingDirs = [absWorkingDir, os.path.normpath(workingDir)]
+        h = hashlib.md5('%s.%s' % (scope, funcName))
+        h.update(pickle.dumps(self.__normalize(args, workingDirs)))
+        h.update(pickle.dumps(self.__normalize(params, workingDirs)))
+        h.update(pickle.dumps(prerequisitesKeys))
+        for fn in iterArgsFiles(args):
+            fn = os.path.abspath(fn)
+            if fn.startswith(absWorkingDir + os.sep):
+                h.update(os.path.relpath(fn, absWorkingDir))
+                self.__updateFileHash(h, fn)
+            else:
+                st = os.stat(fn)
+                h.update('%s:%s:%s' % (fn, st.st_mtime, st.st_size))
+        return h.hexdigest()
+
+    def __getEntryPath(self, key, *paths):
+        return os.path.join(self.path, key, *paths)
+
+    def __linkFile(self, source, dest):
+        """ Hard link source to dest, or copy it if not possible,
+        for example in different file systems.
+        """
+        cleanPath(dest)
+        makeFilePath(dest)
+        try:
+            os.link(source, dest)
+        except OSError:
+            shutil.copy2(source, dest)
+
+    def __iterFiles(self, path):
+        """ Iterate over the files in path, that could be a folder. """
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for f in files:
+                    yield os.path.join(root, f)
+        else:
+            yield path
+
+    def __countHit(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def restore(self, key, workingDir):
+        """ Copy the cached result files of the step with this key into
+        workingDir. Return the list of result files or None if the key
+        is not in the cache or its files were modified.
+        The files are copied (not linked) so writing in the files
+        of this run will not modify the files of other runs.
+        """
+        resultsFn = self.__getEntryPath(key, RESULTS_FILE)
+
+        try:
+            with open(resultsFn) as f:
+                results = json.load(f)
+            # Stored files are hard linked, so check they were not 
+            # modified later by the run that stored them
+            for fn, mtime, size in results['files']:
+                st = os.stat(self.__getEntryPath(key, 'files', fn))
+                if st.st_mtime != mtime or st.st_size != size:
+                    raise Exception("Cached file '%s' was modified" % fn)
+        except Exception:
+            cleanPath(self.__getEntryPath(key))
+            self.__countHit(False)
+            return None
+
+        for fn, _, _ in results['files']:
+            dest = os.path.join(workingDir, fn)
+            cleanPath(dest)
+            makeFilePath(dest)
+            shutil.copy2(self.__getEntryPath(key, 'files', fn), dest)
+        os.utime(resultsFn, None) # Mark as recently used
+        self.__countHit(True)
+
+        return [os.path.join(workingDir, fn) for fn in results['results']]
+
+    def store(self, key, workingDir, resultFiles):
+        """ Store the result files of the step with this key.
+        Only files inside workingDir can be stored, if there are
+        others the step results are not cached. Return True if stored.
+        """
+        absWorkingDir = os.path.abspath(workingDir)
+        results = [os.path.relpath(os.path.abspath(fn), absWorkingDir)
+                   for fn in resultFiles]
+
+        if any(r.startswith(os.pardir) for r in results):
+            return False
+
+        # Write in a temporary entry and rename it when done,
+        # so other processes never see incomplete entries
+        tmpKey = '%s.tmp%d_%d' % (key, os.getpid(), threading.current_thread().ident)
+        files = []
+
+        try:
+            for r in results:
+                for fn in self.__iterFiles(os.path.join(absWorkingDir, r)):
+                    rel = os.path.relpath(fn, absWorkingDir)
+                    dest = self.__getEntryPath(tmpKey, 'files', rel)
+                    self.__linkFile(fn, dest)
+                    st = os.stat(dest)
+                    files.append((rel, st.st_mtime, st.st_size))
+            with open(self.__getEntryPath(tmpKey, RESULTS_FILE), 'w') as f:
+                json.dump({'results': results, 'files': files}, f)
+            cleanPath(self.__getEntryPath(key))
+            os.rename(self.__getEntryPath(tmpKey), self.__getEntryPath(key))
+        except Exception:
+            cleanPath(self.__getEntryPath(tmpKey))
+            return False
+
+        with self._lock:
+            self.stored += 1
+
+        return True
+
+    def getEntries(self):
+        """ Return a list of (lastUsed, size, key) for each entry. """
+        entries = []
+
+        if os.path.exists(self.path):
+            for key in os.listdir(self.path):
+                resultsFn = self.__getEntryPath(key, RESULTS_FILE)
+                if os.path.exists(resultsFn):
+                    size = sum(os.path.getsize(fn) for fn in
+                               self.__iterFiles(self.__getEntryPath(key)))
+                    entries.append((os.path.getmtime(resultsFn), size, key))
+
+        return entries
+
+    def evict(self):
+        """ Remove the least recently used entries until the
+        size of the cache is not bigger than maxSize.
+        """
+        entries = sorted(self.getEntries())
+        totalSize = sum(e[1] for e in entries)
+
+        for _, size, key in entries:
+            if totalSize <= self.maxSize:
+                break
+            cleanPath(self.__getEntryPath(key))
+            totalSize -= size
+            self.evicted += 1
+
+    def getStats(self):
+        """ Return a dict with the cache counters. """
+        return {'hits': self.hits, 'misses': self.misses,
+                'stored': self.stored, 'evicted': self.evicted}
+
+
+def getResultsCache():
+    """ Return the results cache of the project if it is enabled
+    with SCIPION_RESULTS_CACHE, None otherwise. By default the cache
+    is in the project Tmp folder (protocols are run from the project
+    folder), but it can be set with SCIPION_RESULTS_CACHE_DIR.
+    The maximum size (in MB) is set with SCIPION_RESULTS_CACHE_SIZE.
+    """
+    if not envVarOn('SCIPION_RESULTS_CACHE'):
+        return None
+
+    path = os.environ.get('SCIPION_RESULTS_CACHE_DIR',
+                          os.path.join('Tmp', 'ResultsCache'))
+    maxSize = int(os.environ.get('SCIPION_RESULTS_CACHE_SIZE', 10240))
+
+    return ResultsCache(path, maxSize * 1024 * 1024)
@@ -54,6 +54,7 @@ MODE_CHOICES = ('Resume', 'Restart')#, 'Continue')
 # Steps execution mode
 STEPS_SERIAL = 0      # Execute steps serially, some of the steps can be mpi programs
 STEPS_PARALLEL = 1    # Execute steps in parallel, throught threads or mpi
+STEPS_PROCESSES = 2   # Execute steps in parallel, through processes (for CPU-bound python steps)
 
 
 # Level of expertise for the input parameters, mainly used in the protocol form
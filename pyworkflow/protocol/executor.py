@@ -30,10 +30,11 @@ There is one based on threads to execute steps in parallel
 using different threads and the last one with MPI processes.
 """
 
-import time
 import datetime
 import traceback
 import threading
+import heapq
+import inspect
 
 import pyworkflow.utils.process as process
 import constants as cts
@@ -68,7 +69,10 @@ class StepExecutor():
 
 
 class StepThread(threading.Thread):
-    """ Thread to run Steps in parallel. """
+    """ Thread to run Steps in parallel. 
+    The lock should be a threading.Condition, it will be
+    notified when the step is done.
+    """
     def __init__(self, thId, step, lock):
         threading.Thread.__init__(self)
         self.thId = thId
@@ -89,6 +93,7 @@ class StepThread(threading.Thread):
                 else:
                     self.step.setFailed(error)
                 self.step.endTime.set(datetime.datetime.now())
+                self.lock.notify()
 
 
 class ThreadStepExecutor(StepExecutor):
@@ -100,29 +105,49 @@ class ThreadStepExecutor(StepExecutor):
     def runSteps(self, steps, stepStartedCallback, stepFinishedCallback):
         """ Create threads and synchronize the steps execution.
         n: the number of threads.
+        Steps are started when all its prerequisites are finished,
+        the ones with higher priority first and then in insertion order.
         """
-
-        sharedLock = threading.Lock()
+        # The threads notify this condition when a step is done
+        sharedLock = threading.Condition()
 
         runningSteps = {}  # currently running step in each node ({node: step})
         freeNodes = range(self.numberOfProcs)  # available nodes to send mpi jobs
+        threads = []
 
-        def getRunnable():
-            """ Return the first step that is 'new' and all its
-            dependencies have been finished, or None if none ready.
-            """
-            for s in steps:
-                if (s.getStatus() == cts.STATUS_NEW and
-                        all(steps[i-1].isFinished() for i in s._prerequisites)):
-                    return s
-            return None
+        # For each step, count its prerequisites that are not finished
+        # and keep which steps depend on it.
+        pending = [0] * len(steps)
+        dependents = [[] for _ in steps]
+        readySteps = []  # heap of (-priority, index) of runnable steps
+        
+        for i, s in enumerate(steps):
+            if s.getStatus() == cts.STATUS_NEW:
+                for p in s._prerequisites:
+                    p = int(p) - 1
+                    dependents[p].append(i)
+                    if not steps[p].isFinished():
+                        pending[i] += 1
+                if not pending[i]:
+                    heapq.heappush(readySteps, (-s.getPriority(), i))
+        
+        def stepDone(step):
+            """ Update the steps that depend on a finished step. """
+            for i in dependents[step._index - 1]:
+                pending[i] -= 1
+                if not pending[i] and steps[i].getStatus() == cts.STATUS_NEW:
+                    heapq.heappush(readySteps, (-steps[i].getPriority(), i))
 
         while True:
-            # See which of the runningSteps are not really running anymore.
-            # Update them and freeNodes, and call final callback for step.
+            # Wait until some step is done or there is a step to start
             with sharedLock:
+                while (runningSteps and not (freeNodes and readySteps) and
+                       all(s.isRunning() for s in runningSteps.itervalues())):
+                    sharedLock.wait()
                 nodesFinished = [node for node, step in runningSteps.iteritems()
                                  if not step.isRunning()]
+            # Update the finished steps and freeNodes, 
+            # and call final callback for step.
             doContinue = True
             for node in nodesFinished:
                 step = runningSteps.pop(node)  # remove entry from runningSteps
@@ -130,32 +155,87 @@ class ThreadStepExecutor(StepExecutor):
                 doContinue = stepFinishedCallback(step)  # and do final work on the finished step
                 if not doContinue:
                     break
+                if step.isFinished():
+                    stepDone(step)
             if not doContinue:
                 break
 
-            # If there are available nodes, send next runnable step.
-            with sharedLock:
-                if freeNodes:
-                    step = getRunnable()
-                    if step is not None:
-                        # We found a step to work in, so let's start a new
-                        # thread to do the job and book it.
-                        step.setRunning()
-                        stepStartedCallback(step)
-                        node = freeNodes.pop()  # take an available node
-                        runningSteps[node] = step
-                        t = StepThread(node, step, sharedLock)
-                        t.daemon = True  # won't keep process up if main thread ends
-                        t.start()
-                    elif not any(s.isRunning() for s in steps):  # nothing running
-                        break  # yeah, we are done, either failed or finished :)
-
-            time.sleep(0.1)  # be gentle on the main thread
+            # Send runnable steps to the available nodes.
+            while freeNodes and readySteps:
+                step = steps[heapq.heappop(readySteps)[1]]
+                # We found a step to work in, so let's start a new
+                # thread to do the job and book it.
+                with sharedLock:
+                    step.setRunning()
+                stepStartedCallback(step)
+                node = freeNodes.pop()  # take an available node
+                runningSteps[node] = step
+                t = StepThread(node, step, sharedLock)
+                t.daemon = True  # won't keep process up if main thread ends
+                t.start()
+                threads.append(t)
+            
+            if not runningSteps:  # nothing running
+                break  # yeah, we are done, either failed or finished :)
 
         # Wait for all threads now.
-        for t in threading.enumerate():
-            if t is not threading.current_thread():
-                t.join()
+        for t in threads:
+            t.join()
+
+
+class ProcessFunction():
+    """ Callable used instead of a protocol function, that 
+    will run the function in a process of the pool. """
+    def __init__(self, pool, protocolKey, funcName):
+        self.pool = pool
+        self.protocolKey = protocolKey
+        self.funcName = funcName
+        
+    def __call__(self, *funcArgs):
+        from protocol import runFunctionInProcess
+        return self.pool.apply(runFunctionInProcess, 
+                               self.protocolKey + (self.funcName, funcArgs))
+        
+        
+class ProcessStepExecutor(ThreadStepExecutor):
+    """ Run steps in parallel using a pool of processes, to avoid 
+    the GIL limitation of threads for CPU-bound python steps.
+    Steps are scheduled as in the ThreadStepExecutor, but the 
+    protocol functions are executed in the processes, where the
+    protocol is loaded from its run db for each step, so the outputs
+    defined by previous steps are available. 
+    The steps that define outputs (createOutput* functions) are run 
+    in this process, that is the only one writing in the run db 
+    (outputs) and in the steps db (status). So the functions run in 
+    the pool should not define outputs, and the changes that they 
+    make to the protocol attributes are lost.
+    """
+    MAIN_PROCESS_PREFIX = 'createOutput'
+    
+    def __init__(self, hostConfig, nProcesses, projectPath, protDbPath, protId,
+                 protClass):
+        ThreadStepExecutor.__init__(self, hostConfig, nProcesses)
+        # The protocol class is passed to the processes, so they do
+        # not need to find it (it could be defined outside em-packages)
+        self.protocolKey = (projectPath, protDbPath, protId, protClass)
+        
+    def runSteps(self, steps, stepStartedCallback, stepFinishedCallback):
+        import multiprocessing
+        pool = multiprocessing.Pool(self.numberOfProcs)
+        try:
+            for step in steps:
+                # Only protocol functions can be run in the processes,
+                # other functions (e.g. copyFile) are run in threads
+                func = getattr(step, '_func', None)
+                if (inspect.ismethod(func) and func.im_self is not None and
+                    not func.__name__.startswith(self.MAIN_PROCESS_PREFIX)):
+                    step._func = ProcessFunction(pool, self.protocolKey,
+                                                 func.__name__)
+            ThreadStepExecutor.runSteps(self, steps, stepStartedCallback,
+                                        stepFinishedCallback)
+        finally:
+            pool.close()
+            pool.join()
 
 
 class MPIStepExecutor(ThreadStepExecutor):
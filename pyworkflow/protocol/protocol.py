@@ -33,6 +33,9 @@ import sys
 import datetime as dt
 import pickle
 import json
+import hashlib
+import traceback
+import time
 from collections import OrderedDict
 
 import pyworkflow as pw
@@ -41,9 +44,12 @@ from pyworkflow.utils import redStr, greenStr, magentaStr, envVarOn, runJob
 from pyworkflow.utils.path import (makePath, join, missingPaths, cleanPath, cleanPattern,
                                    getFiles, exists, renderTextFile, copyFile)
 from pyworkflow.utils.log import ScipionLogger
-from executor import StepExecutor, ThreadStepExecutor, MPIStepExecutor
+from executor import (StepExecutor, ThreadStepExecutor, MPIStepExecutor, 
+                      ProcessStepExecutor)
 from constants import *
 from params import Form
+from cache import getResultsCache, iterArgsFiles
+from pyworkflow.mapper.sqlite_db import getDbSignature
 import scipion
 
 
@@ -64,6 +70,7 @@ class Step(OrderedObject):
         self.interactive = Boolean(False)
         self._resultFiles = String()
         self._index = None
+        self._priority = 0 # not stored, used to sort steps ready to run
         
     def _preconditions(self):
         """ Check if the necessary conditions to
@@ -133,6 +140,35 @@ class Step(OrderedObject):
     def setInteractive(self, value):
         return self.interactive.set(value)
     
+    def getPriority(self):
+        return self._priority
+    
+    def setPriority(self, value):
+        """ Steps with higher priority will be run first
+        when running steps in parallel. """
+        self._priority = value
+    
+    def getFingerprint(self, workingDir):
+        """ Return a hash that identifies what the step will do, steps
+        of a previous run with the same fingerprint can be skipped. 
+        None means that the step can not be identified in that way.
+        """
+        return None
+    
+    def setResultsCache(self, cache, scope, workingDir, params=None, 
+                        prerequisites=None):
+        """ Set the cache used to reuse the results of this step.
+        By default steps can not be cached.
+        """
+        pass
+    
+    def getCacheKey(self):
+        """ Return the key of the step in the results cache, or None
+        if the step could not be keyed. The steps that depend on it
+        can not be cached either, since their key includes this one.
+        """
+        return None
+    
     def isActive(self):
         return self.getStatus() in ACTIVE_STATUS
     
@@ -197,23 +233,94 @@ class FunctionStep(Step):
         self._args = funcArgs
         self.funcName = String(funcName)
         self.argsStr = String(pickle.dumps(funcArgs))
+        self._fingerprint = String()
+        # Key in the results cache, stored to key the 
+        # steps depending on this one when resuming
+        self._cacheKey = String()
+        # Result files for functions that do not return them (e.g runJob),
+        # only used to store them in the results cache
+        self._expectedFiles = kwargs.get('resultFiles', [])
+        self._cache = None
         self.setInteractive(kwargs.get('interactive', False))
         
     def _runFunc(self):
         """ Return the possible result files after running the function. """
         return self._func(*self._args)
+    
+    def setResultsCache(self, cache, scope, workingDir, params=None,
+                        prerequisites=None):
+        """ Results are reused from the cache if the same function,
+        with the same arguments and input files, was run before 
+        in a protocol of the same scope (the protocol class), with 
+        the same parameters values and after the same prerequisites 
+        steps (with the same keys).
+        """
+        self._cache = (cache, scope, workingDir, params, prerequisites or [])
+        
+    def getCacheKey(self):
+        return self._cacheKey.get()
+    
+    def __computeCacheKey(self, cache, scope, workingDir, params, prerequisites):
+        """ Return the key of the step in the cache, or None if the step
+        or any of its prerequisites could not be keyed.
+        """
+        prerequisitesKeys = [step.getCacheKey() for step in prerequisites]
+        if None in prerequisitesKeys:
+            return None
+        try:
+            return cache.getKey(scope, self.funcName.get(), self._args, 
+                                workingDir, params, prerequisitesKeys)
+        except Exception: # e.g. arguments that can not be pickled
+            return None
 
     def _run(self):
         """ Run the function and check the result files if any. """
-        resultFiles = self._runFunc() 
-        if isinstance(resultFiles, basestring):
-            resultFiles = [resultFiles]
+        resultFiles = None
+        key = None
+        
+        if self._cache is not None:
+            cache, scope, workingDir, params, prerequisites = self._cache
+            key = self.__computeCacheKey(cache, scope, workingDir, 
+                                         params, prerequisites)
+            if key is not None:
+                resultFiles = cache.restore(key, workingDir)
+        self._cacheKey.set(key)
+        
+        if resultFiles is None:
+            resultFiles = self._runFunc()
+            if not resultFiles and key is not None:
+                resultFiles = self._expectedFiles
+            if isinstance(resultFiles, basestring):
+                resultFiles = [resultFiles]
+            if resultFiles and key is not None:
+                if not missingPaths(*resultFiles):
+                    cache.store(key, workingDir, resultFiles)
+            
         if resultFiles and len(resultFiles):
             missingFiles = missingPaths(*resultFiles)
             if len(missingFiles):
                 raise Exception('Missing filePaths: ' + ' '.join(missingFiles))
             self._resultFiles.set(pickle.dumps(resultFiles))
     
+    def getFingerprint(self, workingDir):
+        """ The fingerprint is computed from the function name, 
+        the arguments and the modification time and size of the input 
+        files passed as arguments or named in the arguments strings
+        (see iterArgsFiles). It is computed only once and stored.
+        """
+        if not self._fingerprint.hasValue():
+            h = hashlib.md5(self.funcName.get())
+            h.update(self.argsStr.get())
+            workingDir = os.path.abspath(workingDir) + os.sep
+            for fn in iterArgsFiles(self._args):
+                # Files in the workingDir are generated by the protocol
+                if os.path.abspath(fn).startswith(workingDir):
+                    continue
+                st = os.stat(fn)
+                h.update('%s:%s:%s' % (fn, st.st_mtime, st.st_size))
+            self._fingerprint.set(h.hexdigest())
+        return self._fingerprint.get()
+    
     def _postconditions(self):
         """ This type of Step, will simply check
         as postconditions that the result filePaths exists""" 
@@ -320,6 +427,12 @@ class Protocol(Step):
         # Maybe this property can be inferred from the 
         # prerequisites of steps, but is easier to keep it
         self.stepsExecutionMode = STEPS_SERIAL
+        # Steps updates are written to db in batches, when a step
+        # finishes and at least this number of seconds have passed
+        # since the last write (0 to write each update)
+        self.stepsWriteInterval = 0.25
+        self._pendingSteps = OrderedDict()
+        self._stepsLastWrite = 0
         
         # Run mode
         self.runMode = Integer(kwargs.get('runMode', MODE_RESUME))
@@ -420,6 +533,38 @@ class Protocol(Step):
         for paramName, _ in self._definition.iterParams():
             yield paramName, getattr(self, paramName)
             
+    def _getParamsValues(self):
+        """ Return a list of (paramName, value) with the values of the 
+        params in the form, the pointers values are the id of the 
+        pointed object, the extended attribute and the signature of
+        the file of the pointed object (if any), so a set modified with 
+        the same id (e.g. in streaming) gives a different value.
+        The params that do not change the results (run name and mode, 
+        host) are skipped. This is used to identify the steps in the 
+        results cache.
+        """
+        def getPointerValue(pointer):
+            obj = pointer.getObjValue()
+            if obj is None:
+                return (None, pointer.getExtended(), None)
+            pointed = pointer.get()
+            fn = pointed.getFileName() if hasattr(pointed, 'getFileName') else None
+            return (obj.strId(), pointer.getExtended(), 
+                    getDbSignature(fn) if fn else None)
+        
+        values = []
+        for paramName, attr in sorted(self.iterDefinitionAttributes()):
+            if paramName in ['runName', 'runMode', 'hostName']:
+                continue
+            if isinstance(attr, PointerList):
+                value = [getPointerValue(p) for p in attr]
+            elif attr.isPointer():
+                value = getPointerValue(attr)
+            else:
+                value = attr.getObjValue()
+            values.append((paramName, value))
+        return values
+            
     def getDefinitionDict(self):
         """ Similar to getObjDict, but only for those 
         params that are in the form.
@@ -566,8 +711,11 @@ class Protocol(Step):
         Params:
          **kwargs:
             prerequisites: a list with the steps index that need to be done 
-                           previous than the current one."""
+                           previous than the current one.
+            priority: steps with higher priority will be run first when
+                      running in parallel (e.g. the longest ones)."""
         prerequisites = kwargs.get('prerequisites', None)
+        step.setPriority(kwargs.get('priority', 0))
         
         if prerequisites is None:
             if len(self._steps):
@@ -634,9 +782,12 @@ class Protocol(Step):
         
         return self.__insertStep(step, **kwargs)
         
-    def _insertRunJobStep(self, progName, progArguments, resultFiles=[], **kwargs):
+    def _insertRunJobStep(self, progName, progArguments, *args, **kwargs):
         """ Insert an Step that will simple call runJob function
-        **args: see __insertStep
+        *args: ignored, kept for compatibility with old calls.
+        **kwargs: see __insertStep, resultFiles (that should be passed 
+            by keyword) are the files produced by the program, used to 
+            store them in the results cache.
         """
         return self._insertFunctionStep('runJob', progName, progArguments, **kwargs)
     
@@ -710,31 +861,57 @@ class Protocol(Step):
             self.__insertStep(step)
         
     def __findStartingStep(self):
-        """ From a previous run, compare self._steps and self._prevSteps
-        to find which steps we need to start at, skipping sucessful done 
-        and not changed steps. Steps that needs to be done, will be deleted
-        from the previous run storage.
+        """ From a previous run, find the steps in self._steps that were
+        already done and not changed, which are copied from the previous
+        ones and will be skipped. Steps are matched by its fingerprint, and
+        a step is only skipped if all its prerequisites are also skipped.
+        Return the number of steps already done.
         """
+        workingDir = self.workingDir.get()
+        for step in self._steps:
+            step.getFingerprint(workingDir)
+            
         if self.runMode == MODE_RESTART:
             self._prevSteps = []
             return 0
         
         self._prevSteps = self.loadSteps()
+        self.info("len(steps) " + str(len(self._steps)) + " len(prevSteps) " + str(len(self._prevSteps)))
         
+        # Previous steps done, by its stored fingerprint
+        prevDone = {}
+        for oldStep in self._prevSteps:
+            fingerprint = getattr(oldStep, '_fingerprint', None)
+            if (fingerprint is not None and fingerprint.hasValue() and 
+                oldStep.isFinished() and oldStep._postconditions()):
+                prevDone.setdefault(fingerprint.get(), []).append(oldStep)
+        
+        if self._prevSteps and not prevDone:
+            return self.__findStartingStepByIndex()
+        
+        stepsDone = 0
+        for step in self._steps: # prerequisites are always previous steps
+            oldSteps = prevDone.get(step.getFingerprint(workingDir), None)
+            if oldSteps and all(self._steps[int(i)-1].isFinished() 
+                                for i in step._prerequisites):
+                step.copy(oldSteps.pop(0), ignoreAttrs=['_prerequisites'])
+                stepsDone += 1
+                
+        return stepsDone
+    
+    def __findStartingStepByIndex(self):
+        """ Compare self._steps and self._prevSteps one by one, to find 
+        the first step that needs to be done. This is used when the 
+        previous steps do not have fingerprints (older runs).
+        """
         n = min(len(self._steps), len(self._prevSteps))
-        self.info("len(steps) " + str(len(self._steps)) + " len(prevSteps) " + str(len(self._prevSteps)))
         
         for i in range(n):
             newStep = self._steps[i]
             oldStep = self._prevSteps[i]
-#             self.info(">>> i: %s" % i)
-#             self.info(" oldStep.status: %s" % str(oldStep.status))
-#             self.info(" oldStep!=newStep %s" % (oldStep != newStep))
-#             self.info(" not post: %s" % (not oldStep._postconditions()))
             if (not oldStep.isFinished() or
                 newStep != oldStep or 
                 not oldStep._postconditions()):
-#                 self.info(" returning i: %s" % i)
                 return i
             newStep.copy(oldStep)
             
@@ -758,9 +935,29 @@ class Protocol(Step):
         self._stepsSet.write()
         
     def __updateStep(self, step):
-        """ Store a given step and write changes. """
-        self._stepsSet.update(step)
-        self._stepsSet.write()
+        """ Register the changes of a given step. The changes will be 
+        written by _stepFinished when stepsWriteInterval seconds have 
+        passed since the last write, together with the changes of 
+        other steps done in the meantime (see _writeSteps).
+        """
+        self._pendingSteps[step._index] = step
+        if self.stepsWriteInterval <= 0:
+            self._writeSteps()
+                
+    def _writeSteps(self):
+        """ Write the pending steps changes and the number of
+        steps done, all changes are committed at once. 
+        It is only called from the steps callbacks and _runSteps, 
+        that run in the executor loop thread, so the db connections 
+        are not used at the same time from other threads.
+        """
+        if self._pendingSteps:
+            for step in self._pendingSteps.itervalues():
+                self._stepsSet.update(step)
+            self._stepsSet.write()
+            self._pendingSteps.clear()
+            self._store(self._stepsDone)
+        self._stepsLastWrite = time.time()
         
     def _stepStarted(self, step):
         """This function will be called whenever an step
@@ -786,23 +983,26 @@ class Protocol(Step):
             self.error(errorMsg)
         self.lastStatus = step.getStatus()
         
-        self.__updateStep(step)
         self._stepsDone.increment()
-        self._store(self._stepsDone)
+        self.__updateStep(step)
+        # Do not delay the write if protocol stops
+        if (not doContinue or 
+            time.time() - self._stepsLastWrite >= self.stepsWriteInterval):
+            self._writeSteps()
         
         self.info(magentaStr(step.getStatus().upper()) + ": %s, step %d" %
                   (step.funcName.get(), step._index))
         self.info("  %s" % dt.datetime.strptime(step.endTime.get(),
                                                 "%Y-%m-%d %H:%M:%S.%f"))
-        if step.isFailed() and self.stepsExecutionMode == STEPS_PARALLEL:
+        if step.isFailed() and self.stepsExecutionMode != STEPS_SERIAL:
             # In parallel mode the executor will exit to close
             # all working threads, so we need to close
             self._endRun()
         return doContinue
 
-    def _runSteps(self, startIndex):
-        """ Run all steps defined in self._steps. """
-        self._stepsDone.set(startIndex)
+    def _runSteps(self, stepsDone):
+        """ Run all steps defined in self._steps that are not done. """
+        self._stepsDone.set(stepsDone)
         self._numberOfSteps.set(len(self._steps))
         self.setRunning()
         self._originalRunMode = self.runMode.get() # Keep the original value to set in sub-protocols
@@ -810,7 +1010,22 @@ class Protocol(Step):
         self._store()
         
         self.lastStatus = self.status.get()
-        self._stepsExecutor.runSteps(self._steps, self._stepStarted, self._stepFinished)
+        cache = getResultsCache()
+        if cache is not None:
+            params = self._getParamsValues()
+            for step in self._steps:
+                prerequisites = [self._steps[int(i) - 1] for i in step._prerequisites]
+                step.setResultsCache(cache, self.getClassName(), 
+                                     self.workingDir.get(), params, prerequisites)
+        try:
+            self._stepsExecutor.runSteps(self._steps, self._stepStarted, 
+                                         self._stepFinished)
+        finally:
+            self._writeSteps()
+            if cache is not None:
+                cache.evict()
+                self.info("Results cache: %(hits)d hits, %(misses)d misses, "
+                          "%(stored)d stored, %(evicted)d evicted" % cache.getStats())
         self.setStatus(self.lastStatus)
         self._store(self.status)
         
@@ -889,11 +1104,11 @@ class Protocol(Step):
         #self.__backupSteps() # Prevent from overriden previous stored steps
         self._insertAllSteps() # Define steps for execute later
         #self._makePathsAndClean() This is done now in project
-        startIndex = self.__findStartingStep() # Find at which step we need to start
-        self.info(" Starting at step: %d" % (startIndex + 1))
+        stepsDone = self.__findStartingStep() # Find which steps are already done
+        self.info(" Steps already done: %d of %d" % (stepsDone, len(self._steps)))
         self.__storeSteps() 
         self.info(" Running steps ")
-        self._runSteps(startIndex)
+        self._runSteps(stepsDone)
     
     def _getEnviron(self):
         """ This function should return an environ variable
@@ -1116,7 +1331,7 @@ class Protocol(Step):
         """ Return the package module to which this protocol belongs
         """
         import pyworkflow.em as em
-        em.getProtocols() # make sure the _package is set for each Protocol class
+        em.getClass(cls.__name__) # make sure the _package is set for this class
         return getattr(cls, '_package', scipion)
         
     @classmethod 
@@ -1452,6 +1667,13 @@ def runProtocolMain(projectPath, protDbPath, protId):
         elif protocol.numberOfThreads > 1:
             executor = ThreadStepExecutor(hostConfig,
                                           protocol.numberOfThreads.get()-1) 
+    elif protocol.stepsExecutionMode == STEPS_PROCESSES:
+        if protocol.numberOfThreads > 1:
+            # As with threads, this process counts as one of them
+            executor = ProcessStepExecutor(hostConfig, 
+                                           protocol.numberOfThreads.get()-1,
+                                           projectPath, protDbPath, protId,
+                                           protocol.getClass())
     if executor is None:
         executor = StepExecutor(hostConfig)
     protocol.setStepsExecutor(executor)
@@ -1473,10 +1695,30 @@ def runProtocolMainMPI(projectPath, protDbPath, protId, mpiComm):
     # Finally run the protocol
     protocol.run()        
     
+
+def runFunctionInProcess(projectPath, protDbPath, protId, protClass, 
+                         funcName, funcArgs):
+    """ Run a function of the protocol, this is called from
+    the worker processes of the ProcessStepExecutor. The protocol
+    is loaded from the db, so the outputs stored by previous 
+    steps are available. Return the result of the function.
+    """
+    try:
+        protocol = getProtocolFromDb(projectPath, protDbPath, protId,
+                                     classesDict={protClass.__name__: protClass})
+        protocol.setStepsExecutor(StepExecutor(protocol.getHostConfig()))
+        protocol._log = ScipionLogger(protocol.getLogPaths()[2])
+        return getattr(protocol, funcName)(*funcArgs)
+    except Exception:
+        traceback.print_exc()
+        raise
+    
      
-def getProtocolFromDb(projectPath, protDbPath, protId, chdir=False):
+def getProtocolFromDb(projectPath, protDbPath, protId, chdir=False, 
+                      classesDict=None):
     """ Retrieve the Protocol object from a given .sqlite file
-    and the protocol id.
+    and the protocol id. The classesDict could contain classes 
+    that are not in the em-packages (e.g the protocol class).
     """
     # We need this import here because from Project is imported
     # all from protocol indirectly, so if move this to the top
@@ -1494,6 +1736,8 @@ def getProtocolFromDb(projectPath, protDbPath, protId, chdir=False):
     from pyworkflow.project import Project
     project = Project(projectPath)
     project.load(dbPath=os.path.join(projectPath, protDbPath), chdir=chdir)     
+    if classesDict:
+        project.mapper.dictClasses.update(classesDict)
     protocol = project.getProtocol(protId)
     return protocol
 
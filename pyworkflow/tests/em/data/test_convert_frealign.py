@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:   J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.em.packages.grigoriefflab.convert import (HEADER_LINE, FrealignParFile,
+                                                          splitParFile, mergeParFiles,
+                                                          createBlockPlan)
+
+
+class TestParFiles(BaseTest):
+    
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        
+    def writeParFile(self, filename, particles):
+        f = open(filename, 'w')
+        f.write(HEADER_LINE)
+        for i in particles:
+            f.write("%7d %7.2f %7.2f %7.2f %9.2f %9.2f %7.0f %5d\n" 
+                    % (i, i, 0, 0, 0, 0, 60000, i / 10))
+        f.write("C  Average values\n")
+        f.close()
+        
+    def readParticles(self, filename):
+        parFile = FrealignParFile(filename)
+        particles = [i for i, _ in parFile.iterLines() if i is not None]
+        parFile.close()
+        return particles
+        
+    def test_blockPlan(self):
+        # 5 micrographs in 2 blocks: 3 and 2 micrographs
+        micIdList = [{'_micId': micId, 'count': count}
+                     for micId, count in [(5, 10), (1, 4), (3, 7), (2, 1), (4, 3)]]
+        plan = createBlockPlan(micIdList, 2)
+        self.assertEqual([1, 13], plan['firstParticles'])
+        self.assertEqual([12, 25], plan['lastParticles'])
+        self.assertEqual([5, 1, 3, 2, 4], plan['micIds'])
+        
+    def test_splitMerge(self):
+        parFn = self.getOutputPath('particles.par')
+        self.writeParFile(parFn, range(1, 101))
+        lastParticles = [30, 65, 100]
+        blockFiles = [self.getOutputPath('block%d.par' % b) for b in range(1, 4)]
+        
+        splitParFile(parFn, blockFiles, lastParticles)
+        # Each block contains from the first particle to its last one
+        for fn, last in zip(blockFiles, lastParticles):
+            self.assertEqual(range(1, last + 1), self.readParticles(fn))
+        
+        # Blocks output files contain only their particles
+        for fn, first, last in zip(blockFiles, [1, 31, 66], lastParticles):
+            self.writeParFile(fn, range(first, last + 1))
+        mergedFn = self.getOutputPath('merged.par')
+        mergeParFiles(blockFiles, mergedFn)
+        self.assertEqual(range(1, 101), self.readParticles(mergedFn))
+        self.assertEqual(1, len([l for l in open(mergedFn) if l.startswith('C')]))
@@ -136,3 +136,126 @@ class TestConvertBinaryFiles(BaseTest):
         
         
         
+        
+        
+class TestStarFiles(BaseTest):
+    
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        
+    def test_readWriteStar(self):
+        """ Write a block with the star module and read it back,
+        also with the MetaData class.
+        """
+        import numpy as np
+        from pyworkflow.utils.star import writeStar, readStar, StarReader
+        
+        n = 25
+        columns = {'rlnImageName': np.array(['%06d@particles.mrcs' % (i+1) 
+                                             for i in range(n)], dtype=object),
+                   'rlnDefocusU': np.linspace(10000, 20000, n),
+                   'rlnClassNumber': np.arange(n) % 3 + 1,
+                   'rlnMicrographName': np.array(['mic %d.mrc' % (i % 2) 
+                                                  for i in range(n)], dtype=object)}
+        labels = ['rlnImageName', 'rlnDefocusU', 'rlnClassNumber', 'rlnMicrographName']
+        fnStar = self.getOutputPath('particles.star')
+        writeStar('particles@%s' % fnStar, columns, labels)
+        
+        data = readStar(fnStar, 'particles')
+        self.assertEqual(list(data.dtype.names), labels)
+        self.assertEqual(len(data), n)
+        for label in labels:
+            self.assertTrue(np.all(data[label] == columns[label]))
+        
+        # Read in chunks
+        reader = StarReader('particles@%s' % fnStar, chunkSize=10)
+        self.assertEqual([len(chunk) for chunk in reader.iterChunks()], [10, 10, 5])
+        reader.close()
+        
+        mdStar = md.MetaData('particles@%s' % fnStar)
+        self.assertEqual(mdStar.size(), n)
+        self.assertEqual(mdStar.getColumnValues(md.RLN_MICROGRAPH_NAME), 
+                         list(columns['rlnMicrographName']))
+        self.assertEqual(mdStar.getColumnValues(md.RLN_PARTICLE_CLASS), 
+                         list(columns['rlnClassNumber']))
+        
+    def test_particlesToColumns(self):
+        """ The particles written at once should be the same
+        as the particles written row by row.
+        """
+        acquisition = Acquisition(magnification=60000, voltage=300,
+                                  sphericalAberration=2., amplitudeContrast=0.07)
+        # The acquisition could be set in each particle or only in the set
+        for perParticle in [True, False]:
+            suffix = '_particle' if perParticle else '_set'
+            partSet = SetOfParticles(filename=self.getOutputPath('particles%s.sqlite' % suffix))
+            partSet.setAcquisition(acquisition)
+            partSet.setHasCTF(True)
+            
+            for i in range(10):
+                p = Particle()
+                p.setLocation(i+1, 'particles.stk')
+                p.setCTF(CTFModel(defocusU=10000+i, defocusV=15000+i, defocusAngle=15))
+                if perParticle:
+                    p.setAcquisition(acquisition)
+                coord = Coordinate()
+                coord.setPosition(i*10, i*20)
+                coord.setMicId(i % 3 + 1)
+                p.setCoordinate(coord)
+                partSet.append(p)
+            partSet.write()
+            
+            fnStar = self.getOutputPath('particles_bulk%s.star' % suffix)
+            relion.writeSetOfParticles(partSet, fnStar, self.getOutputPath())
+            self.assertIsNotNone(relion.particlesToColumns(partSet))
+            
+            rowsMd = md.MetaData()
+            relion.setOfImagesToMd(partSet, rowsMd, relion.particleToRow)
+            bulkMd = md.MetaData('Particles@%s' % fnStar)
+            
+            self.assertEqual(bulkMd.size(), rowsMd.size())
+            for label in [md.RLN_CTF_VOLTAGE, md.RLN_CTF_CS, md.RLN_CTF_Q0]:
+                self.assertTrue(bulkMd.containsLabel(label))
+            for label in rowsMd.getActiveLabels():
+                self.assertEqual(bulkMd.getColumnValues(label), 
+                                 rowsMd.getColumnValues(label), 
+                                 "Different values for label %s" % md.label2Str(label))
+
+    def test_alignmentToColumns(self):
+        """ The alignment of all particles converted at once should 
+        be the same as converting the transform of each particle.
+        """
+        import numpy as np
+        from pyworkflow.em.data import Transform
+        from pyworkflow.em.constants import ALIGN_2D, ALIGN_PROJ
+        
+        np.random.seed(23)
+        partSet = SetOfParticles(filename=self.getOutputPath('particles_align.sqlite'))
+        shifts = 10 * np.random.random((20, 3))
+        angles = 360 * np.random.random((20, 3)) - 180
+        matrices = relion.matricesFromGeometry(shifts, angles, True)
+        
+        for m in matrices:
+            p = Particle()
+            p.setLocation(1, 'particles.stk')
+            p.setTransform(Transform(m))
+            partSet.append(p)
+        partSet.write()
+        
+        for alignType in [ALIGN_2D, ALIGN_PROJ]:
+            columns = relion.alignmentToColumns(partSet, alignType)
+            for i, p in enumerate(partSet):
+                row = md.Row()
+                relion.alignmentToRow(p.getTransform(), row, alignType)
+                self.assertEqual(sorted(columns.keys()), sorted(l for l, _ in row))
+                for label, value in row:
+                    self.assertAlmostEqual(columns[label][i], value, 5)
+                
+        # Back to matrices from the batch geometry
+        shifts2, angles2 = relion.geometryFromMatrices(matrices, True)
+        self.assertTrue(np.allclose(relion.matricesFromGeometry(shifts2, angles2, True), 
+                                    matrices))
+        for m, s, a in zip(matrices, shifts2, angles2):
+            s1, a1 = relion.geometryFromMatrix(m, True)
+            self.assertTrue(np.allclose(s, s1) and np.allclose(a, a1))
@@ -10,7 +10,7 @@ import os, traceback
 from itertools import izip
 from pyworkflow.tests import *
 from pyworkflow.em.data import *
-from pyworkflow.utils.path import makePath
+from pyworkflow.utils.path import makePath, copyFile
 from pyworkflow.em.packages.xmipp3.convert import *
 import pyworkflow.em.packages.eman2.convert as e2convert
 from pyworkflow.em.protocol import EMProtocol
@@ -205,7 +205,90 @@ class TestSetOfParticles(BaseTest):
             #img.setObjId(None)
             
         imgSet.write()
-        
+
+    def test_hugeSetBulk(self):
+        """ Same as test_hugeSet but using the bulkAppend mode. """
+        n = int(os.environ.get('SCIPION_TEST_HUGE', 10000))
+        print ">>>> Creating a set of %d particles (bulk mode)." % n
+
+        dbFn = self.getOutputPath('huge_set_bulk.sqlite')
+
+        img = Particle()
+        imgSet = SetOfParticles(filename=dbFn)
+        imgSet.setSamplingRate(1.0)
+
+        with imgSet.bulkAppend(batchSize=1000):
+            for i in range(1, n+1):
+                img.setLocation(i, "images.stk")
+                imgSet.append(img)
+                img.cleanObjId()
+
+        imgSet.write()
+        imgSet.close()
+
+        imgSet2 = SetOfParticles(filename=dbFn)
+        self.assertEqual(n, imgSet2.getSize())
+        self.assertEqual((n, "images.stk"), imgSet2[n].getLocation())
+
+    def test_columnArrays(self):
+        """ Write and read particles attributes as numpy arrays. """
+        n = 100
+        imgSet = SetOfParticles(filename=self.getOutputPath('arrays.sqlite'))
+        img = Particle()
+        img.setLocation(1, 'images.stk')
+        img.setSamplingRate(1.0)
+
+        indexes = np.arange(1, n+1)
+        micIds = indexes % 5
+        imgSet.appendFromArrays({'_index': indexes, '_micId': micIds}, item=img)
+        self.assertEqual(n, imgSet.getSize())
+        imgSet.write()
+
+        ids, indexes2, sampling = imgSet.getColumnArrays(['id', '_index', '_samplingRate'])
+        self.assertTrue(np.array_equal(indexes, ids))
+        self.assertTrue(np.array_equal(indexes, indexes2))
+        self.assertEqual(np.int64, indexes2.dtype)
+        self.assertTrue(np.allclose(sampling, 1.0))
+
+        micIndexes, = imgSet.getColumnArrays(['_index'], where='_micId=2')
+        self.assertTrue(np.array_equal(indexes[micIds == 2], micIndexes))
+        imgSet.close()
+
+    def test_idsAndJoin(self):
+        """ Select items by ids and join movie particles with particles. """
+        partSet = SetOfParticles(filename=self.getOutputPath('join_particles.sqlite'))
+        movieSet = SetOfMovieParticles(filename=self.getOutputPath('join_movies.sqlite'))
+        part = Particle()
+        part.setLocation(1, 'images.stk')
+        moviePart = MovieParticle()
+        moviePart.setLocation(1, 'movies.stk')
+
+        for partId in range(1, 11):
+            if partId % 3: # particles 3, 6 and 9 were discarded
+                part.setObjId(partId)
+                part.setIndex(partId)
+                partSet.append(part)
+            for frameId in range(4):
+                moviePart.cleanObjId()
+                moviePart.setParticleId(partId)
+                moviePart.setFrameId(frameId)
+                movieSet.append(moviePart)
+        partSet.write()
+        movieSet.write()
+
+        self.assertEqual([True, False, True, False], partSet.hasIds([1, 3, 5, 11]))
+        self.assertEqual([5, 2], [p.getObjId() for p in
+                                  partSet.getItemsByIds([6, 5, 2, 11], direction='DESC')])
+
+        pairs = [(mp.getParticleId(), mp.getFrameId(), p.getObjId(), p.getIndex())
+                 for mp, p in movieSet.join(partSet, on='_particleId')]
+        self.assertEqual(4 * 7, len(pairs))
+        for partId, frameId, pId, index in pairs:
+            self.assertTrue(partId == pId == index)
+            self.assertTrue(partId % 3)
+        partSet.close()
+        movieSet.close()
+
     def test_hugeSetToMd(self):
         """ Just as a bencharmark comparing to test_hugeSet ."""
         # Allow what huge means to be defined with environment var
@@ -333,9 +416,148 @@ class TestSetOfClasses2D(BaseTest):
             self.assertEqual(cls.getSize(), sizes[i])
         clsSet.clear() # Close db connection and clean data
 
+    def test_singleTable(self):
+        """ Classify particles storing the items of all classes 
+        in a single table, and read them back as classes.
+        """
+        partSet = SetOfParticles(filename=self.getOutputPath('particles.sqlite'))
+        partSet.setSamplingRate(1.0)
+        for i in range(1, 31):
+            part = Particle()
+            part.setLocation(i, 'particles.stk')
+            partSet.append(part)
+        partSet.write()
+        
+        def updateItem(item, row):
+            item.setClassId(item.getObjId() % 3 + 1)
+        
+        SetOfClasses2D.setSingleTable(True)
+        try:
+            classesFn = self.getOutputPath('classes_single.sqlite')
+            classes2DSet = SetOfClasses2D(filename=classesFn)
+            classes2DSet.setImages(partSet)
+            classes2DSet.classifyItems(updateItemCallback=updateItem)
+            classes2DSet.write()
+            classes2DSet.close()
+        finally:
+            SetOfClasses2D.setSingleTable(False)
+        
+        # The layout is read from the file
+        classes2DSet = SetOfClasses2D(filename=classesFn)
+        self.assertTrue(classes2DSet.isSingleTable())
+        self.assertEqual(classes2DSet.getClassSizes(), {1: 10, 2: 10, 3: 10})
+        
+        classIds = {1: range(3, 31, 3), 2: range(1, 31, 3), 3: range(2, 31, 3)}
+        for cls in classes2DSet:
+            self.assertEqual(cls.getSize(), 10)
+            self.assertEqual([img.getObjId() for img in cls], 
+                             classIds[cls.getObjId()])
+        
+        cls2 = classes2DSet[2]
+        self.assertEqual(cls2.getSize(), 10)
+        self.assertEqual(cls2.getFirstItem().getObjId(), 1)
+        self.assertEqual(cls2.hasIds([1, 2, 4]), [True, False, True])
+        
+    def test_migrateToSingleTable(self):
+        """ Migrate a SetOfClasses2D stored with a table per 
+        class to the single table layout.
+        """
+        classesFn = self.getOutputPath('classes_migrated.sqlite')
+        copyFile(self.selectionFn, classesFn)
+        
+        classes2DSet = SetOfClasses2D(filename=classesFn)
+        self.assertFalse(classes2DSet.isSingleTable())
+        legacyIds = [[(img.getObjId(), img.isEnabled()) for img in cls] 
+                     for cls in classes2DSet]
+        classes2DSet.migrateToSingleTable()
+        classes2DSet.close()
+        
+        classes2DSet = SetOfClasses2D(filename=classesFn)
+        self.assertTrue(classes2DSet.isSingleTable())
+        self.assertEqual([[(img.getObjId(), img.isEnabled()) for img in cls] 
+                          for cls in classes2DSet], legacyIds)
+        
+        imgSet = SetOfParticles(filename=':memory:')
+        imgSet.appendFromClasses(classes2DSet)
+        self.assertEqual(imgSet.getSize(), 68)
+        imgSet.clear()
+
+    def test_migrateFailure(self):
+        """ If the migration fails after some classes have been moved,
+        the set should be kept in the legacy layout with all its items
+        and the migration could be done again.
+        """
+        from pyworkflow.mapper.sqlite import SqliteFlatMapper
+        classesFn = self.getOutputPath('classes_failed.sqlite')
+        copyFile(self.selectionFn, classesFn)
+
+        classes2DSet = SetOfClasses2D(filename=classesFn)
+        legacyIds = [[img.getObjId() for img in cls] for cls in classes2DSet]
+
+        def failingMapper(fn, classesDict, tablePrefix=''):
+            if tablePrefix == 'Class003': # fail after the second class
+                raise Exception("Injected failure")
+            return SqliteFlatMapper(fn, classesDict, tablePrefix)
+
+        classes2DSet._MapperClass = failingMapper
+        self.assertRaises(Exception, classes2DSet.migrateToSingleTable)
+        classes2DSet.close()
+
+        classes2DSet = SetOfClasses2D(filename=classesFn)
+        self.assertFalse(classes2DSet.isSingleTable())
+        self.assertEqual([[img.getObjId() for img in cls]
+                          for cls in classes2DSet], legacyIds)
+
+        classes2DSet.migrateToSingleTable()
+        classes2DSet.close()
+
+        classes2DSet = SetOfClasses2D(filename=classesFn)
+        self.assertTrue(classes2DSet.isSingleTable())
+        self.assertEqual([[img.getObjId() for img in cls]
+                          for cls in classes2DSet], legacyIds)
+
+
+class TestImageHandler(BaseTest):
+    
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        
+    def test_readWriteStack(self):
+        """ Write stacks with numpy and read them back. """
+        import numpy
+        ih = ImageHandler()
+        data = numpy.arange(5 * 16 * 12, dtype='float32').reshape((5, 16, 12))
+        
+        for ext in ['mrcs', 'stk']:
+            fn = self.getOutputPath('stack.%s' % ext)
+            ih.writeStack(data, fn)
+            self.assertTrue(numpy.array_equal(data, ih.readStack(fn)))
+            self.assertTrue(numpy.array_equal(data[1:3], ih.readStack(fn, [2, 3])))
+            self.assertTrue(numpy.array_equal(data[[4, 0]], ih.readStack(fn, [5, 1])))
+        
+        imgSet = SetOfParticles(filename=':memory:')
+        img = Particle()
+        for i in [3, 1]:
+            img.setLocation(i, self.getOutputPath('stack.stk'))
+            imgSet.append(img)
+            img.cleanObjId()
+        fn = self.getOutputPath('subset.mrcs')
+        imgSet.writeStack(fn)
+        self.assertTrue(numpy.array_equal(data[[2, 0]], ih.readStack(fn)))
+        
+        # SPIDER files could also be big endian
+        fn = self.getOutputPath('stack_big.stk')
+        numpy.fromfile(self.getOutputPath('stack.stk'), dtype='<f4').astype('>f4').tofile(fn)
+        self.assertTrue(numpy.array_equal(data, ih.readStack(fn)))
+        
 
 class TestTransform(BaseTest):
 
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
     def test_scale(self):
         """ Check Scale storage in transformation class
         """
@@ -388,6 +610,181 @@ class TestTransform(BaseTest):
         m3 = p2.getTransform().getMatrix()
         self.assertTrue(np.allclose(m, m3, rtol=1e-2)) 
 
+    def test_binaryStorage(self):
+        """ Check that matrices stored as binary blobs and 
+        as json text are both read properly from a set.
+        """
+        fn = self.getOutputPath('binary_matrix.sqlite')
+        imgSet = SetOfParticles(filename=fn)
+        p = Particle()
+        
+        for binary in [False, True]:
+            Matrix.setBinaryStorage(binary)
+            t = Transform()
+            t.getMatrix()[0, 3] = 10 + int(binary)
+            p.setLocation(1, 'particles.stk')
+            p.setTransform(t)
+            imgSet.append(p)
+            p.cleanObjId()
+        Matrix.setBinaryStorage(False)
+        imgSet.write()
+        imgSet.close()
+        
+        imgSet2 = SetOfParticles(filename=fn)
+        shifts = [img.getTransform().getMatrix()[0, 3] for img in imgSet2]
+        self.assertEqual([10, 11], shifts)
+        # Check the matrix read from a blob can be modified
+        img = imgSet2[2]
+        img.getTransform().scaleShifts2D(2)
+        self.assertAlmostEqual(22, img.getTransform().getMatrix()[0, 3])
+
+    def test_batchConversions(self):
+        """ The vectorized conversions between matrices and euler angles
+        should give the same results as the scalar ones, for random 
+        angles (also in the degenerated cases) and all axes sequences.
+        """
+        import math
+        import pyworkflow.em.transformations as tfs
+        
+        np.random.seed(17)
+        for axes, (_, _, repetition, _) in tfs._AXES2TUPLE.iteritems():
+            angles = (4 * math.pi) * (np.random.random((100, 3)) - 0.5)
+            # Gimbal lock for every 5 matrices
+            angles[::5, 1] = 0 if repetition else math.pi / 2
+            matrices = tfs.euler_matrices(angles[:, 0], angles[:, 1], angles[:, 2], axes)
+            matrices[:, :3, 3] = np.random.random((100, 3))
+            
+            for a, m in izip(angles, matrices):
+                m2 = tfs.euler_matrix(a[0], a[1], a[2], axes)
+                self.assertTrue(np.allclose(m[:3, :3], m2[:3, :3]), axes)
+                
+            eulers = tfs.euler_from_matrices(matrices, axes)
+            self.assertEqual(eulers.shape, (100, 3))
+            for e, m in izip(eulers, matrices):
+                self.assertTrue(np.allclose(e, tfs.euler_from_matrix(m, axes)), axes)
+
+            self.assertTrue(np.allclose(tfs.translations_from_matrices(matrices),
+                                        [tfs.translation_from_matrix(m) for m in matrices]))
+
+    def test_transformMatrices(self):
+        """ Check that all matrices of a set are read at once, from
+        json text and binary values, and nan for images without transform.
+        """
+        imgSet = SetOfParticles(filename=self.getOutputPath('transform_matrices.sqlite'))
+        noAlignSet = SetOfParticles(filename=self.getOutputPath('no_transform.sqlite'))
+        p = Particle()
+        p.setLocation(1, 'particles.stk')
+        
+        ids, matrices = imgSet.getTransformMatrices()
+        self.assertEqual(matrices.shape, (0, 4, 4))
+        
+        expected = []
+        for i in range(6):
+            noAlignSet.append(p)
+            p.cleanObjId()
+            Matrix.setBinaryStorage(i % 2 == 0)
+            m = np.random.random((4, 4))
+            p.setTransform(Transform(m))
+            expected.append(m)
+            imgSet.append(p)
+            p.cleanObjId()
+            p.setTransform(None)
+        Matrix.setBinaryStorage(False)
+        imgSet.write()
+        noAlignSet.write()
+        
+        ids, matrices = imgSet.getTransformMatrices()
+        self.assertEqual(list(ids), range(1, 7))
+        self.assertTrue(np.allclose(matrices, expected))
+        
+        ids, matrices = imgSet.getTransformMatrices(direction='DESC', where='id > 3')
+        self.assertEqual(list(ids), [6, 5, 4])
+        self.assertTrue(np.allclose(matrices, expected[:2:-1]))
+        
+        ids, matrices = noAlignSet.getTransformMatrices()
+        self.assertEqual(list(ids), range(1, 7))
+        self.assertTrue(np.isnan(matrices).all())
+        imgSet.close()
+        noAlignSet.close()
+
+
+class TestSpatialIndex(BaseTest):
+    
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        
+    def test_queries(self):
+        from pyworkflow.em.spatial import SpatialIndex, mergeClosePoints
+        points = np.random.uniform(0, 500, (1000, 2))
+        queries = np.random.uniform(-20, 520, (300, 2))
+        dist = np.sqrt(np.sum((queries[:, None] - points[None])**2, axis=2))
+        index = SpatialIndex(points, 10)
+        
+        for radius in [3, 10, 25]:
+            queryIdx, pointIdx, _ = index.queryPairs(queries, radius)
+            self.assertEqual(set(zip(*np.nonzero(dist < radius))), 
+                             set(zip(queryIdx, pointIdx)))
+            nearest, _ = index.nearestIndexes(queries, radius)
+            close = dist.min(axis=1) < radius
+            self.assertTrue(np.all(nearest[close] == dist.argmin(axis=1)[close]))
+            self.assertTrue(np.all(nearest[~close] == -1))
+        
+        self.assertIsNone(index.nearest([-100, -100], 5))
+        
+        points, votes = mergeClosePoints([[[1, 1], [50, 50]], [[3, 3], [90, 90]]], 10)
+        self.assertEqual([2, 1, 1], votes.tolist())
+        self.assertEqual([2, 2], points[0].tolist())
+        
+    def test_coordinatesIndex(self):
+        coordSet = SetOfCoordinates(filename=self.getOutputPath('coordinates.sqlite'))
+        coordSet.setBoxSize(20)
+        for micId in [1, 2]:
+            for x, y in [(10, 10), (15, 10), (100, 100)]:
+                coord = Coordinate(x=x, y=y)
+                coord.setMicId(micId)
+                coordSet.append(coord)
+        coordSet.write()
+        
+        index = coordSet.buildSpatialIndex(2)
+        self.assertEqual(3, len(index))
+        self.assertEqual([4, 5], index.queryRadius((12, 10), 10).tolist())
+        self.assertEqual(6, index.nearest((95, 95), 10))
+
+
+class TestAngularDistribution(BaseTest):
+    
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        
+    def test_binDirections(self):
+        from pyworkflow.em.angdist import binDirections, loadAngularBins, getBinsFile
+        rot = [10, 10.5, 190.5, 100, 30]
+        tilt = [91, 91.5, -91, 0.2, 179.9]
+        binRot, binTilt, binWeight = binDirections(rot, tilt, step=2)
+        # The first three are the same direction, mapped to the same bin
+        self.assertEqual(3, len(binWeight))
+        self.assertEqual(5, binWeight.sum())
+        self.assertEqual(3, binWeight.max())
+        self.assertTrue(all((binTilt >= 0) & (binTilt <= 180)))
+        
+        fn = self.getOutputPath('projections.sqlite')
+        angMd = md.MetaData()
+        for r, t in zip(rot, tilt):
+            row = md.Row()
+            row.setValue(md.MDL_ANGLE_ROT, float(r))
+            row.setValue(md.MDL_ANGLE_TILT, float(t))
+            row.setValue(md.MDL_WEIGHT, 0.5)
+            row.writeToMd(angMd, angMd.addObject())
+        angMd.write(fn)
+        
+        binWeight = loadAngularBins(fn, step=2)[2]
+        self.assertTrue(os.path.exists(getBinsFile(fn)))
+        self.assertAlmostEqual(1.5, binWeight.max())
+        # Read again from the cached bins
+        self.assertAlmostEqual(2.5, loadAngularBins(fn, step=2)[2].sum())
+
 
 if __name__ == '__main__':
 #    suite = unittest.TestLoader().loadTestsFromName('test_data_xmipp.TestXmippCTFModel.testConvertXmippCtf')
@@ -56,7 +56,86 @@ class TestSqliteMapper(BaseTest):
         self.assertEqual(tables, db.getTables())
         
         db.close()
-        
+
+    def test_connectionPool(self):
+        """ Check that connections are reused in the same thread,
+        but not between different threads. """
+        import threading
+        from pyworkflow.mapper.sqlite_db import SqliteDb, SqliteConnectionPool
+        fn = self.getOutputPath("pool.sqlite")
+        pool = SqliteConnectionPool(maxSize=1)
+        db1, db2 = SqliteDb(), SqliteDb()
+        self.assertEqual(pool.getConnection(fn, 1000, db1),
+                         pool.getConnection(fn, 1000, db2))
+        self.assertEqual(1, pool.getStats()['hits'])
+
+        connections = []
+        def getConnection():
+            db = SqliteDb()
+            connections.append(pool.getConnection(fn, 1000, db))
+            pool.releaseConnection(connections[0], db)
+        thread = threading.Thread(target=getConnection)
+        thread.start()
+        thread.join()
+        self.assertNotEqual(connections[0], pool.getConnection(fn, 1000, db1))
+        # The connection of the thread is not in use, so it was evicted
+        stats = pool.getStats()
+        self.assertEqual((1, 1), (stats['size'], stats['evictions']))
+
+        # A connection released while the same thread is changing the pool
+        # (e.g. from a __del__) should not block, it is released afterwards
+        db3 = SqliteDb()
+        connection = pool.getConnection(fn, 1000, db3)
+        with pool._locked():
+            pool.releaseConnection(connection, db3)
+            self.assertEqual(1, len(pool._deferred))
+        self.assertEqual([], pool._deferred)
+
+    def test_dbSignature(self):
+        """ Check that the signature of a db changes after an update
+        even if the size and the mtime of the file are the same. """
+        from pyworkflow.mapper.sqlite_db import getDbSignature
+        fn = self.getOutputPath("signature.sqlite")
+        mapper = SqliteMapper(fn, globals())
+        c = Complex.createComplex()
+        mapper.insert(c)
+        mapper.commit()
+        st = os.stat(fn)
+        signature = getDbSignature(fn)
+
+        c.real.set(c.real.get() + 1)
+        mapper.store(c)
+        mapper.commit()
+        os.utime(fn, (st.st_atime, st.st_mtime))
+        self.assertEqual(st.st_size, os.path.getsize(fn))
+        self.assertNotEqual(signature, getDbSignature(fn))
+        self.assertIsNone(getDbSignature(self.getOutputPath("missing.sqlite")))
+        mapper.close()
+
+    def test_dbSignatureWal(self):
+        """ In WAL mode the commits are written to the -wal file, 
+        the signature should change even if the db file does not. """
+        from pyworkflow.mapper.sqlite_db import (SqliteDb, SqliteConnectionPool,
+                                                 getDbSignature)
+        fn = self.getOutputPath("signature_wal.sqlite")
+        pool = SqliteConnectionPool(walMode=True)
+        db = SqliteDb()
+        connection = pool.getConnection(fn, 1000, db)
+        connection.execute("CREATE TABLE Items (id INTEGER PRIMARY KEY, value INTEGER)")
+        connection.execute("INSERT INTO Items (value) VALUES (1)")
+        connection.commit()
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        with open(fn, 'rb') as f:
+            dbContent = f.read()
+        signature = getDbSignature(fn)
+
+        connection.execute("UPDATE Items SET value=2")
+        connection.commit()
+        with open(fn, 'rb') as f:
+            self.assertEqual(dbContent, f.read())
+        self.assertNotEqual(signature, getDbSignature(fn))
+        pool.closeConnections(fn)
+
     def test_SqliteMapper(self):
         fn = self.getOutputPath("basic.sqlite")
         fnGold = self.modelGoldSqlite
@@ -191,9 +270,54 @@ class TestSqliteMapper(BaseTest):
         #Check the mapper was properly stored when
         # set to None and the _extended property cleanned
         self.assertIsNone(p2.get())
-        
-        
-        
+
+    def test_indexes(self):
+        """ Check the hierarchy queries use indexes and return
+        the right objects. """
+        fn = self.getOutputPath("indexes.sqlite")
+        mapper = SqliteMapper(fn, globals())
+        for i in range(3):
+            mapper.insert(Complex.createComplex())
+        mapper.insert(Integer(1))
+        mapper.commit()
+
+        db = mapper.db
+        db.executeCommand("EXPLAIN QUERY PLAN " +
+                          db.selectCmd(db.ANCESTOR_WHERE), ('1.', '1/'))
+        plan = ' '.join(str(row[-1]) for row in db.cursor.fetchall())
+        self.assertTrue('Objects_name_index' in plan)
+
+        self.assertEqual(3, len(mapper.selectByClass('Complex')))
+        c = mapper.selectByClass('Complex')[0]
+        self.assertEqual(2, len(db.selectObjectsByAncestor(c.strId())))
+        mapper.deleteChilds(c)
+        self.assertEqual(0, len(db.selectObjectsByAncestor(c.strId())))
+
+    def test_changes(self):
+        """ Check the changes journal registers the root objects
+        that are modified. """
+        fn = self.getOutputPath("changes.sqlite")
+        mapper = SqliteMapper(fn, globals())
+        complexList = [Complex.createComplex() for _ in range(3)]
+        for c in complexList:
+            mapper.insert(c)
+        mapper.commit()
+
+        lastChange = mapper.getLastChange()
+        self.assertEqual([], mapper.getChangesSince(lastChange))
+        c0, c1, c2 = complexList
+        c1.real.set(5)
+        mapper.store(c1.real) # a child change is registered for its root
+        mapper.delete(c0)
+        changedIds = [objId for objId, _ in mapper.getChangesSince(lastChange)]
+        self.assertEqual([c1.getObjId(), c0.getObjId()], changedIds)
+
+        objs = mapper.selectByIds(changedIds)
+        self.assertEqual(1, len(objs))
+        self.assertEqual(5, objs[0].real.get())
+
+
+
 class TestSqliteFlatMapper(BaseTest):
     """ Some tests for DataSet implementation. """
 
@@ -243,6 +367,50 @@ class TestSqliteFlatMapper(BaseTest):
         self.assertEqual(mapper2.getProperty('samplingRate'), '3.0')
         self.assertEqual(mapper2.getProperty('defocusU'), '2000')
         
+    def test_createIndex(self):
+        dbName = self.getOutputPath('indexes.sqlite')
+        print ">>> test_createIndex: dbName = '%s'" % dbName
+        mapper = SqliteFlatMapper(dbName, globals())
+        # Index is only declared, it will be built on commit
+        mapper.createIndex('_filename')
+        self.assertEqual([], mapper.getIndexes())
+
+        for i in range(10):
+            img = Image()
+            img.setLocation(i+1, 'images%d.stk' % (i % 2))
+            mapper.store(img)
+        mapper.commit()
+        self.assertEqual(['_filename'], mapper.getIndexes())
+        mapper.close()
+
+        # Check the index is there when reading and used in queries
+        mapper2 = SqliteFlatMapper(dbName, globals())
+        self.assertEqual(['_filename'], mapper2.getIndexes())
+        indexes = [img.getIndex() for img in
+                   mapper2.selectAll(where='_filename="images1.stk"')]
+        self.assertEqual([2, 4, 6, 8, 10], indexes)
+        mapper2.close()
+
+    def test_selectAllReuse(self):
+        dbName = self.getOutputPath('reuse.sqlite')
+        print ">>> test_selectAllReuse: dbName = '%s'" % dbName
+        mapper = SqliteFlatMapper(dbName, globals())
+
+        for i in range(10):
+            img = Image()
+            img.setLocation(i+1, 'images.stk')
+            mapper.store(img)
+        mapper.commit()
+
+        # By default the same object is filled for every row
+        imgs = list(mapper.selectAll())
+        self.assertTrue(all(img is imgs[0] for img in imgs))
+        self.assertEqual(10, imgs[0].getIndex())
+        # With reuse=False, each row is a new object
+        imgs = list(mapper.selectAll(reuse=False))
+        self.assertEqual(range(1, 11), [img.getIndex() for img in imgs])
+        mapper.close()
+
     def test_downloads(self):
         dbName = self.getOutputPath('downloads.sqlite')
         #dbName = '/tmp/downloads.sqlite'
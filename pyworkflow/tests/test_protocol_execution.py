@@ -24,13 +24,17 @@
 # *
 # **************************************************************************
 
+import os
 from pyworkflow.object import *
 from pyworkflow.em import *
 from tests import *
 from pyworkflow.mapper import SqliteMapper
 from pyworkflow.utils import dateStr
 from pyworkflow.protocol.constants import MODE_RESUME, STATUS_FINISHED
-from pyworkflow.protocol.executor import StepExecutor
+from pyworkflow.protocol.executor import (StepExecutor, ThreadStepExecutor,
+                                          ProcessStepExecutor)
+from pyworkflow.protocol.protocol import Step, FunctionStep, getProtocolFromDb
+from pyworkflow.protocol.cache import ResultsCache
 
     
 #Protocol for tests, runs in resume mode, and sleeps for??
@@ -65,6 +69,55 @@ class MyParallelProtocol(MyProtocol):
         for i in range(n):
             self._insertFunctionStep('sleepStep')
     
+
+class MyResumeProtocol(MyProtocol):
+    """ Protocol that registers the steps run and reads an input file. """
+    def __init__(self, **args):
+        MyProtocol.__init__(self, **args)
+        self.inputFile = String(args.get('inputFile', None))
+        self._stepsRun = []
+        
+    def countStep(self, i, fn):
+        self._stepsRun.append(i)
+        
+    def _insertAllSteps(self):
+        # The input file is in the arguments string, as in runJob steps
+        step1 = self._insertFunctionStep('countStep', 0, '-i %s' % self.inputFile.get())
+        for i in range(1, self.numberOfSleeps.get()):
+            self._insertFunctionStep('countStep', i, 'x', prerequisites=[step1])
+            
+
+class MyProcessProtocol(MyProtocol):
+    """ Protocol with steps run in other processes and a step
+    (run in the main process) that defines the output. """
+    def squareStep(self, i):
+        fn = self._getExtraPath('square_%02d.txt' % i)
+        f = open(fn, 'w')
+        f.write('%d %d' % (i * i, os.getpid()))
+        f.close()
+        return [fn]
+    
+    def createOutputStep(self):
+        total = 0
+        for i in range(1, self.numberOfSleeps.get() + 1):
+            total += int(open(self._getExtraPath('square_%02d.txt' % i)).read().split()[0])
+        self._defineOutputs(outputSum=Integer(total))
+        
+    def _insertAllSteps(self):
+        deps = [self._insertFunctionStep('squareStep', i + 1) 
+                for i in range(self.numberOfSleeps.get())]
+        self._insertFunctionStep('createOutputStep', prerequisites=deps)
+        
+
+class MyStep(Step):
+    """ Step that registers its index in a list when run. """
+    def __init__(self, order, **kwargs):
+        Step.__init__(self, **kwargs)
+        self._order = order
+
+    def _run(self):
+        self._order.append(self._index)
+
             
 class TestProtocolExecution(BaseTest):
 
@@ -93,6 +146,189 @@ class TestProtocolExecution(BaseTest):
                          prot2._steps[1]._status.get())
         # TODO: prot2._steps is an empty list (so the last line fails). Why?
 
+    def test_ThreadStepExecutor(self):
+        """ Test that steps run after its prerequisites and
+        following the priority of the ready ones. """
+        order = []
+        steps = []
+        # Step 1 should be first, then steps 2-4 by priority
+        # and step 5 after all of them
+        for i, priority in enumerate([0, 1, 3, 2, 0]):
+            step = MyStep(order)
+            step._index = i + 1
+            step.setPriority(priority)
+            steps.append(step)
+        for step in steps[1:4]:
+            step._prerequisites.append(1)
+        steps[4]._prerequisites += [2, 3, 4]
+        
+        started = []
+        def stepStarted(step):
+            started.append(step._index)
+        executor = ThreadStepExecutor(hostConfig=None, nThreads=1)
+        executor.runSteps(steps, stepStarted, lambda step: True)
+        
+        self.assertTrue(all(s.isFinished() for s in steps))
+        self.assertEqual([1, 3, 4, 2, 5], started)
+        self.assertEqual([1, 3, 4, 2, 5], order)
+
+    def test_resumeSteps(self):
+        """ Test that only the steps with a changed fingerprint,
+        and the ones depending on them, are run again on resume. """
+        fn = self.getOutputPath("protocol_resume.sqlite")
+        inputFile = self.getOutputPath("resume_input.txt")
+        workingDir = self.getOutputPath("resume")
+        makePath(workingDir)
+        open(inputFile, 'w').write('1')
+        mapper = SqliteMapper(fn, globals())
+        
+        def runProtocol(n):
+            prot = MyResumeProtocol(mapper=mapper, n=n, inputFile=inputFile,
+                                    workingDir=workingDir)
+            prot._stepsExecutor = StepExecutor(hostConfig=None)
+            prot.run()
+            return prot._stepsRun
+        
+        self.assertEqual([0, 1, 2], runProtocol(3))
+        self.assertEqual([], runProtocol(3))
+        self.assertEqual([3], runProtocol(4))
+        # Changing the input file should invalidate all steps
+        open(inputFile, 'w').write('22')
+        self.assertEqual([0, 1, 2, 3], runProtocol(4))
+
+    def test_resultsCache(self):
+        """ Test that result files are reused in other working dirs
+        and that the cache size is limited. """
+        cache = ResultsCache(self.getOutputPath("results_cache"), 1024)
+        inputFile = self.getOutputPath("cache_input.txt")
+        open(inputFile, 'w').write('1')
+        wd1 = self.getOutputPath("cache_run1")
+        wd2 = self.getOutputPath("cache_run2")
+        makePath(wd1, wd2)
+        
+        args1 = (inputFile, join(wd1, 'out.txt'))
+        key = cache.getKey('MyProtocol', 'countStep', args1, wd1)
+        self.assertIsNone(cache.restore(key, wd1))
+        open(args1[1], 'w').write('result')
+        self.assertTrue(cache.store(key, wd1, [args1[1]]))
+        # The working dir is not part of the key
+        args2 = (inputFile, join(wd2, 'out.txt'))
+        key2 = cache.getKey('MyProtocol', 'countStep', args2, wd2)
+        self.assertEqual(key, key2)
+        self.assertEqual([join(wd2, 'out.txt')], cache.restore(key2, wd2))
+        self.assertEqual('result', open(join(wd2, 'out.txt')).read())
+        # Restored files are copies, writing them does not change other runs
+        open(join(wd2, 'out.txt'), 'w').write('changed')
+        self.assertEqual('result', open(args1[1]).read())
+        # The protocol params are part of the key
+        self.assertNotEqual(key, cache.getKey('MyProtocol', 'countStep', args2, 
+                                              wd2, [('n', 3)]))
+        # and the input files too
+        open(inputFile, 'w').write('22')
+        self.assertNotEqual(key, cache.getKey('MyProtocol', 'countStep', args2, wd2))
+        self.assertEqual({'hits': 1, 'misses': 1, 'stored': 1, 'evicted': 0},
+                         cache.getStats())
+        # The keys of the prerequisites steps are part of the key
+        self.assertNotEqual(cache.getKey('MyProtocol', 'countStep', args2, wd2, None, ['a']),
+                            cache.getKey('MyProtocol', 'countStep', args2, wd2, None, ['b']))
+        # and the content of the files of the working dir in the arguments
+        cmd = '-i %s -o out.txt'
+        for wd, content in [(wd1, 'images'), (wd2, 'images')]:
+            open(join(wd, 'images.xmd'), 'w').write(content)
+        key1 = cache.getKey('MyProtocol', 'runJob', cmd % join(wd1, 'images.xmd'), wd1)
+        self.assertEqual(key1, cache.getKey('MyProtocol', 'runJob', 
+                                            cmd % join(wd2, 'images.xmd'), wd2))
+        open(join(wd2, 'images.xmd'), 'w').write('other images')
+        self.assertNotEqual(key1, cache.getKey('MyProtocol', 'runJob', 
+                                               cmd % join(wd2, 'images.xmd'), wd2))
+        # Steps depending on steps that can not be keyed are not cached
+        step = FunctionStep(lambda: None, 'noResults')
+        step.setResultsCache(cache, 'MyProtocol', wd1, prerequisites=[Step()])
+        step.run()
+        self.assertTrue(step.isFinished())
+        self.assertIsNone(step.getCacheKey())
+        
+        cache.maxSize = 0
+        cache.evict()
+        self.assertIsNone(cache.restore(key, wd1))
+
     def test_MpiStepExecutor(self):
         """ Test the execution of a protocol steps with MPI. """
         pass  # TODO: this function
+
+
+class TestProtocolDb(BaseTest):
+    
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        
+    def test_runDbClosure(self):
+        """ Check that the run db only contains the objects needed
+        by the protocol and that the protocol can be loaded from it. """
+        prot1 = self.newProtocol(ProtImportMicrographs)
+        self.saveProtocol(prot1)
+        prot1.makePathsAndClean()
+        micSet = prot1._createSetOfMicrographs()
+        micSet.setSamplingRate(1.0)
+        mic = Micrograph()
+        mic.setLocation(1, 'mic1.mrc')
+        micSet.append(mic)
+        prot1._defineOutputs(outputMicrographs=micSet)
+        # This protocol is not related, so it should not be in the run db
+        protOther = self.newProtocol(ProtImportMicrographs)
+        self.saveProtocol(protOther)
+        
+        prot2 = self.newProtocol(ProtUnionSet)
+        prot2.inputSets.append(Pointer(value=prot1.outputMicrographs))
+        self.saveProtocol(prot2)
+        prot2.makePathsAndClean()
+        self.proj.mapper.copyClosureTo(prot2.getDbPath(), [prot2.getObjId()])
+        
+        prot2Db = getProtocolFromDb(self.proj.path, prot2.getDbPath(), 
+                                    prot2.getObjId())
+        self.assertEqual(prot1.outputMicrographs.getObjId(),
+                         prot2Db.inputSets[0].get().getObjId())
+        self.assertIsNone(prot2Db.getMapper().selectById(protOther.getObjId()))
+        
+    def test_processStepExecutor(self):
+        """ Run the steps of a protocol in a pool of processes, the 
+        output should be defined by the step run in the main process.
+        """
+        prot = self.newProtocol(MyProcessProtocol, n=4)
+        self.saveProtocol(prot)
+        prot.makePathsAndClean()
+        self.proj.mapper.copyClosureTo(prot.getDbPath(), [prot.getObjId()])
+        
+        protKey = (self.proj.path, prot.getDbPath(), prot.getObjId())
+        classesDict = {'MyProcessProtocol': MyProcessProtocol}
+        protDb = getProtocolFromDb(*protKey, classesDict=classesDict)
+        protDb.setStepsExecutor(ProcessStepExecutor(None, 2, *(protKey + (MyProcessProtocol,))))
+        protDb.run()
+        
+        self.assertEqual([STATUS_FINISHED] * 5, 
+                         [step.getStatus() for step in protDb.loadSteps()])
+        for i in range(1, 5):
+            pid = int(open(protDb._getExtraPath('square_%02d.txt' % i)).read().split()[1])
+            self.assertNotEqual(os.getpid(), pid)
+        # The output was stored in the run db by the main process
+        protDb2 = getProtocolFromDb(*protKey, classesDict=classesDict)
+        self.assertEqual(30, protDb2.outputSum.get())
+        
+    def test_reloadPackageProtocols(self):
+        """ The runs of protocols defined in em-packages should be loaded
+        when the project is reloaded, even if their packages are not
+        imported yet (the classes are imported when needed).
+        """
+        from pyworkflow.project import Project
+        from pyworkflow.em.packages.xmipp3 import XmippProtCTFMicrographs
+        protImport = self.newProtocol(ProtImportMicrographs)
+        self.saveProtocol(protImport)
+        protCtf = self.newProtocol(XmippProtCTFMicrographs)
+        self.saveProtocol(protCtf)
+        
+        proj = Project(self.proj.path)
+        proj.load()
+        runs = dict((r.getObjId(), r.getClassName()) for r in proj.getRuns())
+        self.assertEqual('ProtImportMicrographs', runs.get(protImport.getObjId()))
+        self.assertEqual('XmippProtCTFMicrographs', runs.get(protCtf.getObjId()))
@@ -85,5 +85,106 @@ class TestProccess(BaseTest):
 
 
 
+class TestPackagesRegistry(BaseTest):
+    """ Check that the registry of classes only imports
+    the packages of the requested classes. """
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        
+    def _writePackage(self, path, name, code):
+        makePath(join(path, name))
+        f = open(join(path, name, '__init__.py'), 'w')
+        f.write(code)
+        f.close()
+        
+    def _getRegistry(self, packagesPath, registryFn):
+        from pyworkflow.em.registry import PackagesRegistry
+        from pyworkflow.protocol import Protocol
+        from pyworkflow.viewer import Viewer
+        return PackagesRegistry(packagesPath, registryFn,
+                                {'protocols': Protocol, 'viewers': Viewer})
+        
+    def test_lazyImport(self):
+        import sys
+        from pyworkflow.viewer import DESKTOP_TKINTER
+        packagesPath = self.getOutputPath('packages')
+        registryFn = self.getOutputPath('registry.json')
+        self._writePackage(packagesPath, 'regtest_pkga', 
+                           "from pyworkflow.protocol import Protocol\n"
+                           "class RegTestProtA(Protocol): pass\n")
+        self._writePackage(packagesPath, 'regtest_pkgb', 
+                           "from pyworkflow.viewer import Viewer\n"
+                           "from regtest_pkga import RegTestProtA\n"
+                           "class RegTestViewerB(Viewer):\n"
+                           "    _targets = [RegTestProtA]\n")
+        # The first time all packages are imported to build the registry
+        registry = self._getRegistry(packagesPath, registryFn)
+        self.assertTrue(registry.hasClass('protocols', 'RegTestProtA'))
+        self.assertTrue(exists(registryFn))
+        
+        for name in ['regtest_pkga', 'regtest_pkgb']:
+            del sys.modules[name]
+        registry = self._getRegistry(packagesPath, registryFn)
+        protClass = registry.getClass('protocols', 'RegTestProtA')
+        self.assertEqual('RegTestProtA', protClass.__name__)
+        self.assertEqual('regtest_pkga', protClass._package.__name__)
+        self.assertFalse('regtest_pkgb' in sys.modules)
+        
+        # Subclasses are found without importing their packages
+        from pyworkflow.protocol import Protocol
+        from pyworkflow.em.registry import LazyClassesDict
+        del sys.modules['regtest_pkga']
+        registry = self._getRegistry(packagesPath, registryFn)
+        classesDict = LazyClassesDict(registry, ['protocols'], Protocol=Protocol)
+        self.assertTrue('RegTestProtA' in classesDict.getSubclassNames(Protocol))
+        self.assertFalse('regtest_pkga' in sys.modules)
+        
+        viewers = registry.findClasses('viewers', DESKTOP_TKINTER, ['RegTestProtA'])
+        self.assertEqual(['RegTestViewerB'], [v.__name__ for v in viewers])
+        self.assertTrue('regtest_pkgb' in sys.modules)
+        
+        # Modify a package, so the registry is built again
+        self._writePackage(packagesPath, 'regtest_pkga', 
+                           "from pyworkflow.protocol import Protocol\n"
+                           "class RegTestProtA(Protocol): pass\n"
+                           "class RegTestProtA2(Protocol): pass\n")
+        mtime = os.path.getmtime(registryFn) + 10
+        os.utime(join(packagesPath, 'regtest_pkga', '__init__.py'), (mtime, mtime))
+        for name in ['regtest_pkga', 'regtest_pkgb']:
+            del sys.modules[name]
+        registry = self._getRegistry(packagesPath, registryFn)
+        self.assertTrue(registry.hasClass('protocols', 'RegTestProtA2'))
+
+
+class TestStar(BaseTest):
+    """ Check the STAR reader and writer of utils.star module. """
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        
+    def test_withoutXmipp(self):
+        """ Read and write a STAR file in a process where 
+        the xmipp module can not be imported.
+        """
+        import sys
+        import subprocess
+        fnStar = self.getOutputPath('noxmipp.star')
+        code = ("import sys\n"
+                "sys.modules['xmipp'] = None # import xmipp will fail\n"
+                "import numpy as np\n"
+                "from pyworkflow.utils.star import writeStar, readStar\n"
+                "writeStar('particles@%s', {'rlnImageName': np.array(['1@a.mrcs', '2@a.mrcs']),\n"
+                "                           'rlnDefocusU': np.array([1000., 2000.])},\n"
+                "          ['rlnImageName', 'rlnDefocusU'])\n"
+                "data = readStar('%s', 'particles')\n"
+                "assert list(data['rlnImageName']) == ['1@a.mrcs', '2@a.mrcs']\n"
+                "assert list(data['rlnDefocusU']) == [1000., 2000.]\n"
+                "assert data['rlnDefocusU'].dtype.kind == 'f'\n" % (fnStar, fnStar))
+        self.assertEqual(0, subprocess.call([sys.executable, '-c', code]))
+
+
 if __name__ == '__main__':
     unittest.main()        
@@ -34,29 +34,58 @@ from inspect import isclass
 
 
 
+def importModule(path, name):
+    """ Import the sub-module name under path.
+    Return the module or None if there were errors importing it.
+    """
+    if path not in sys.path:
+        sys.path.append(path)
+    try:
+        return __import__(name)
+    except Exception, ex:
+        print ">>> Error loading module: '%s'" % name
+        print ">>> Exception: ", ex
+        import traceback
+        traceback.print_exc()
+        return None
+
+
 def getModules(path):
     """ Try to find possible sub-modules under path.
     A dictionary will be returned with modules names
     as keys and the modules objects as values.
     """
-    sys.path.append(path)
     folders = os.listdir(path)
     modules = {}
 
     for f in folders:
         if exists(join(path, f, '__init__.py')):
-            try:
-                m = __import__(f)
+            m = importModule(path, f)
+            if m is not None:
                 modules[f] = m
-            except Exception, ex:
-                print ">>> Error loading module: '%s'" % f
-                print ">>> Exception: ", ex
-                import traceback
-                traceback.print_exc()
 
     return modules
 
 
+def getModulesMtimes(path):
+    """ Return a dictionary with the names of the sub-modules under path
+    as keys and the last modification time of their python files as
+    values, without importing them.
+    """
+    mtimes = {}
+
+    for f in os.listdir(path):
+        if exists(join(path, f, '__init__.py')):
+            mtime = 0
+            for root, _, files in os.walk(join(path, f)):
+                for fn in files:
+                    if fn.endswith('.py'):
+                        mtime = max(mtime, os.path.getmtime(join(root, fn)))
+            mtimes[f] = mtime
+
+    return mtimes
+
+
 def getSubclassesFromModules(BaseClass, modules, debug=False):
     """ Find subclasses of BaseClass from a give dict of modules.
     """
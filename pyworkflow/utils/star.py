@@ -0,0 +1,351 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+This module contains a reader and a writer of STAR files (the format of
+Relion star and Xmipp xmd metadata files) implemented in python and numpy.
+The data blocks are read and written in chunks of rows, as numpy
+structured arrays with one field per label, so big files are never
+completely in memory and no object is created per row.
+This module does not need the xmipp module (it is not in pyworkflow.em
+that requires it), xmipp is only used (if available) to know the type
+of the labels.
+"""
+
+import shlex
+from itertools import izip
+
+import numpy as np
+
+
+DEFAULT_CHUNK_SIZE = 100000
+
+# Numpy types used for the python types of labels
+NUMPY_TYPES = {int: np.int64,
+               long: np.int64,
+               float: np.float64,
+               bool: np.bool_,
+               str: np.object_}
+
+
+def getLabelTypes(labels):
+    """ Return a dict with the python type (int, float, bool, str..) of
+    the labels found in the Xmipp labels table. The type of the labels
+    not found (or all of them, if xmipp is not available) is guessed
+    from the values when reading.
+    """
+    try:
+        from pyworkflow.em.metadata.constants import LABEL_TYPES, MDL_UNDEFINED
+        from pyworkflow.em.metadata.functions import labelType, str2Label
+    except ImportError:
+        return {}
+
+    labelTypes = {}
+
+    for labelName in labels:
+        try:
+            label = str2Label(labelName)
+            if label != MDL_UNDEFINED:
+                labelTypes[labelName] = LABEL_TYPES.get(labelType(label), str)
+        except Exception: # not a valid label
+            pass
+
+    return labelTypes
+
+
+def splitLocation(filename):
+    """ Split an xmipp block@filename path into (blockName, filename).
+    The blockName is None if the path does not contain it.
+    """
+    if '@' in filename:
+        blockName, filename = filename.split('@', 1)
+        return blockName, filename
+    return None, filename
+
+
+def getBlocks(filename):
+    """ Return the names of the data blocks in a STAR file. """
+    blocks = []
+
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('data_'):
+                blocks.append(line.strip()[5:])
+
+    return blocks
+
+
+def _splitLine(line):
+    """ Split the values of a line, taking into account quoted strings. """
+    if '"' in line or "'" in line:
+        return shlex.split(line)
+    return line.split()
+
+
+class StarReader():
+    """ Read a data block of a STAR file in chunks of rows.
+    Params:
+        filename: the STAR file, could be in the blockName@filename form.
+        blockName: the name of the block to read, the first one if None.
+        chunkSize: maximum number of rows of each chunk.
+        labelTypes: dict with the python type of some labels. By default
+            the types are taken from the Xmipp labels table and the
+            rest are guessed from the values of the first chunk.
+    """
+    def __init__(self, filename, blockName=None,
+                 chunkSize=DEFAULT_CHUNK_SIZE, labelTypes=None):
+        fileBlock, filename = splitLocation(filename)
+        self.filename = filename
+        self.blockName = blockName or fileBlock
+        self.chunkSize = chunkSize
+        self.labels = []
+        self._file = open(filename)
+        self._pending = []
+        self.__readHeader()
+
+        types = getLabelTypes(self.labels) if labelTypes is None else labelTypes
+        self._dtypes = dict((label, NUMPY_TYPES.get(t, np.object_))
+                            for label, t in types.iteritems()
+                            if label in self.labels)
+
+    def __readHeader(self):
+        """ Find the block and read its labels. The first data row
+        (or all the values if the block is not a loop) are kept
+        in self._pending.
+        """
+        dataLine = None
+
+        for line in self._file:
+            if (line.startswith('data_') and
+                (self.blockName is None or line.strip()[5:] == self.blockName)):
+                dataLine = line
+                break
+
+        if dataLine is None:
+            raise Exception("StarReader: block '%s' not found in file '%s'"
+                            % (self.blockName, self.filename))
+
+        self.blockName = dataLine.strip()[5:]
+        self._isLoop = False
+        rowValues = []
+
+        for line in self._file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('data_'):
+                break
+            if line.startswith('loop_'):
+                self._isLoop = True
+            elif line.startswith('_'):
+                parts = _splitLine(line)
+                self.labels.append(parts[0][1:])
+                # In row format, the value is in the label line
+                if not self._isLoop and len(parts) > 1:
+                    rowValues.append(parts[1])
+            else:
+                self._pending.append(_splitLine(line))
+                break
+
+        if not self._isLoop and rowValues:
+            self._pending.append(rowValues)
+
+    def __iterRows(self):
+        """ Iterate over the values of the rows of the block. """
+        for values in self._pending:
+            yield values
+        self._pending = []
+
+        if self._isLoop:
+            for line in self._file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('data_') or line.startswith('loop_'):
+                    break
+                yield _splitLine(line)
+
+    def __convert(self, label, values):
+        """ Convert a column of values to the type of the label.
+        If the type is not known, integer and then float are tried.
+        If an integer or float column contains a value that can not
+        be converted, the type of the column is changed.
+        """
+        dtype = self._dtypes.get(label)
+
+        if dtype is None:
+            for dtype in [np.int64, np.float64]:
+                try:
+                    array = np.array(values, dtype=dtype)
+                    self._dtypes[label] = dtype
+                    return array
+                except ValueError:
+                    pass
+            dtype = self._dtypes[label] = np.object_
+
+        if dtype is np.bool_:
+            return np.array(values, dtype=np.int64).astype(np.bool_)
+        if dtype is np.object_:
+            return np.array(values, dtype=np.object_)
+
+        try:
+            return np.array(values, dtype=dtype)
+        except ValueError:
+            self._dtypes[label] = np.float64 if dtype is np.int64 else np.object_
+            return self.__convert(label, values)
+
+    def __toArray(self, rows):
+        columns = izip(*rows) if rows else [()] * len(self.labels)
+        arrays = [self.__convert(label, values)
+                  for label, values in izip(self.labels, columns)]
+        result = np.empty(len(rows), dtype=self.getDtype())
+
+        for label, array in izip(self.labels, arrays):
+            result[label] = array
+
+        return result
+
+    def getDtype(self):
+        """ Return the dtype of the arrays read (the types of
+        the labels not known are guessed with the first chunk).
+        """
+        return np.dtype([(label, self._dtypes.get(label, np.object_))
+                         for label in self.labels])
+
+    def iterChunks(self):
+        """ Iterate over the rows of the block in structured arrays
+        of at most chunkSize rows.
+        """
+        rows = []
+
+        for values in self.__iterRows():
+            if len(values) != len(self.labels):
+                raise Exception("StarReader: expected %d values and found %d "
+                                "in block '%s' of file '%s'"
+                                % (len(self.labels), len(values),
+                                   self.blockName, self.filename))
+            rows.append(values)
+            if len(rows) == self.chunkSize:
+                yield self.__toArray(rows)
+                rows = []
+
+        if rows:
+            yield self.__toArray(rows)
+
+    def read(self):
+        """ Read all (remaining) rows of the block in a single array. """
+        chunks = list(self.iterChunks())
+        if not chunks:
+            return self.__toArray([])
+        # Column types could be changed by later chunks
+        dtype = self.getDtype()
+        return np.concatenate([c.astype(dtype) for c in chunks])
+
+    def close(self):
+        self._file.close()
+
+
+class StarWriter():
+    """ Write a data block of a STAR file from chunks of rows.
+    Params:
+        filename: the STAR file, could be in the blockName@filename form.
+        labels: the labels of the block (without the leading _).
+        blockName: the name of the block.
+        mode: 'w' to create the file or 'a' to append the block.
+    """
+    def __init__(self, filename, labels, blockName='', mode='w'):
+        fileBlock, filename = splitLocation(filename)
+        self.filename = filename
+        self.labels = list(labels)
+        self.blockName = fileBlock or blockName
+        self._file = open(filename, mode)
+
+        if mode == 'w' and filename.endswith('.xmd'):
+            self._file.write('# XMIPP_STAR_1 * \n#\n')
+        self._file.write('data_%s\nloop_\n' % self.blockName)
+        for i, label in enumerate(self.labels):
+            # Relion labels are numbered, Xmipp ones are not
+            if label.startswith('rln'):
+                self._file.write('_%s #%d\n' % (label, i + 1))
+            else:
+                self._file.write(' _%s\n' % label)
+
+    def __getColumn(self, values):
+        """ Return the format and the list of values of a column. """
+        values = np.asarray(values)
+
+        if values.dtype.kind in 'iub':
+            return '%d', values.astype(np.int64).tolist()
+
+        if values.dtype.kind == 'f':
+            # Columns with small values (but not 0) are 
+            # written in scientific notation
+            small = (values != 0) & (np.abs(values) < 0.001)
+            return ('%0.6e' if small.any() else '%0.6f'), values.tolist()
+
+        strValues = [str(v) for v in values]
+        for i, v in enumerate(strValues):
+            if ' ' in v or not v:
+                strValues[i] = '"%s"' % v
+        return '%s', strValues
+
+    def writeChunk(self, columns):
+        """ Write some rows from columns, either a structured array or
+        a dict of arrays with the labels as keys.
+        """
+        formats, lists = zip(*[self.__getColumn(columns[label])
+                               for label in self.labels])
+        rowFormat = ' '.join(formats)
+        lines = [rowFormat % values for values in izip(*lists)]
+        if lines:
+            self._file.write('\n'.join(lines))
+            self._file.write('\n')
+
+    def close(self):
+        self._file.write('\n')
+        self._file.close()
+
+
+def readStar(filename, blockName=None, **kwargs):
+    """ Read a whole data block of a STAR file into a structured array. """
+    reader = StarReader(filename, blockName, **kwargs)
+    try:
+        return reader.read()
+    finally:
+        reader.close()
+
+
+def writeStar(filename, columns, labels=None, blockName='', mode='w'):
+    """ Write a data block with the columns (a structured array or a
+    dict of arrays). If labels is None, the names of the fields
+    of the structured array are used.
+    """
+    if labels is None:
+        labels = columns.dtype.names
+    writer = StarWriter(filename, labels, blockName, mode)
+    try:
+        writer.writeChunk(columns)
+    finally:
+        writer.close()
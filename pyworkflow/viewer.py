@@ -337,23 +337,17 @@ class ProtocolViewer(Protocol, Viewer):
         import pyworkflow.em.metadata as md
         if not os.path.exists(sqliteFn):
             projectionList = [] # List of list of 3 elements containing angleTilt, anglePsi, weight
-            
-            def getCloseProjection(angleRot, angleTilt):
-                """ Get an existing projection close to angleRot, angleTilt.
-                Return None if not found close enough.
-                """
-                for projection in projectionList:
-                    if abs(projection[0] - angleRot) <= 0.01 and abs(projection[1] - angleTilt) <= 0.01:
-                        return projection
-                return None            
+            projectionDict = {} # Projections by their angles rounded to 0.01
             
             weight = 1./numberOfParticles
             
             for angleRot, angleTilt in itemDataIterator:
-    #             print "angleTilt, anglePsi, parts", angleTilt, anglePsi, parts
-                projection = getCloseProjection(angleRot, angleTilt)
+                key = (int(round(angleRot * 100)), int(round(angleTilt * 100)))
+                projection = projectionDict.get(key)
                 if projection is None:
-                    projectionList.append([angleRot, angleTilt, weight])
+                    projection = [angleRot, angleTilt, weight]
+                    projectionDict[key] = projection
+                    projectionList.append(projection)
                 else:
                     projection[2] = projection[2] + weight
             
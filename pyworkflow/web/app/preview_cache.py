@@ -0,0 +1,139 @@
+# **************************************************************************
+# *
+# * Authors:    Jose Gutierrez (jose.gutierrez@cnb.csic.es)
+# *             Adrian Quintana (aquintana@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Disk cache of the PNG previews rendered by the web viewers, so the
+images are only read and rendered the first time they are shown.
+"""
+
+import os
+import hashlib
+import threading
+
+
+PREVIEWS_DIR = os.path.join('Tmp', 'WebPreviews')
+# Size of the previews cache of each project in MB
+PREVIEWS_SIZE = int(os.environ.get('SCIPION_WEB_PREVIEWS_SIZE', 512))
+
+
+class PreviewCache():
+    """ Store the previews as PNG files in a folder, with the key as name.
+    The key depends on the image file, its modification time and the
+    render parameters, so the previews of modified images are not used.
+    When the size of the cache is bigger than maxSize (in bytes), the
+    least recently used previews are removed.
+    """
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        self._size = None # Computed when needed
+        self._lock = threading.Lock()
+
+    def getKey(self, imageFn, *params):
+        """ Return the key for the preview of imageFn rendered with params,
+        or None if the image file does not exists.
+        """
+        if not os.path.exists(imageFn):
+            return None
+        st = os.stat(imageFn)
+        h = hashlib.md5(os.path.abspath(imageFn))
+        h.update(repr((st.st_mtime, st.st_size) + params))
+        return h.hexdigest()
+
+    def __getPreviewPath(self, key):
+        return os.path.join(self.path, key[:2], key + '.png')
+
+    def get(self, key):
+        """ Return the path of the preview with this key or None. """
+        previewFn = self.__getPreviewPath(key)
+
+        if not os.path.exists(previewFn):
+            return None
+        os.utime(previewFn, None) # Mark as recently used
+
+        return previewFn
+
+    def put(self, key, img):
+        """ Store the preview (a PIL image) and return its path. """
+        previewFn = self.__getPreviewPath(key)
+        tmpFn = '%s.tmp%d_%d' % (previewFn, os.getpid(),
+                                 threading.current_thread().ident)
+        if not os.path.exists(os.path.dirname(previewFn)):
+            try:
+                os.makedirs(os.path.dirname(previewFn))
+            except OSError: # created by other thread
+                pass
+        img.save(tmpFn, "PNG")
+        os.rename(tmpFn, previewFn)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(p[1] for p in self.__getPreviews())
+            else:
+                self._size += os.path.getsize(previewFn)
+            if self._size > self.maxSize:
+                self.__evict()
+
+        return previewFn
+
+    def __getPreviews(self):
+        """ Return a list of (lastUsed, size, path) of the previews. """
+        previews = []
+
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                if f.endswith('.png'):
+                    fn = os.path.join(root, f)
+                    st = os.stat(fn)
+                    previews.append((st.st_mtime, st.st_size, fn))
+
+        return previews
+
+    def __evict(self):
+        """ Remove least recently used previews until the size
+        is 90% of the maximum, to not evict in every put.
+        """
+        previews = sorted(self.__getPreviews())
+        self._size = sum(p[1] for p in previews)
+
+        for _, size, fn in previews:
+            if self._size <= 0.9 * self.maxSize:
+                break
+            try:
+                os.remove(fn)
+                self._size -= size
+            except OSError: # removed by other process
+                pass
+
+
+_previewCaches = {}
+
+def getPreviewCache(projectPath):
+    """ Return the previews cache of a project. """
+    if projectPath not in _previewCaches:
+        _previewCaches[projectPath] = PreviewCache(os.path.join(projectPath, PREVIEWS_DIR),
+                                                   PREVIEWS_SIZE * 1024 * 1024)
+    return _previewCaches[projectPath]
@@ -62,6 +62,13 @@ def loadTable(request, dataset, inputParams):
     
     dataset.projectPath = request.session['projectPath']
     table = dataset.getTable(inputParams[sj.TABLE_NAME])
+    
+    # Sort the rows when loading them, sortby is 'label [asc|desc]'
+    if inputParams[sj.SORT_BY]:
+        sortBy = inputParams[sj.SORT_BY].split()
+        for col in table.iterColumns():
+            if col.getLabel() == sortBy[0]:
+                table.setOrderBy(col.getName(), sortBy[1] if len(sortBy) > 1 else 'ASC')
         
     # Update inputParams to make sure have a valid table name (if using first table)
     inputParams[sj.TABLE_NAME] = dataset.currentTable()
@@ -30,7 +30,9 @@ import xmipp
 import json
 import mimetypes
 from django.shortcuts import render_to_response
-from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+from django.http import (HttpResponse, HttpResponseForbidden, HttpResponseNotFound,
+                         HttpResponseNotModified)
+from django.utils.http import http_date
 from django.core.servers.basehttp import FileWrapper
 
 import pyworkflow.em as em
@@ -41,6 +43,7 @@ from pyworkflow.utils import *
 from pyworkflow.gui import getImage, getPILImage
 from pyworkflow.dataset import COL_RENDER_IMAGE, COL_RENDER_VOLUME
 from pyworkflow.em.convert import ImageHandler
+from preview_cache import getPreviewCache
 
 iconDict = {
             'logo_scipion': 'scipion_logo_small_web.png',
@@ -486,6 +489,36 @@ def get_image_path(request):
     img.save(response, "PNG")
     return response
     
+def servePreview(request, imageFn, params, renderFunc):
+    """ Return a response with the PNG preview of imageFn rendered with 
+    params. renderFunc (that should return a PIL image) is only called if
+    the preview is not in the project cache. The ETag and Last-Modified 
+    headers are set, so browsers will not download it again if not changed.
+    """
+    key = None
+    if 'projectPath' in request.session:
+        cache = getPreviewCache(request.session['projectPath'])
+        key = cache.getKey(imageFn, *params)
+        
+    if key is None:
+        response = HttpResponse(mimetype="image/png")
+        renderFunc().save(response, "PNG")
+        return response
+    
+    etag = '"%s"' % key
+    if request.META.get('HTTP_IF_NONE_MATCH', None) == etag:
+        return HttpResponseNotModified()
+    
+    previewFn = cache.get(key) or cache.put(key, renderFunc())
+    f = open(previewFn, 'rb')
+    response = HttpResponse(f.read(), mimetype="image/png")
+    f.close()
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(os.path.getmtime(imageFn))
+    response['Cache-Control'] = 'no-cache' # Always validate with the ETag
+    
+    return response
+    
 def get_image(request):
     imageNo = None
     
@@ -505,6 +538,13 @@ def get_image(request):
     matrix = request.GET.get('matrix',None)
         
     try:
+        # Values of the transform applied to the image: the 3x3 rotation
+        # and the x, y, z shifts of the matrix (stored as json, see em.Matrix)
+        transform = None
+        if applyTransformMatrix and matrix:
+            tMatrix = json.loads(matrix)
+            transform = [float(v) for row in tMatrix[:3] for v in row[:4]]
+            
         # PAJM: Como vamos a gestionar lsa imagen    
         if imagePath.endswith('png') or imagePath.endswith('gif'):
             imagePathTmp = os.path.join(request.session['projectPath'], prefix + imagePath)
@@ -514,7 +554,8 @@ def get_image(request):
                 parts = imagePath.split('@')
                 imageNo = parts[0]
                 imagePath = parts[1]
-    
+            
+            imagePathTmp = imagePath
             if 'projectPath' in request.session:
                 imagePathTmp = os.path.join(request.session['projectPath'], imagePath)
                 if not os.path.isfile(imagePathTmp):
@@ -524,31 +565,33 @@ def get_image(request):
             if imageNo:
                 imagePath = '%s@%s' % (imageNo, imagePath) 
                 
-            imgXmipp = xmipp.Image()
-            imgXmipp.readPreview(imagePath, int(imageDim))
-            
-            #===================================================================
-            # Transform Matrix
-            if applyTransformMatrix: 
-                takarras=[tMatrix[0][0], tMatrix[0][1], tMatrix[0][2], x if x!=None else 0,
-                tMatrix[1][0], tMatrix[1][1], tMatrix[1][2], y if y!=None else 0,
-                tMatrix[2][0], tMatrix[2][1], tMatrix[2][2], z if z!=None else 0]
-#               imgXmipp.applyTransforMatScipion(matrix, onlyShifts, wrap)
-                imgXmipp.applyTransforMatScipion(takarras, onlyShifts, wrap)
-            #===================================================================
-            
-            #===================================================================
-            # Invert Y axis
-            if mirrorY: 
-                imgXmipp.mirrorY()
-            #===================================================================
-            
-            #TO DO: PSD FIX
-            if imagePath.endswith('.psd'):
-                imgXmipp.convertPSD()
+            def renderImage():
+                imgXmipp = xmipp.Image()
+                imgXmipp.readPreview(imagePath, int(imageDim))
+                
+                #===================================================================
+                # Transform Matrix
+                if transform is not None: 
+                    imgXmipp.applyTransforMatScipion(transform, onlyShifts, wrap)
+                #===================================================================
+                
+                #===================================================================
+                # Invert Y axis
+                if mirrorY: 
+                    imgXmipp.mirrorY()
+                #===================================================================
+                
+                #TO DO: PSD FIX
+                if imagePath.endswith('.psd'):
+                    imgXmipp.convertPSD()
+                
+                # from PIL import Image
+                return getPILImage(imgXmipp, None)
             
-            # from PIL import Image
-            img = getPILImage(imgXmipp, None)
+            # The transform values are part of the key, so the same image
+            # shown with other alignment does not get a cached preview
+            params = (imageNo, imageDim, mirrorY, onlyShifts, wrap, transform)
+            return servePreview(request, imagePathTmp, params, renderImage)
     except Exception:
         img = getImage(findResource(getResourceIcon("no_image")), tkImage=False)
 
@@ -579,28 +622,29 @@ def get_slice(request):
 #             imageNo = parts[0]
 #             imagePath = parts[1]
     imagePath = convertVolume(request, imagePath)
-    imgXmipp = xmipp.Image()
-    if sliceNo is None:
-        imgXmipp.readPreview(imagePath, int(imageDim))
-    else:
-        imgXmipp.readPreview(imagePath, int(imageDim), sliceNo)
-        
-#        if applyTransformMatrix and transformMatrix != None: 
-#            imgXmipp.applyTransforMatScipion(transformMatrix, onlyApplyShifts, wrap)
-#        
-    if mirrorY: 
-        imgXmipp.mirrorY()
-    
-    # from PIL import Image
-#   img = getPILImage(imgXmipp, None, False)
-    img = getPILImage(imgXmipp, normalize=False)
-    response = HttpResponse(mimetype="image/png")
     
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    img.save(response, "PNG")
+    def renderSlice():
+        imgXmipp = xmipp.Image()
+        if sliceNo is None:
+            imgXmipp.readPreview(imagePath, int(imageDim))
+        else:
+            imgXmipp.readPreview(imagePath, int(imageDim), sliceNo)
+            
+#            if applyTransformMatrix and transformMatrix != None: 
+#                imgXmipp.applyTransforMatScipion(transformMatrix, onlyApplyShifts, wrap)
+#            
+        if mirrorY: 
+            imgXmipp.mirrorY()
+        
+        # from PIL import Image
+#       img = getPILImage(imgXmipp, None, False)
+        img = getPILImage(imgXmipp, normalize=False)
+        
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return img
     
-    return response
+    return servePreview(request, imagePath, (sliceNo, imageDim, mirrorY), renderSlice)
 
 
 def get_image_dim(request):
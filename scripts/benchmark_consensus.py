@@ -0,0 +1,117 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Compare the time of merging the coordinates of several picking methods
+(as done by the consensus picking protocol) comparing each coordinate
+with all the others, or through the spatial index.
+Usage: scipion run scripts/benchmark_consensus.py [--mics N] [--picks N]
+"""
+
+import time
+import argparse
+import numpy as np
+
+from pyworkflow.em.spatial import mergeClosePoints
+
+
+def mergeAllVsAll(coords, radius):
+    """ Previous implementation of the consensus, comparing
+    each new coordinate with all the previous ones.
+    """
+    Ncoords = sum(len(c) for c in coords)
+    allCoords = np.zeros([Ncoords, 2])
+    votes = np.zeros(Ncoords)
+    N0 = len(coords[0])
+    allCoords[0:N0, :] = coords[0]
+    votes[0:N0] = 1
+    Ncurrent = N0
+
+    for n in range(1, len(coords)):
+        for coord in coords[n]:
+            dist = np.sum((coord - allCoords[0:Ncurrent])**2, axis=1)
+            imin = np.argmin(dist)
+            if np.sqrt(dist[imin]) < radius:
+                allCoords[imin, ] = (votes[imin]*allCoords[imin, ]+coord)/(votes[imin]+1)
+                votes[imin] += 1
+            else:
+                allCoords[Ncurrent, :] = coord
+                votes[Ncurrent] = 1
+                Ncurrent += 1
+
+    return allCoords[:Ncurrent], votes[:Ncurrent]
+
+
+def simulatePicks(picks, methods, size, boxSize):
+    """ Simulate the coordinates picked by several methods in a
+    micrograph, with some shift from the true particles positions,
+    some missing particles and some false positives.
+    """
+    particles = np.random.uniform(boxSize, size - boxSize, (picks, 2))
+    coords = []
+    for _ in range(methods):
+        found = particles[np.random.rand(picks) < 0.9]
+        found = found + np.random.normal(0, 2, found.shape)
+        false = np.random.uniform(0, size, (picks // 10, 2))
+        coords.append(np.round(np.vstack((found, false))))
+    return coords
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the time of the '
+                                     'consensus picking merge with and '
+                                     'without the spatial index.')
+    parser.add_argument('--mics', type=int, default=1000,
+                        help="number of micrographs")
+    parser.add_argument('--picks', type=int, default=2000,
+                        help="number of particles per micrograph")
+    parser.add_argument('--methods', type=int, default=2,
+                        help="number of picking methods")
+    parser.add_argument('--radius', type=int, default=10,
+                        help="consensus radius (in pixels)")
+    args = parser.parse_args()
+
+    times = {'all vs all': 0, 'spatial index': 0}
+    consensus = {'all vs all': 0, 'spatial index': 0}
+    
+    for _ in range(args.mics):
+        coords = simulatePicks(args.picks, args.methods, 4096, 100)
+        for label, func in [('all vs all', mergeAllVsAll),
+                            ('spatial index', mergeClosePoints)]:
+            t0 = time.time()
+            _, votes = func(coords, args.radius)
+            times[label] += time.time() - t0
+            consensus[label] += np.sum(votes >= args.methods)
+
+    print "%d micrographs x %d picks, %d methods" % (args.mics, args.picks,
+                                                     args.methods)
+    for label in ['all vs all', 'spatial index']:
+        print "%-15s time: %8.3fs  consensus coordinates: %d" % (label, 
+                                                                times[label],
+                                                                consensus[label])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Compare the time of converting the transforms of many particles to
+shifts and angles (and back) one by one and with the batch functions,
+and of reading the matrices of a set with its items or at once.
+Usage: scipion run scripts/benchmark_geometry.py [--particles N] [--output FILE]
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+from pyworkflow.em.data import SetOfParticles, Particle, Transform
+from pyworkflow.em.packages.relion.convert import (geometryFromMatrix, matrixFromGeometry,
+                                                   geometryFromMatrices, matricesFromGeometry)
+
+
+def timeIt(label, func, *args):
+    t0 = time.time()
+    result = func(*args)
+    print "%-30s %8.3fs" % (label, time.time() - t0)
+    return result
+
+
+def geometryOneByOne(matrices):
+    return [geometryFromMatrix(m, True) for m in matrices]
+
+
+def matricesOneByOne(shifts, angles):
+    return [matrixFromGeometry(s, a, True) for s, a in zip(shifts, angles)]
+
+
+def createSet(filename, matrices):
+    partSet = SetOfParticles(filename=filename)
+    p = Particle()
+    p.setLocation(1, 'particles.stk')
+    with partSet.bulkAppend():
+        for m in matrices:
+            p.setTransform(Transform(m))
+            partSet.append(p)
+            p.cleanObjId()
+    partSet.write()
+    return partSet
+
+
+def readOneByOne(partSet):
+    return np.array([p.getTransform().getMatrix() for p in partSet])
+
+
+def readAtOnce(partSet):
+    return partSet.getTransformMatrices()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the per particle '
+                                     'geometry conversions with the batch ones.')
+    parser.add_argument('--particles', type=int, default=200000,
+                        help="number of particles")
+    parser.add_argument('--output', default='benchmark_geometry.sqlite',
+                        help="sqlite file of the set of particles")
+    args = parser.parse_args()
+    n = args.particles
+
+    shifts = np.random.uniform(-10, 10, (n, 3))
+    angles = np.random.uniform(-180, 180, (n, 3))
+
+    matrices = timeIt('matrices one by one', matricesOneByOne, shifts, angles)
+    matrices2 = timeIt('matrices batch', matricesFromGeometry, shifts, angles, True)
+    print "Same matrices: ", np.allclose(matrices, matrices2)
+
+    timeIt('geometry one by one', geometryOneByOne, matrices2)
+    timeIt('geometry batch', geometryFromMatrices, matrices2, True)
+
+    partSet = createSet(args.output, matrices2)
+    fromItems = timeIt('read set items', readOneByOne, partSet)
+    atOnce = timeIt('read set matrices', readAtOnce, partSet)
+    print "Same matrices: ", np.allclose(fromItems, atOnce)
+    partSet.close()
+    os.remove(args.output)
+
+
+if __name__ == '__main__':
+    main()
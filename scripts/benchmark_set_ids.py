@@ -0,0 +1,115 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Compare the filter of movie particles done by Relion protocols (keep
+the movie particles whose particle is in the refined set) looking up
+each particle by id, or with Set.join and Set.hasIds.
+Usage: scipion run scripts/benchmark_set_ids.py [--particles N] [--frames N]
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from pyworkflow.utils.path import cleanPath
+from pyworkflow.em.data import (SetOfParticles, SetOfMovieParticles, 
+                                Particle, MovieParticle)
+
+
+def createSets(outputDir, nParticles, nFrames):
+    """ Create the movie particles and a set with half of the particles. """
+    partSet = SetOfParticles(filename=os.path.join(outputDir, 'particles.sqlite'))
+    movieSet = SetOfMovieParticles(filename=os.path.join(outputDir, 'movie_particles.sqlite'))
+    part = Particle()
+    part.setLocation(1, 'particles.mrcs')
+    moviePart = MovieParticle()
+    moviePart.setLocation(1, 'movie_particles.mrcs')
+
+    with partSet.bulkAppend(), movieSet.bulkAppend():
+        for partId in range(1, nParticles + 1):
+            if partId % 2:
+                part.setObjId(partId)
+                partSet.append(part)
+            for frameId in range(nFrames):
+                moviePart.cleanObjId()
+                moviePart.setParticleId(partId)
+                moviePart.setFrameId(frameId)
+                movieSet.append(moviePart)
+    partSet.write()
+    movieSet.write()
+
+    return partSet, movieSet
+
+
+def filterById(partSet, movieSet):
+    """ One query for each movie particle (as done before). """
+    return [mp.getObjId() for mp in movieSet
+            if partSet[mp.getParticleId()] is not None]
+
+
+def filterByJoin(partSet, movieSet):
+    return [mp.getObjId() for mp, _ in movieSet.join(partSet, on='_particleId')]
+
+
+def filterByHasIds(partSet, movieSet):
+    movieIds, partIds = movieSet.getColumnArrays(['id', '_particleId'])
+    present = partSet.hasIds(partIds)
+    return [mp.getObjId() for mp in movieSet.getItemsByIds(movieIds[np.array(present)])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the filter of movie '
+                                     'particles by id lookups against a join.')
+    parser.add_argument('--particles', type=int, default=100000,
+                        help="number of particles")
+    parser.add_argument('--frames', type=int, default=16,
+                        help="number of frames of each particle")
+    args = parser.parse_args()
+
+    outputDir = tempfile.mkdtemp()
+    try:
+        partSet, movieSet = createSets(outputDir, args.particles, args.frames)
+        results = []
+        for label, func in [('lookup by id', filterById),
+                            ('join', filterByJoin),
+                            ('hasIds', filterByHasIds)]:
+            t0 = time.time()
+            results.append(func(partSet, movieSet))
+            print "%-15s %8.3fs  (%d movie particles)" % (label, time.time() - t0,
+                                                         len(results[-1]))
+        if any(r != results[0] for r in results):
+            print "ERROR: the filters give different results"
+        partSet.close()
+        movieSet.close()
+    finally:
+        cleanPath(outputDir)
+
+
+if __name__ == '__main__':
+    main()
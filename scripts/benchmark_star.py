@@ -0,0 +1,116 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Compare the time of reading and writing a big STAR file with the
+numpy star module and with the MetaData class, row by row as
+done by the conversions functions.
+Usage: scipion run scripts/benchmark_star.py [--rows N] [--output FILE]
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+import pyworkflow.em.metadata as md
+from pyworkflow.utils.star import StarWriter, readStar, DEFAULT_CHUNK_SIZE
+
+
+LABELS = ['rlnImageName', 'rlnMicrographName', 'rlnDefocusU', 'rlnDefocusV',
+          'rlnDefocusAngle', 'rlnCoordinateX', 'rlnCoordinateY', 'rlnClassNumber']
+
+
+def createColumns(start, n):
+    """ Create the columns of n random particles starting at start. """
+    ids = np.arange(start, start + n)
+    return {'rlnImageName': np.array(['%06d@particles_%03d.mrcs' % (i % 1000 + 1, i / 1000)
+                                      for i in ids], dtype=object),
+            'rlnMicrographName': np.array(['mic_%03d.mrc' % (i / 1000) for i in ids],
+                                          dtype=object),
+            'rlnDefocusU': np.random.uniform(10000, 30000, n),
+            'rlnDefocusV': np.random.uniform(10000, 30000, n),
+            'rlnDefocusAngle': np.random.uniform(0, 180, n),
+            'rlnCoordinateX': np.random.uniform(0, 4096, n),
+            'rlnCoordinateY': np.random.uniform(0, 4096, n),
+            'rlnClassNumber': np.random.randint(1, 50, n)}
+
+
+def timeIt(label, func, *args):
+    t0 = time.time()
+    result = func(*args)
+    print "%-30s %8.3fs" % (label, time.time() - t0)
+    return result
+
+
+def writeNumpy(filename, rows):
+    writer = StarWriter(filename, LABELS, 'Particles')
+    for start in range(0, rows, DEFAULT_CHUNK_SIZE):
+        writer.writeChunk(createColumns(start, min(DEFAULT_CHUNK_SIZE, rows - start)))
+    writer.close()
+
+
+def readMetaData(filename):
+    """ Read the rows and their values, as readSetOfParticles does. """
+    mdStar = md.MetaData(filename)
+    values = [row.getValue(md.RLN_CTF_DEFOCUSU) for row in md.iterRows(mdStar)]
+    return len(values)
+
+
+def writeMetaData(filename, data):
+    """ Write the values row by row, as setOfImagesToMd does. """
+    mdStar = md.MetaData()
+    labels = [md.str2Label(label) for label in data.dtype.names]
+    for values in data:
+        row = md.Row()
+        for label, value in zip(labels, values.tolist()):
+            row.setValue(label, value)
+        row.writeToMd(mdStar, mdStar.addObject())
+    mdStar.write(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the star module '
+                                     'with the MetaData class.')
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help="number of rows of the STAR file")
+    parser.add_argument('--output', default='benchmark_particles.star',
+                        help="STAR file to write")
+    args = parser.parse_args()
+    starFile = 'Particles@%s' % args.output
+    mdFile = 'Particles@%s' % args.output.replace('.star', '_md.star')
+
+    timeIt('star module write', writeNumpy, starFile, args.rows)
+    data = timeIt('star module read', readStar, starFile)
+    timeIt('MetaData read', readMetaData, starFile)
+    timeIt('MetaData write', writeMetaData, mdFile, data)
+
+    for fn in [starFile, mdFile]:
+        os.remove(fn.split('@')[1])
+
+
+if __name__ == '__main__':
+    main()
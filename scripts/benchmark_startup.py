@@ -0,0 +1,82 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Measure the startup time of a new process that needs an em class,
+importing all em-packages (as before the packages registry) or only
+the package of the class through the registry.
+Usage: scipion run scripts/benchmark_startup.py [--runs N] [--class NAME]
+"""
+
+import sys
+import time
+import argparse
+import subprocess
+
+
+EAGER = """
+import pyworkflow.em as em
+em.getProtocols()
+em.getObjects()
+"""
+
+LAZY = """
+import pyworkflow.em as em
+em.findClass('%s')
+"""
+
+
+def timeProcess(code, runs):
+    """ Return the times (in seconds) of running code in new processes. """
+    times = []
+    for _ in range(runs):
+        t0 = time.time()
+        subprocess.check_call([sys.executable, '-c', code])
+        times.append(time.time() - t0)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the startup time of '
+                                     'importing all em-packages against the '
+                                     'lazy import through the packages registry.')
+    parser.add_argument('--runs', type=int, default=5,
+                        help="number of processes to run for each case")
+    parser.add_argument('--class', dest='className', default='ProtRelionRefine3D',
+                        help="em class to load in the lazy case")
+    args = parser.parse_args()
+
+    # First run to build the registry if it is not up to date
+    timeProcess(LAZY % args.className, 1)
+
+    for label, code in [('all packages', EAGER),
+                        ('registry', LAZY % args.className)]:
+        times = timeProcess(code, args.runs)
+        print "%-15s mean: %6.3fs  min: %6.3fs" % (label, sum(times) / len(times),
+                                                  min(times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (jmdelarosa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'jmdelarosa@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Migrate the sqlite files of SetOfClasses from the layout with a table
+per class (Class001, Class002...) to the layout with the items of all
+classes in a single table.
+Usage: scipion run scripts/migrate_classes.py [--keep] FILE [FILE ...]
+"""
+
+import argparse
+
+import pyworkflow.em as em
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Store the items of all '
+                                     'classes of SetOfClasses sqlite files '
+                                     'in a single table.')
+    parser.add_argument('files', nargs='+', metavar='FILE',
+                        help="sqlite files of SetOfClasses")
+    parser.add_argument('--keep', action='store_true',
+                        help="do not drop the table of each class")
+    args = parser.parse_args()
+
+    for fn in args.files:
+        classesSet = em.loadSetFromDb(fn)
+
+        if not isinstance(classesSet, em.SetOfClasses):
+            print "%s: skipped, it is a %s" % (fn, classesSet.getClassName())
+        elif classesSet.isSingleTable():
+            print "%s: skipped, already migrated" % fn
+        else:
+            classesSet.migrateToSingleTable(dropLegacy=not args.keep)
+            print "%s: migrated %d classes" % (fn, classesSet.getSize())
+
+        classesSet.close()
+
+
+if __name__ == '__main__':
+    main()